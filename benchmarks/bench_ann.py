@@ -0,0 +1,76 @@
+"""
+Filename: bench_ann.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Reports the build time of the IVF approximate nearest neighbour index of the local vector store,
+and queries per second and recall@k against exact search for a range of search breadths (n_probe),
+on a synthetic corpus of clustered vectors.
+
+Example: python benchmarks/bench_ann.py --vectors 200000 --lists 450 --output ann.json
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import argparse
+import tempfile
+import time
+from bench_utils import synthetic_vectors, write_results
+from local_vector_store import LocalVectorStore
+
+
+def run(store, queries, k):
+    start = time.perf_counter()
+    rows = [[row for row, _ in store.search_by_vector(query, k)] for query in queries]
+    return rows, len(queries) / (time.perf_counter() - start)
+
+
+def recall(results, reference):
+    return round(sum(len(set(a) & set(b)) / len(b) for a, b in zip(results, reference)) / len(reference), 4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the IVF index of the local vector store")
+    parser.add_argument('--vectors', type=int, default=200000, help="Number of chunk vectors")
+    parser.add_argument('--dimensions', type=int, default=1536)
+    parser.add_argument('--lists', type=int, default=0, help="Number of IVF lists (0 = sqrt(vectors))")
+    parser.add_argument('--n-probe', type=int, nargs='+', default=[1, 4, 8, 16, 32, 64], help="Search breadths to measure")
+    parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'float16', 'int8'])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    vectors, queries = synthetic_vectors(args.vectors, args.dimensions, clusters=max(100, args.vectors // 1000), queries=args.queries, seed=args.seed)
+    lists = args.lists or int(args.vectors ** 0.5)
+
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        LocalVectorStore.save(path, [str(i) for i in range(args.vectors)], [""] * args.vectors, [{}] * args.vectors, vectors, ann_lists=lists)
+        build_seconds = time.perf_counter() - start
+        del vectors
+
+        exact = LocalVectorStore(path, None, precision=args.precision)
+        reference, exact_qps = run(exact, queries, args.k)
+
+        results = {
+            "vectors": args.vectors,
+            "dimensions": args.dimensions,
+            "lists": lists,
+            "precision": args.precision,
+            "k": args.k,
+            "build_seconds": round(build_seconds, 2),
+            "exact_qps": round(exact_qps, 1),
+            "ann": [],
+        }
+        # The store shares the quantized vectors with the exact one, only the IVF index and n_probe differ
+        ann = LocalVectorStore(path, None, precision=args.precision, n_probe=1)
+        for n_probe in args.n_probe:
+            ann.n_probe = n_probe
+            rows, qps = run(ann, queries, args.k)
+            results["ann"].append({"n_probe": n_probe, "qps": round(qps, 1), "speedup": round(qps / exact_qps, 1), f"recall@{args.k}": recall(rows, reference)})
+
+    write_results(args.output, results)
@@ -0,0 +1,116 @@
+"""
+Filename: bench_corpus_load.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Compares the two layouts of the converted notes on a synthetic corpus: a directory with one pretty-printed
+JSON file per note (notes_to_json.py --format json) and the packed corpus (corpus_store.py). For both it reports
+the write time, the size on disk, the time to load all notes (as build_index.py does) and the latency of reading
+single notes by ID in random order. The files are read from the page cache after the first repeat; the first (cold)
+load is reported separately, but only a freshly booted machine or dropped caches give a truly cold read.
+
+Example: python benchmarks/bench_corpus_load.py --notes 50000 --lookups 2000 --output corpus.json
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from bench_utils import synthetic_corpus, latency_summary, directory_size, write_results
+from corpus_store import CorpusStore, CorpusWriter, corpus_index_path, load_notes
+
+
+def write_directory(directory, notes):
+    # The layout of notes_to_json.py --format json
+    os.makedirs(directory)
+    for note_id, data in notes.items():
+        with open(os.path.join(directory, note_id + ".json"), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def write_packed(path, notes):
+    with CorpusWriter(path) as writer:
+        for note_id, data in notes.items():
+            writer.add(note_id, data)
+
+
+def read_from_directory(directory, note_id):
+    with open(os.path.join(directory, note_id + ".json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def measure(layout, path, notes, lookup_ids, repeats):
+    """Returns the load and lookup results of a layout, checking that it reads back the notes it was written with."""
+    load_seconds = []
+    for _ in range(repeats):
+        loaded, seconds = timed(load_notes, path)
+        load_seconds.append(seconds)
+    if loaded != notes:
+        raise RuntimeError(f"The {layout} layout did not read back the written notes")
+
+    lookups = []
+    if layout == "packed":
+        corpus, open_seconds = timed(CorpusStore, path)
+        with corpus:
+            for note_id in lookup_ids:
+                _, seconds = timed(corpus.get, note_id)
+                lookups.append(seconds)
+    else:
+        open_seconds = 0.0
+        for note_id in lookup_ids:
+            _, seconds = timed(read_from_directory, path, note_id)
+            lookups.append(seconds)
+
+    return {
+        "first_load_seconds": round(load_seconds[0], 3),
+        "load_seconds": round(min(load_seconds), 3),
+        "notes_per_second": round(len(notes) / min(load_seconds), 1),
+        "open_seconds": round(open_seconds, 4),
+        "lookup": latency_summary(lookups),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark loading the notes from a packed corpus and from a directory of json files")
+    parser.add_argument('--notes', type=int, default=20000, help="Number of notes in the synthetic corpus")
+    parser.add_argument('--lookups', type=int, default=1000, help="Number of notes read by ID")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of full loads per layout (the best is reported)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    notes = synthetic_corpus(args.notes, seed=args.seed)
+    lookup_ids = random.Random(args.seed).choices(list(notes), k=args.lookups)
+    results = {"settings": {key: value for key, value in vars(args).items() if key != "output"}, "layouts": {}}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, "json")
+        packed = os.path.join(tmp, "notes.jsonl")
+        _, directory_write = timed(write_directory, directory, notes)
+        _, packed_write = timed(write_packed, packed, notes)
+
+        results["layouts"]["directory"] = {"write_seconds": round(directory_write, 3), "files": len(notes), "bytes": directory_size(directory),
+                                           **measure("directory", directory, notes, lookup_ids, args.repeats)}
+        results["layouts"]["packed"] = {"write_seconds": round(packed_write, 3), "files": 2,
+                                        "bytes": os.path.getsize(packed) + os.path.getsize(corpus_index_path(packed)),
+                                        **measure("packed", packed, notes, lookup_ids, args.repeats)}
+
+    directory_results, packed_results = results["layouts"]["directory"], results["layouts"]["packed"]
+    results["packed_vs_directory"] = {
+        "load_speedup": round(directory_results["load_seconds"] / packed_results["load_seconds"], 2),
+        "lookup_p50_speedup": round(directory_results["lookup"]["p50_ms"] / packed_results["lookup"]["p50_ms"], 2),
+        "size_ratio": round(packed_results["bytes"] / directory_results["bytes"], 3),
+    }
+    write_results(args.output, results)
@@ -0,0 +1,92 @@
+"""
+Filename: bench_embedding_batch.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Benchmark of the micro-batching of question embeddings (embedding_batcher.py) against a local stand-in of
+the embedding API: every request waits for a latency (fakes.py spec) plus a small cost per text, and at most
+--api-concurrency requests are served at a time (the connection pool and rate limits of a real API). For every batching
+window (0 = no batching) and concurrency level it reports the throughput and latency of the question embeddings,
+the number of embedding requests, the batch size distribution and the wait of the questions for their batch.
+
+Example: python benchmarks/bench_embedding_batch.py --windows 0 2 5 10 --concurrency 1 10 50 --requests 500 --output batch.json
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import argparse
+import asyncio
+from bench_graph import run_level
+from bench_utils import write_results
+from fakes import FakeEmbeddings, Latency
+from embedding_batcher import BatchingEmbeddings
+
+
+class LimitedEmbeddings(FakeEmbeddings):
+    """FakeEmbeddings serving at most max_concurrency requests at a time, with a latency per text on top of the request latency."""
+
+    def __init__(self, latency, text_latency_ms, max_concurrency, dimensions=1536, seed=0):
+        super().__init__(latency, dimensions=dimensions, seed=seed)
+        self.text_latency = text_latency_ms / 1000
+        self.max_concurrency = max_concurrency
+        self.semaphore = None
+        self.requests = 0
+
+    async def _request(self, texts):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.semaphore:
+            self.requests += 1
+            await asyncio.sleep(self.text_latency * len(texts))
+            return await super().aembed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        return await self._request(texts)
+
+    async def aembed_query(self, text):
+        return (await self._request([text]))[0]
+
+
+async def main(args):
+    results = {"settings": {key: value for key, value in vars(args).items() if key != "output"}, "windows": {}}
+    for window in args.windows:
+        levels = []
+        for concurrency in args.concurrency:
+            model = LimitedEmbeddings(args.embedding_latency, args.text_latency, args.api_concurrency, seed=args.seed)
+            embeddings = BatchingEmbeddings(model, window_ms=window, max_batch_size=args.max_batch_size) if window > 0 else model
+            # Every question is distinct, so the batches are not helped by duplicates
+            questions = [f"benchmark question {i}" for i in range(args.requests)]
+
+            async def request(question, breakdown):
+                await embeddings.aembed_query(question)
+                return {}
+
+            level = await run_level(request, questions, concurrency, args.requests)
+            level["embedding_requests"] = model.requests
+            if window > 0:
+                level["batching"] = embeddings.stats()
+            levels.append(level)
+            print(f"window {window} ms, concurrency {concurrency}: {level['requests_per_second']:.1f} questions/s, "
+                  f"p50 {level['latency'].get('p50_ms', 0):.1f} ms, p95 {level['latency'].get('p95_ms', 0):.1f} ms, "
+                  f"{model.requests} embedding requests")
+        results["windows"][str(window)] = levels
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the micro-batching of concurrent question embeddings")
+    parser.add_argument('--windows', type=float, nargs='+', default=[0, 2, 5, 10], help="Batching windows in ms (0 = no batching)")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50], help="Numbers of questions in flight")
+    parser.add_argument('--requests', type=int, default=500, help="Number of questions per level")
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--embedding-latency', type=str, default='lognormal:40:0.3', help="Latency spec of an embedding request in ms (see fakes.py)")
+    parser.add_argument('--text-latency', type=float, default=0.2, help="Additional latency per embedded text in ms")
+    parser.add_argument('--api-concurrency', type=int, default=8, help="Embedding requests served at a time")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+    Latency(args.embedding_latency)  # fails early on an invalid spec
+
+    write_results(args.output, asyncio.run(main(args)))
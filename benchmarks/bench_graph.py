@@ -0,0 +1,196 @@
+"""
+Filename: bench_graph.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Offline benchmark of the search graph and the search API. The retriever, chains and web search tool are replaced
+by the local stand-ins of fakes.py (with configurable latency distributions), so no OpenAI, Azure AI Search or Tavily account
+is needed. For every concurrency level it keeps that many questions in flight and reports throughput, p50/p95/p99 latency
+and the latency of every graph node and outbound call. Targets:
+- graph: the compiled search graph (ainvoke),
+- api: POST /answer of the FastAPI app (create_app in search_notes.py), in process through httpx's ASGI transport,
+- stream: the server-sent events of POST /answer/stream (stream_answer in search_notes.py), also reporting the time to
+  the first answer token. The events are consumed from the app's generator, as httpx's ASGI transport buffers whole responses.
+
+Example: python benchmarks/bench_graph.py --target graph api stream --concurrency 1 8 32 --requests 128 --output graph.json
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+import httpx
+from bench_utils import latency_summary, write_results
+from fakes import FakeRetriever, FakeMainChain, FakeEvalChain, FakeJudgeChain, FakeWebSearchTool, Latency
+import metrics
+from graph_builder import build_graph
+from graph_operations import GraphOperations
+from llm_scheduler import LLMScheduler
+
+
+def build_fake_graph(args):
+    """Returns (retriever, graph operations, compiled graph) with the fake services."""
+    retriever = FakeRetriever(args.embedding_latency, args.search_latency, seed=args.seed)
+    scheduler = None
+    if args.llm_parallel:
+        scheduler = LLMScheduler(max_parallel=args.llm_parallel, max_queue=args.llm_queue, queue_timeout=args.llm_queue_timeout)
+    main_chain = FakeMainChain(args.first_token_latency, args.token_latency, answer_words=args.answer_words, scheduler=scheduler, seed=args.seed)
+    eval_chain = FakeEvalChain(args.eval_latency, sufficient_rate=args.sufficient_rate, scheduler=scheduler, seed=args.seed)
+    judge_chain = FakeJudgeChain(args.eval_latency, args.token_latency, answer_words=args.answer_words,
+                                 sufficient_rate=args.sufficient_rate, scheduler=scheduler, seed=args.seed)
+    web_search_tool = FakeWebSearchTool(args.web_search_latency, seed=args.seed)
+    graph_ops = GraphOperations(retriever, main_chain, eval_chain, web_search_tool, speculative_search=args.speculative, judge_chain=judge_chain)
+    return retriever, graph_ops, build_graph(graph_ops, mode=args.graph_mode)
+
+
+def load_search_notes(retriever, graph_ops, graph):
+    """Returns the search_notes module (the FastAPI app and its request handlers) serving the fake graph."""
+    # search_notes builds its (real) components at import: they only connect on first use, so dummy settings are enough
+    os.environ.update({
+        "OPENAI_API_KEY": "benchmark", "TAVILY_API_KEY": "benchmark", "SEARCH_BACKEND": "azure",
+        "AZURESEARCH_ENDPOINT": "https://benchmark.invalid", "AZURESEARCH_ADMIN_KEY": "benchmark", "AZURESEARCH_INDEX_NAME": "benchmark",
+        "EVALUATOR": "llm", "ANSWER_CACHE": "0", "EMBEDDING_CACHE_PATH": "",
+    })
+    import search_notes
+
+    # The app reads these module attributes on every request
+    search_notes.retriever = retriever
+    search_notes.graph_ops = graph_ops
+    search_notes.search_graph = graph
+    search_notes.warmup_state.update(ready=True, seconds=0.0)
+    return search_notes
+
+
+def add_timings(breakdown, timings):
+    for timing in timings:
+        breakdown.setdefault(f"{timing['kind']}:{timing['name']}", []).append(timing["ms"] / 1000)
+
+
+async def graph_request(graph, question, breakdown):
+    timings = metrics.start_timings()
+    await graph.ainvoke({"question": question})
+    add_timings(breakdown, timings)
+    return {}
+
+
+async def api_request(client, question, breakdown):
+    response = await client.post("/answer", json={"question": question, "timings": True})
+    response.raise_for_status()
+    add_timings(breakdown, response.json()["timings"])
+    return {}
+
+
+async def stream_request(stream_answer, question, breakdown):
+    timings = metrics.start_timings()
+    start = time.perf_counter()
+    first_token = None
+    async for event in stream_answer(question):
+        if event.startswith("event: token") and first_token is None:
+            first_token = time.perf_counter() - start
+        elif event.startswith("event: error"):
+            raise RuntimeError(event)
+    add_timings(breakdown, timings)
+    return {"first_token": first_token}
+
+
+async def run_level(request, questions, concurrency, requests):
+    """Sends the requests with at most concurrency of them in flight. Returns the level results."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    first_tokens = []
+    breakdown = {}
+    errors = 0
+
+    async def ask(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                result = await request(questions[i % len(questions)], breakdown)
+                latencies.append(time.perf_counter() - start)
+                if result.get("first_token") is not None:
+                    first_tokens.append(result["first_token"])
+            except Exception:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[ask(i) for i in range(requests)])
+    seconds = time.perf_counter() - start
+
+    results = {
+        "concurrency": concurrency,
+        "requests_per_second": round(len(latencies) / seconds, 2),
+        "errors": errors,
+        "latency": latency_summary(latencies),
+    }
+    if first_tokens:
+        results["first_token"] = latency_summary(first_tokens)
+    if breakdown:
+        results["breakdown"] = {name: latency_summary(values) for name, values in sorted(breakdown.items())}
+    return results
+
+
+async def main(args):
+    retriever, graph_ops, graph = build_fake_graph(args)
+    questions = [f"benchmark question {i}" for i in range(args.questions)]
+    results = {"settings": {key: value for key, value in vars(args).items() if key != "output"}, "targets": {}}
+
+    search_notes = load_search_notes(retriever, graph_ops, graph) if {"api", "stream"} & set(args.target) else None
+    app = search_notes.create_app() if search_notes is not None else None
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=None, limits=limits) as client:
+        requests = {
+            "graph": lambda question, breakdown: graph_request(graph, question, breakdown),
+            "api": lambda question, breakdown: api_request(client, question, breakdown),
+            "stream": lambda question, breakdown: stream_request(search_notes.stream_answer, question, breakdown),
+        }
+        for target in args.target:
+            levels = []
+            for concurrency in args.concurrency:
+                level = await run_level(requests[target], questions, concurrency, args.requests)
+                levels.append(level)
+                print(f"{target}, concurrency {concurrency}: {level['requests_per_second']:.2f} requests/s, "
+                      f"p95 {level['latency'].get('p95_ms', 0):.1f} ms, {level['errors']} errors")
+            results["targets"][target] = levels
+    return results
+
+
+def check_latencies(args):
+    for spec in (args.embedding_latency, args.search_latency, args.eval_latency, args.first_token_latency, args.token_latency, args.web_search_latency):
+        Latency(spec)  # fails early on an invalid spec
+
+
+def add_service_arguments(parser):
+    """Adds the options of the fake services and the load (shared with bench_judge.py)."""
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help="Numbers of requests in flight")
+    parser.add_argument('--requests', type=int, default=64, help="Number of requests per concurrency level")
+    parser.add_argument('--questions', type=int, default=50, help="Number of distinct questions")
+    parser.add_argument('--embedding-latency', type=str, default='lognormal:40:0.3', help="Latency spec in ms (see fakes.py)")
+    parser.add_argument('--search-latency', type=str, default='lognormal:60:0.3')
+    parser.add_argument('--eval-latency', type=str, default='lognormal:500:0.3')
+    parser.add_argument('--first-token-latency', type=str, default='lognormal:400:0.3')
+    parser.add_argument('--token-latency', type=str, default='15')
+    parser.add_argument('--answer-words', type=int, default=40)
+    parser.add_argument('--web-search-latency', type=str, default='lognormal:900:0.4')
+    parser.add_argument('--sufficient-rate', type=float, default=0.7, help="Share of questions answered from the notes (no web search)")
+    parser.add_argument('--graph-mode', type=str, default='two_call', choices=['two_call', 'fused'], help="Graph mode (see graph_builder.py)")
+    parser.add_argument('--speculative', action='store_true', help="Start the web search concurrently with the evaluation")
+    parser.add_argument('--llm-parallel', type=int, default=0, help="Parallel slots of the LLM scheduler (a local inference server), 0 = no scheduler")
+    parser.add_argument('--llm-queue', type=int, default=32, help="Maximum LLM calls waiting in the scheduler queue")
+    parser.add_argument('--llm-queue-timeout', type=float, default=30.0, help="Maximum wait in the scheduler queue in seconds")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the search graph and API with local stand-ins of the external services")
+    parser.add_argument('--target', type=str, nargs='+', default=['graph', 'api'], choices=['graph', 'api', 'stream'])
+    add_service_arguments(parser)
+    parser.add_argument('--output', type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+    check_latencies(args)
+
+    write_results(args.output, asyncio.run(main(args)))
@@ -0,0 +1,141 @@
+"""
+Filename: bench_hybrid_search.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Benchmark of the local hybrid search (vector + BM25 with reciprocal rank fusion).
+
+It runs in two modes:
+- fixture (default): builds a local index from a synthetic fixture corpus with deterministic local embeddings and reports
+  query latency of vector, keyword and hybrid search, plus the overlap of hybrid results with vector-only results:
+  python benchmarks/bench_hybrid_search.py --notes 2000 --output hybrid.json
+- azure: compares the local hybrid search with the Azure AI Search hybrid path on the same questions. Needs the .env variables
+  and a local index built from the same notes (python create-index/build_index.py --target both):
+  python benchmarks/bench_hybrid_search.py --azure --local-index data/local_index --questions-file questions.jsonl
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from bench_utils import HashingEmbeddings, synthetic_corpus, synthetic_questions, build_fixture_index, latency_summary, directory_size, write_results
+
+
+def overlap(results, reference):
+    """Average fraction of the reference top-k found in the results top-k (compared by chunk content)."""
+    shared = [
+        len({doc.page_content for doc in a} & {doc.page_content for doc in b}) / max(1, len(b))
+        for a, b in zip(results, reference)
+    ]
+    return round(sum(shared) / max(1, len(shared)), 3)
+
+
+def run(search, questions):
+    """Runs the search for every question. Returns (results, latencies in seconds)."""
+    results = []
+    latencies = []
+    for question in questions:
+        start = time.perf_counter()
+        results.append(search(question))
+        latencies.append(time.perf_counter() - start)
+    return results, latencies
+
+
+def fixture_benchmark(args):
+    from local_vector_store import LocalVectorStore
+
+    notes = synthetic_corpus(args.notes, seed=args.seed)
+    questions = synthetic_questions(notes, args.questions, seed=args.seed)
+    embeddings = HashingEmbeddings()
+
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        chunks = build_fixture_index(path, notes, embeddings)
+        build_seconds = time.perf_counter() - start
+        store = LocalVectorStore(path, embeddings.embed_query)
+
+        # Embed the questions up front, so the latencies below measure the search only
+        vectors = {question: embeddings.embed_query(question) for question in questions}
+        store.embedding_function = vectors.__getitem__
+
+        vector_results, vector_latencies = run(lambda q: store.similarity_search(q, k=args.k), questions)
+        _, keyword_latencies = run(lambda q: store.keyword_index.search(q, args.k), questions)
+        hybrid_results, hybrid_latencies = run(lambda q: store.hybrid_search(q, k=args.k), questions)
+
+        return {
+            "mode": "fixture",
+            "notes": args.notes,
+            "chunks": chunks,
+            "k": args.k,
+            "index_build_seconds": round(build_seconds, 2),
+            "index_bytes": directory_size(path),
+            "vector": latency_summary(vector_latencies),
+            "keyword": latency_summary(keyword_latencies),
+            "hybrid": latency_summary(hybrid_latencies),
+            "hybrid_overlap_with_vector": overlap(hybrid_results, vector_results),
+        }
+
+
+def azure_benchmark(args):
+    from dotenv import load_dotenv, find_dotenv
+    from retriever import Retriever
+
+    _ = load_dotenv(find_dotenv(filename='.env'))
+    with open(args.questions_file, "r", encoding="utf-8") as f:
+        questions = [json.loads(line)["question"] for line in f if line.strip()]
+
+    def retriever(backend):
+        return Retriever(
+            openai_api_key=os.getenv("OPENAI_API_KEY"),
+            open_ai_api_version="2023-05-15",
+            embedding_model_name="text-embedding-ada-002",
+            embedding_provider="openai",
+            vector_store_address=os.getenv("AZURESEARCH_ENDPOINT"),
+            vector_store_password=os.getenv("AZURESEARCH_ADMIN_KEY"),
+            vector_store_index=os.getenv("AZURESEARCH_INDEX_NAME"),
+            retrieved_documents=args.k,
+            search_type="hybrid",
+            embedding_cache_path=args.embedding_cache,
+            backend=backend,
+            local_index_path=args.local_index,
+        )
+
+    azure = retriever("azure")
+    local = retriever("local")
+    # Warm the embedding cache, so both paths measure the search and not the embedding round trip
+    azure.embeddings.embed_documents(questions)
+
+    azure_results, azure_latencies = run(azure.retrieve, questions)
+    local_results, local_latencies = run(local.retrieve, questions)
+    return {
+        "mode": "azure",
+        "questions": len(questions),
+        "k": args.k,
+        "azure_hybrid": latency_summary(azure_latencies),
+        "local_hybrid": latency_summary(local_latencies),
+        "local_overlap_with_azure": overlap(local_results, azure_results),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the local hybrid search")
+    parser.add_argument('--notes', type=int, default=2000, help="Number of notes in the synthetic fixture corpus")
+    parser.add_argument('--questions', type=int, default=200, help="Number of synthetic questions")
+    parser.add_argument('--k', type=int, default=3, help="Number of retrieved chunks")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--azure', action='store_true', help="Compare with Azure AI Search instead of using the fixture corpus")
+    parser.add_argument('--local-index', type=str, default='data/local_index', help="Local index built from the notes in Azure (azure mode)")
+    parser.add_argument('--questions-file', type=str, help="JSONL file with {\"question\": ...} lines (azure mode)")
+    parser.add_argument('--embedding-cache', type=str, default='data/embedding_cache.sqlite', help="Embedding cache (azure mode)")
+    parser.add_argument('--output', type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.azure and not args.questions_file:
+        parser.error("--azure needs --questions-file")
+
+    write_results(args.output, azure_benchmark(args) if args.azure else fixture_benchmark(args))
@@ -0,0 +1,76 @@
+"""
+Filename: bench_judge.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Compares the two graph modes with the local stand-ins of fakes.py: "two_call" (the evaluation chain, then
+the main chain) and "fused" (the judge chain evaluates and answers in one call, the main chain only runs after a web search).
+For every concurrency level it reports throughput and latency of the graph, and the LLM calls and estimated prompt and
+completion tokens per question - the cost. The services and load take the options of bench_graph.py.
+
+Example: python benchmarks/bench_judge.py --concurrency 1 16 --requests 64 --sufficient-rate 0.7 --output judge.json
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import argparse
+import asyncio
+from bench_graph import add_service_arguments, build_fake_graph, check_latencies, graph_request, run_level
+from bench_utils import write_results
+from fakes import new_usage
+
+
+def chain_usage(graph_ops):
+    """Returns the usage of the chains of the graph added up, and resets it."""
+    total = new_usage()
+    for chain in (graph_ops.main_chain, graph_ops.eval_chain, graph_ops.judge_chain):
+        for key in total:
+            total[key] += chain.usage[key]
+        chain.usage = new_usage()
+    return total
+
+
+async def main(args):
+    questions = [f"benchmark question {i}" for i in range(args.questions)]
+    results = {"settings": {key: value for key, value in vars(args).items() if key not in ("output", "graph_mode")}, "modes": {}}
+
+    for mode in ("two_call", "fused"):
+        args.graph_mode = mode
+        _, graph_ops, graph = build_fake_graph(args)
+        levels = []
+        for concurrency in args.concurrency:
+            level = await run_level(lambda question, breakdown: graph_request(graph, question, breakdown), questions, concurrency, args.requests)
+            usage = chain_usage(graph_ops)
+            answered = args.requests - level["errors"]
+            level["per_question"] = {key: round(value / answered, 2) for key, value in usage.items()} if answered else {}
+            levels.append(level)
+            print(f"{mode}, concurrency {concurrency}: {level['requests_per_second']:.2f} requests/s, "
+                  f"p50 {level['latency'].get('p50_ms', 0):.1f} ms, p95 {level['latency'].get('p95_ms', 0):.1f} ms, "
+                  f"{level['per_question'].get('calls', 0)} LLM calls and {level['per_question'].get('prompt_tokens', 0)} prompt tokens per question")
+        results["modes"][mode] = levels
+
+    # Fused relative to two_call, per concurrency level
+    results["fused_vs_two_call"] = [
+        {
+            "concurrency": two_call["concurrency"],
+            "p50_latency_ratio": round(fused["latency"]["p50_ms"] / two_call["latency"]["p50_ms"], 3),
+            "p95_latency_ratio": round(fused["latency"]["p95_ms"] / two_call["latency"]["p95_ms"], 3),
+            "llm_calls_ratio": round(fused["per_question"]["calls"] / two_call["per_question"]["calls"], 3),
+            "prompt_tokens_ratio": round(fused["per_question"]["prompt_tokens"] / two_call["per_question"]["prompt_tokens"], 3),
+        }
+        for two_call, fused in zip(results["modes"]["two_call"], results["modes"]["fused"])
+        if two_call["latency"] and fused["latency"]
+    ]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the two-call and fused (judge and answer) graph modes")
+    add_service_arguments(parser)
+    parser.add_argument('--output', type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+    check_latencies(args)
+
+    write_results(args.output, asyncio.run(main(args)))
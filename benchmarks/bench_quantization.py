@@ -0,0 +1,79 @@
+"""
+Filename: bench_quantization.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Reports recall@k, memory and query latency of the vector storage modes of the local index
+(float32, float16 and int8, with and without exact rescoring) on a synthetic corpus of clustered 1536-dimensional vectors.
+The reference is the exact float32 search.
+
+Example: python benchmarks/bench_quantization.py --vectors 50000 --k 3 --output quantization.json
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import argparse
+import tempfile
+import time
+from bench_utils import synthetic_vectors, latency_summary, write_results
+from local_vector_store import LocalVectorStore
+
+
+def recall(results, reference):
+    """Average fraction of the exact top-k rows found by the approximate search."""
+    return round(sum(len(set(a) & set(b)) / len(b) for a, b in zip(results, reference)) / len(reference), 4)
+
+
+def run(store, queries, k):
+    rows = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        rows.append([row for row, _ in store.search_by_vector(query, k)])
+        latencies.append(time.perf_counter() - start)
+    return rows, latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark quantized vector storage of the local index")
+    parser.add_argument('--vectors', type=int, default=50000, help="Number of chunk vectors")
+    parser.add_argument('--dimensions', type=int, default=1536, help="Vector dimensions (1536 for text-embedding-ada-002)")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    vectors, queries = synthetic_vectors(args.vectors, args.dimensions, queries=args.queries, seed=args.seed)
+    settings = [
+        ("float32", 0),
+        ("float16", 0),
+        ("float16", 4 * args.k),
+        ("int8", 0),
+        ("int8", 4 * args.k),
+        ("int8", 10 * args.k),
+    ]
+
+    results = {"vectors": args.vectors, "dimensions": args.dimensions, "queries": args.queries, "k": args.k, "settings": []}
+    with tempfile.TemporaryDirectory() as path:
+        LocalVectorStore.save(path, [str(i) for i in range(args.vectors)], [""] * args.vectors, [{}] * args.vectors, vectors)
+        del vectors
+
+        reference = None
+        for precision, rescore in settings:
+            store = LocalVectorStore(path, None, precision=precision, rescore=rescore)
+            rows, latencies = run(store, queries, args.k)
+            if reference is None:
+                reference = rows
+            results["settings"].append({
+                "precision": precision,
+                "rescore": rescore,
+                "memory_mb": round(store.memory_bytes() / 2**20, 1),
+                f"recall@{args.k}": recall(rows, reference),
+                "latency": latency_summary(latencies),
+            })
+            del store
+
+    write_results(args.output, results)
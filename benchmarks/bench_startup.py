@@ -0,0 +1,61 @@
+"""
+Filename: bench_startup.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Measures the cold start of the search API: the time a fresh Python process takes to import search_notes.py
+(imports and construction of the retriever, chains, tools and graph), which is what every new worker pays before serving.
+By default it runs offline with the local backend on a synthetic fixture index (no service is called at startup);
+with --azure it uses the .env configuration, including the Azure AI Search setup.
+
+Example: python benchmarks/bench_startup.py --runs 5 --output startup.json
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from bench_utils import HashingEmbeddings, synthetic_corpus, build_fixture_index, latency_summary, repo_root, write_results
+
+# Prints the import time of search_notes measured inside the child process
+probe = "import time; start = time.perf_counter(); import search_notes; print(time.perf_counter() - start)"
+
+
+def cold_start(env, runs):
+    """Imports search_notes in `runs` fresh processes. Returns the import times in seconds."""
+    seconds = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", probe], cwd=os.path.join(repo_root, "search-index"), env=env,
+                                capture_output=True, text=True, check=True)
+        seconds.append(float(result.stdout.strip().splitlines()[-1]))
+    return seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the cold start of the search API")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--notes', type=int, default=2000, help="Number of notes in the fixture index (local backend)")
+    parser.add_argument('--azure', action='store_true', help="Use the .env configuration (Azure AI Search backend) instead of the fixture index")
+    parser.add_argument('--output', type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    with tempfile.TemporaryDirectory() as path:
+        if not args.azure:
+            build_fixture_index(path, synthetic_corpus(args.notes), HashingEmbeddings(dimensions=1536))
+            env.update(SEARCH_BACKEND="local", LOCAL_INDEX_PATH=path)
+            # The clients are only constructed at startup, no request is sent
+            env.setdefault("OPENAI_API_KEY", "startup-benchmark")
+            env.setdefault("TAVILY_API_KEY", "startup-benchmark")
+        seconds = cold_start(env, args.runs)
+
+    write_results(args.output, {
+        "backend": "azure" if args.azure else "local",
+        "runs": args.runs,
+        "import": latency_summary(seconds),
+    })
@@ -0,0 +1,149 @@
+"""
+Filename: bench_utils.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Helpers shared by the benchmark scripts: synthetic fixture corpora and vectors, deterministic local embeddings
+(so no OpenAI account is needed), latency percentiles and result files.
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import hashlib
+import json
+import os
+import random
+import string
+import sys
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# The benchmarks use the modules of both components, which are flat script directories
+repo_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(repo_root, 'search-index'))
+sys.path.append(os.path.join(repo_root, 'create-index'))
+
+from bm25_index import tokenize
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Deterministic local embeddings: a signed hashed bag of words, L2-normalized.
+    A stand-in for the OpenAI embedding model - texts sharing words get similar vectors.
+    """
+
+    def __init__(self, dimensions=256):
+        self.dimensions = dimensions
+
+    def embed_query(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for token in tokenize(text):
+            h = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+            vector[h % self.dimensions] += 1.0 if h >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def _word(rng):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 9)))
+
+
+def synthetic_corpus(n_notes, seed=0, topics=20, vocabulary_size=5000):
+    """
+    Returns {note_id: {"title", "content", "label"}} - notes in the format written by notes_to_json.py.
+    Every note belongs to a topic (its label) and draws most of its words from the topic vocabulary.
+    """
+    rng = random.Random(seed)
+    vocabulary = [_word(rng) for _ in range(vocabulary_size)]
+    topic_words = [rng.sample(vocabulary, 200) for _ in range(topics)]
+
+    notes = {}
+    for i in range(n_notes):
+        topic = rng.randrange(topics)
+        sentences = []
+        for _ in range(rng.randint(5, 30)):
+            words = [rng.choice(topic_words[topic]) if rng.random() < 0.7 else rng.choice(vocabulary) for _ in range(rng.randint(8, 15))]
+            sentences.append(" ".join(words).capitalize() + ".")
+        title = " ".join(rng.sample(topic_words[topic], 3)).capitalize()
+        notes[f"note-{i:06d}"] = {"title": title, "content": f"{title}\n{' '.join(sentences)}", "label": f"Topic {topic}"}
+    return notes
+
+
+def synthetic_questions(notes, n, seed=0, words=4):
+    """Returns n questions made of a few words of randomly chosen notes."""
+    rng = random.Random(seed)
+    note_ids = sorted(notes)
+    questions = []
+    for _ in range(n):
+        tokens = tokenize(notes[rng.choice(note_ids)]["content"])
+        questions.append(" ".join(rng.sample(tokens, min(words, len(tokens)))))
+    return questions
+
+
+def synthetic_vectors(n, dimensions=1536, clusters=100, queries=100, seed=0):
+    """
+    Returns (vectors, queries): L2-normalized float32 vectors grouped around random cluster centres, like real
+    embeddings of a topical corpus, and query vectors made by perturbing random corpus vectors.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dimensions), dtype=np.float32)
+    vectors = np.empty((n, dimensions), dtype=np.float32)
+    # Generate in blocks to keep the temporary arrays small for large n
+    for start in range(0, n, 65536):
+        end = min(n, start + 65536)
+        assignment = rng.integers(0, clusters, end - start)
+        vectors[start:end] = centres[assignment] + 0.8 * rng.standard_normal((end - start, dimensions), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    picks = rng.integers(0, n, queries)
+    query_vectors = vectors[picks] + 0.05 * rng.standard_normal((queries, dimensions), dtype=np.float32)
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    return vectors, query_vectors
+
+
+def build_fixture_index(path, notes, embeddings):
+    """Splits the notes like build_index.py does and writes a local index (vectors, chunks and BM25) to path."""
+    from build_index import split_note
+    from local_vector_store import LocalVectorStore
+
+    chunks = []
+    ids = []
+    for note_id in sorted(notes):
+        note_chunks, note_ids = split_note(note_id, notes[note_id])
+        chunks.extend(note_chunks)
+        ids.extend(note_ids)
+    texts = [chunk.page_content for chunk in chunks]
+    LocalVectorStore.save(path, ids, texts, [chunk.metadata for chunk in chunks], embeddings.embed_documents(texts))
+    return len(ids)
+
+
+def latency_summary(seconds):
+    """Returns mean and p50/p95/p99 latencies (in milliseconds) of a list of durations (in seconds)."""
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if len(ms) == 0:
+        return {}
+    return {
+        "count": int(len(ms)),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+    }
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def write_results(path, results):
+    """Prints the results and, if a path is given, writes them as JSON for later comparison."""
+    print(json.dumps(results, indent=2))
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {path}.")
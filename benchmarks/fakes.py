@@ -0,0 +1,403 @@
+"""
+Filename: fakes.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Deterministic local stand-ins for the external services of the search graph, with the interfaces of
+Retriever, MainChain, EvalChain, JudgeChain and WebSearchTool (sync and async). Each one waits for a latency drawn from a configurable
+distribution instead of calling OpenAI, Azure AI Search or Tavily, so the graph and the API can be benchmarked offline.
+The calls are recorded in the metrics (metrics.py) like the ones of the real components, and the chains count their
+LLM calls and estimated prompt and completion tokens (usage) to compare the cost of graph modes.
+
+A latency is given as a spec string (milliseconds):
+- "50": fixed,
+- "uniform:20:80": uniform between 20 and 80,
+- "lognormal:50:0.5": log-normal with a median of 50 and sigma 0.5 (the long tail of real services),
+- "0": no wait.
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import asyncio
+import hashlib
+import random
+import time
+from contextlib import nullcontext
+from typing import Any, AsyncIterator, Iterator
+from langchain.prompts import PromptTemplate
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from bench_utils import HashingEmbeddings
+from llm_scheduler import EVALUATE, GENERATE
+from metrics import TokenCounter, timer
+
+
+def stable_fraction(text, salt=""):
+    """Returns a deterministic number in [0, 1) for a text."""
+    digest = hashlib.blake2b(f"{salt}\0{text}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") / 2 ** 64
+
+
+def estimate_tokens(question, documents):
+    """Estimates the prompt tokens of a chain call (about 4 characters per token)."""
+    text = question + " ".join(doc.page_content if isinstance(doc, Document) else str(doc) for doc in documents)
+    return len(text) // 4
+
+
+def new_usage():
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+
+def record_usage(usage, question, documents, completion_tokens):
+    usage["calls"] += 1
+    usage["prompt_tokens"] += estimate_tokens(question, documents)
+    usage["completion_tokens"] += completion_tokens
+
+
+class Latency:
+    """
+    A latency distribution parsed from a spec string (see the module description).
+
+    Args:
+        spec (str): The distribution spec, in milliseconds.
+        seed (int, optional): The seed of the random generator. Defaults to 0.
+
+    Methods:
+        sample() -> float: Returns a latency in seconds.
+        wait() / await await_(): Sleeps for a sampled latency.
+    """
+
+    def __init__(self, spec, seed=0):
+        self.spec = str(spec)
+        self.rng = random.Random(f"{seed}:{spec}")
+        kind, *params = self.spec.split(":")
+        if not params:
+            params, kind = [kind], "fixed"
+        self.kind = kind
+        self.params = [float(param) for param in params]
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Invalid latency spec: {spec}. Please use 'MS', 'uniform:LOW:HIGH' or 'lognormal:MEDIAN:SIGMA'.")
+
+    def sample(self):
+        if self.kind == "fixed":
+            ms = self.params[0]
+        elif self.kind == "uniform":
+            ms = self.rng.uniform(*self.params)
+        else:
+            median, sigma = self.params
+            ms = median * self.rng.lognormvariate(0.0, sigma)
+        return max(0.0, ms) / 1000
+
+    def wait(self):
+        seconds = self.sample()
+        if seconds:
+            time.sleep(seconds)
+
+    async def await_(self):
+        seconds = self.sample()
+        if seconds:
+            await asyncio.sleep(seconds)
+
+
+class FakeEmbeddings(HashingEmbeddings):
+    """HashingEmbeddings which wait for a latency per request, like a remote embedding model."""
+
+    def __init__(self, latency="0", dimensions=1536, seed=0):
+        super().__init__(dimensions=dimensions)
+        self.latency = Latency(latency, seed)
+
+    def _vectors(self, texts):
+        # HashingEmbeddings.embed_documents calls embed_query, which would wait for the latency again for every text
+        return [super(FakeEmbeddings, self).embed_query(text) for text in texts]
+
+    def embed_documents(self, texts):
+        self.latency.wait()
+        return self._vectors(texts)
+
+    def embed_query(self, text):
+        self.latency.wait()
+        return super().embed_query(text)
+
+    async def aembed_documents(self, texts):
+        await self.latency.await_()
+        return self._vectors(texts)
+
+    async def aembed_query(self, text):
+        await self.latency.await_()
+        return super().embed_query(text)
+
+
+class FakeRetriever:
+    """
+    A stand-in for Retriever: embeds the question with FakeEmbeddings and returns k deterministic documents
+    (with "score" and "similarity" metadata, and one of the labels if given) after the search latency.
+
+    Args:
+        embedding_latency (str, optional): The latency spec of an embedding request. Defaults to "0".
+        search_latency (str, optional): The latency spec of a search. Defaults to "0".
+        retrieved_documents (int, optional): The number of documents returned. Defaults to 3.
+        seed (int, optional): The seed of the latencies. Defaults to 0.
+    """
+
+    def __init__(self, embedding_latency="0", search_latency="0", retrieved_documents=3, seed=0):
+        self.embeddings = FakeEmbeddings(embedding_latency, seed=seed)
+        self.search_latency = Latency(search_latency, seed)
+        self.retrieved_documents = retrieved_documents
+
+    def labels(self):
+        return ["Benchmark"]
+
+    def _documents(self, question, labels=None):
+        label = labels[0] if labels else "Benchmark"
+        documents = []
+        for rank in range(self.retrieved_documents):
+            similarity = 0.7 + 0.25 * stable_fraction(question, f"similarity-{rank}")
+            documents.append(Document(
+                page_content=f"Note {rank} about {question}. " * 20,
+                metadata={"title": f"Note {rank}", "label": label, "note_id": f"note-{rank}",
+                          "score": similarity, "similarity": similarity},
+            ))
+        return documents
+
+    def retrieve(self, question, vector=None, labels=None):
+        if vector is None:
+            with timer("call", "embedding"):
+                self.embeddings.embed_query(question)
+        with timer("call", "search"):
+            self.search_latency.wait()
+            return self._documents(question, labels)
+
+    async def aretrieve(self, question, vector=None, labels=None):
+        if vector is None:
+            with timer("call", "embedding"):
+                await self.embeddings.aembed_query(question)
+        with timer("call", "search"):
+            await self.search_latency.await_()
+            return self._documents(question, labels)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    A chat model answering with a fixed number of words: it waits for the first token latency, then streams the words
+    with the token latency between them (invoke waits for the whole answer). It reports token usage like ChatOpenAI.
+    """
+
+    first_token_latency: Any
+    token_latency: Any
+    answer_words: int = 40
+
+    @property
+    def _llm_type(self):
+        return "fake-benchmark"
+
+    def _words(self, messages):
+        prompt = " ".join(str(message.content) for message in messages)
+        words = [f"word{int(stable_fraction(prompt, str(i)) * 1000)}" for i in range(self.answer_words)]
+        return prompt, words
+
+    def _usage(self, prompt, words):
+        prompt_tokens = len(prompt) // 4
+        return {"input_tokens": prompt_tokens, "output_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+
+    def _answer_seconds(self, words):
+        # Without streaming the answer arrives at once, after all the tokens were generated
+        return self.first_token_latency.sample() + sum(self.token_latency.sample() for _ in words[1:])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt, words = self._words(messages)
+        time.sleep(self._answer_seconds(words))
+        message = AIMessage(content=" ".join(words), usage_metadata=self._usage(prompt, words))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt, words = self._words(messages)
+        await asyncio.sleep(self._answer_seconds(words))
+        message = AIMessage(content=" ".join(words), usage_metadata=self._usage(prompt, words))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        prompt, words = self._words(messages)
+        self.first_token_latency.wait()
+        for i, word in enumerate(words):
+            if i:
+                self.token_latency.wait()
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else f" {word}"))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(prompt, words)))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        prompt, words = self._words(messages)
+        await self.first_token_latency.await_()
+        for i, word in enumerate(words):
+            if i:
+                await self.token_latency.await_()
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else f" {word}"))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(prompt, words)))
+
+
+class FakeMainChain:
+    """
+    A stand-in for MainChain: the same prompt, followed by FakeChatModel, so the answers stream token by token.
+
+    Args:
+        first_token_latency (str, optional): The latency spec of the first token. Defaults to "0".
+        token_latency (str, optional): The latency spec between tokens. Defaults to "0".
+        answer_words (int, optional): The number of words of an answer. Defaults to 40.
+        context_packer (ContextPacker, optional): Packs the documents like in MainChain. Defaults to None.
+        scheduler (LLMScheduler, optional): Schedules the async calls like in MainChain. Defaults to None.
+        seed (int, optional): The seed of the latencies. Defaults to 0.
+    """
+
+    def __init__(self, first_token_latency="0", token_latency="0", answer_words=40, context_packer=None, scheduler=None, seed=0):
+        self.context_packer = context_packer
+        self.scheduler = scheduler
+        self.answer_words = answer_words
+        self.usage = new_usage()
+        self.prompt = PromptTemplate(template="Question: {question}\nDocuments: {documents}\nAnswer:", input_variables=["question", "documents"])
+        self.llm = FakeChatModel(
+            first_token_latency=Latency(first_token_latency, seed),
+            token_latency=Latency(token_latency, seed),
+            answer_words=answer_words,
+            callbacks=[TokenCounter("generate")],
+        )
+        self.chain = self.prompt | self.llm | StrOutputParser()
+
+    def _context(self, documents):
+        return self.context_packer.pack(documents) if self.context_packer is not None else documents
+
+    def _slot(self):
+        return self.scheduler.slot(GENERATE, "generate") if self.scheduler is not None else nullcontext()
+
+    def generate(self, question, documents):
+        context = self._context(documents)
+        record_usage(self.usage, question, documents, self.answer_words)
+        with timer("call", "llm_generate"):
+            return self.chain.invoke({"documents": context, "question": question})
+
+    async def agenerate(self, question, documents):
+        context = self._context(documents)
+        record_usage(self.usage, question, documents, self.answer_words)
+        async with self._slot():
+            with timer("call", "llm_generate"):
+                return await self.chain.ainvoke({"documents": context, "question": question})
+
+
+class FakeEvalChain:
+    """
+    A stand-in for EvalChain: after the latency, the documents of a question are sufficient for a deterministic
+    sufficient_rate share of the questions.
+
+    Args:
+        latency (str, optional): The latency spec of an evaluation. Defaults to "0".
+        sufficient_rate (float, optional): The share of questions answered from the notes. Defaults to 0.7.
+        scheduler (LLMScheduler, optional): Schedules the async calls like in EvalChain. Defaults to None.
+        seed (int, optional): The seed of the latencies. Defaults to 0.
+    """
+
+    def __init__(self, latency="0", sufficient_rate=0.7, scheduler=None, seed=0):
+        self.latency = Latency(latency, seed)
+        self.sufficient_rate = sufficient_rate
+        self.scheduler = scheduler
+        self.usage = new_usage()
+
+    def _evaluation(self, question):
+        return {"Evaluation": "yes" if stable_fraction(question, "evaluation") < self.sufficient_rate else "no"}
+
+    def evaluate(self, question, documents):
+        record_usage(self.usage, question, documents, 5)
+        with timer("call", "llm_evaluate"):
+            self.latency.wait()
+            return self._evaluation(question)
+
+    async def aevaluate(self, question, documents):
+        record_usage(self.usage, question, documents, 5)
+        async with self.scheduler.slot(EVALUATE, "evaluate") if self.scheduler is not None else nullcontext():
+            with timer("call", "llm_evaluate"):
+                await self.latency.await_()
+                return self._evaluation(question)
+
+
+class FakeJudgeChain:
+    """
+    A stand-in for JudgeChain: the verdict takes the evaluation latency (the same prompt and documents are processed)
+    and, for sufficient documents, the answer follows with the token latency between its words. The verdicts are those
+    of FakeEvalChain with the same sufficient_rate.
+
+    Args:
+        latency (str, optional): The latency spec of the verdict. Defaults to "0".
+        token_latency (str, optional): The latency spec between the tokens of the answer. Defaults to "0".
+        answer_words (int, optional): The number of words of an answer. Defaults to 40.
+        sufficient_rate (float, optional): The share of questions answered from the notes. Defaults to 0.7.
+        scheduler (LLMScheduler, optional): Schedules the async calls like in JudgeChain. Defaults to None.
+        seed (int, optional): The seed of the latencies. Defaults to 0.
+    """
+
+    def __init__(self, latency="0", token_latency="0", answer_words=40, sufficient_rate=0.7, scheduler=None, seed=0):
+        self.latency = Latency(latency, seed)
+        self.token_latency = Latency(token_latency, seed)
+        self.answer_words = answer_words
+        self.sufficient_rate = sufficient_rate
+        self.scheduler = scheduler
+        self.usage = new_usage()
+
+    def _verdict(self, question, documents):
+        """Returns (verdict, seconds of the call)."""
+        seconds = self.latency.sample()
+        if stable_fraction(question, "evaluation") >= self.sufficient_rate:
+            record_usage(self.usage, question, documents, 5)
+            return {"Evaluation": "no", "Answer": ""}, seconds
+        record_usage(self.usage, question, documents, 5 + self.answer_words)
+        seconds += sum(self.token_latency.sample() for _ in range(self.answer_words))
+        answer = " ".join(f"word{int(stable_fraction(question, str(i)) * 1000)}" for i in range(self.answer_words))
+        return {"Evaluation": "yes", "Answer": answer}, seconds
+
+    def judge(self, question, documents):
+        with timer("call", "llm_judge"):
+            verdict, seconds = self._verdict(question, documents)
+            time.sleep(seconds)
+            return verdict
+
+    async def ajudge(self, question, documents):
+        async with self.scheduler.slot(GENERATE, "judge") if self.scheduler is not None else nullcontext():
+            with timer("call", "llm_judge"):
+                verdict, seconds = self._verdict(question, documents)
+                await asyncio.sleep(seconds)
+                return verdict
+
+
+class FakeWebSearchTool:
+    """
+    A stand-in for WebSearchTool: returns max_results results in the format of Tavily after the latency.
+
+    Args:
+        latency (str, optional): The latency spec of a search. Defaults to "0".
+        max_results (int, optional): The number of results. Defaults to 3.
+        seed (int, optional): The seed of the latencies. Defaults to 0.
+    """
+
+    def __init__(self, latency="0", max_results=3, seed=0):
+        self.latency = Latency(latency, seed)
+        self.max_results = max_results
+
+    def _results(self, query):
+        return [{"url": f"https://example.com/{i}", "content": f"Web result {i} about {query}. " * 10} for i in range(self.max_results)]
+
+    def search(self, query):
+        with timer("call", "web_search"):
+            self.latency.wait()
+            return self._results(query)
+
+    async def asearch(self, query):
+        with timer("call", "web_search"):
+            await self.latency.await_()
+            return self._results(query)
@@ -0,0 +1,88 @@
+"""
+Filename: load_test.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Load test of the search notes API. For every concurrency level it keeps that many questions in flight
+against the /answer endpoint and reports throughput and latency percentiles, which shows how far a single server
+(or a single worker) scales with concurrent requests.
+
+Start the API first (e.g. python search-index/search_notes.py --mode api-mode-local), then:
+python benchmarks/load_test.py --url http://localhost:8000 --concurrency 1 4 16 64 --requests 128 --output load.json
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import httpx
+from bench_utils import latency_summary, write_results
+
+default_questions = [
+    "What is a generator function?",
+    "What is LangSmith?",
+    "How do I create a virtual environment in Python?",
+    "What is the difference between a list and a tuple?",
+]
+
+
+async def run_level(client, url, questions, concurrency, requests):
+    """Sends the requests with at most concurrency of them in flight. Returns (wall seconds, latencies, errors)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def ask(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, json={"question": questions[i % len(questions)]})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[ask(i) for i in range(requests)])
+    return time.perf_counter() - start, latencies, errors
+
+
+async def main(args):
+    questions = default_questions
+    if args.questions_file:
+        with open(args.questions_file, "r", encoding="utf-8") as f:
+            questions = [json.loads(line)["question"] for line in f if line.strip()]
+
+    url = f"{args.url.rstrip('/')}{args.endpoint}"
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    results = {"url": url, "requests": args.requests, "levels": []}
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for concurrency in args.concurrency:
+            seconds, latencies, errors = await run_level(client, url, questions, concurrency, args.requests)
+            results["levels"].append({
+                "concurrency": concurrency,
+                "requests_per_second": round(len(latencies) / seconds, 2),
+                "errors": errors,
+                "latency": latency_summary(latencies),
+            })
+            print(f"Concurrency {concurrency}: {len(latencies) / seconds:.2f} requests/s, {errors} errors")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the search notes API at increasing concurrency")
+    parser.add_argument('--url', type=str, default='http://localhost:8000', help="Base URL of the API")
+    parser.add_argument('--endpoint', type=str, default='/answer')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64], help="Numbers of requests in flight")
+    parser.add_argument('--requests', type=int, default=128, help="Number of requests per concurrency level")
+    parser.add_argument('--questions-file', type=str, help="JSONL file with {\"question\": ...} lines")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Request timeout in seconds")
+    parser.add_argument('--output', type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    write_results(args.output, asyncio.run(main(args)))
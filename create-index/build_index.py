@@ -5,106 +5,222 @@ Author: Szymon Manduk
 
 Company: Szymon Manduk AI, manduk.ai
 
-Description: This script reads documents from a directory, splits them into chunks, and adds them to the Azure Search index.
+Description: This script reads the notes (the packed corpus written by notes_to_json.py, or a directory of json files),
+splits them into chunks, and adds them to the Azure Search index.
+Chunks get deterministic IDs and the uploaded notes are recorded in a manifest (see index_manifest.py).
+With --incremental only new or edited notes are split, embedded and uploaded, and chunks of removed or edited notes are deleted.
+With --target local (or both) the script also writes a local index (see search-index/local_vector_store.py), which can be used instead of Azure AI Search.
+
+Example: python create-index/build_index.py --incremental
+Example: python create-index/build_index.py --target local --local-index data/local_index
 
 Copyright (c) 2024 Szymon Manduk AI.
 """
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
-import json
+import argparse
 import os
+import sys
 from dotenv import load_dotenv, find_dotenv
 from langchain_community.vectorstores.azuresearch import AzureSearch
 from langchain_openai import OpenAIEmbeddings
-from uuid import uuid4
 from index_fields import fields
+from index_manifest import note_hash, chunk_ids, index_key, load_manifest, save_manifest, diff_notes, write_index_version
+from embedding_pipeline import EmbeddingPipeline
+
+# The embedding cache is shared with the search API, so it lives in the search-index directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search-index'))
+from embedding_cache import CachedEmbeddings
+from local_vector_store import LocalVectorStore
+from corpus_store import load_notes
 
 # Load the environment variables
 _ = load_dotenv(find_dotenv(filename='.env'))
 
 directory = 'data/Notes/json'
+corpus_path = 'data/Notes/notes.jsonl'
+manifest_path = 'data/Notes/index_manifest.json'
+checkpoint_path = 'data/Notes/index_checkpoint.txt'
+local_index_path = 'data/local_index'
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH", 'data/embedding_cache.sqlite')
+index_version_path = os.getenv("INDEX_VERSION_PATH", 'data/index_version.txt')  # watched by the answer cache of the search API
 
 # OpenAI API data (for embeddings)
 openai_api_key = os.getenv("OPENAI_API_KEY")
 openai_api_version = "2023-05-15"
 model = "text-embedding-ada-002"
 
-# Initialize the embeddings
-embeddings = OpenAIEmbeddings(
-    openai_api_key=openai_api_key, 
-    openai_api_version=openai_api_version, 
-    model=model
-)
-embedding_function = embeddings.embed_query
-
 # Azure AI Search data (for vector store)
-vector_store_address = os.getenv("AZURESEARCH_ENDPOINT") 
+vector_store_address = os.getenv("AZURESEARCH_ENDPOINT")
 vector_store_password = os.getenv("AZURESEARCH_ADMIN_KEY")
 vector_store_index = os.getenv("AZURESEARCH_INDEX_NAME")
 
-# Initialize the vector store
-vector_store = AzureSearch(
-    azure_search_endpoint=vector_store_address,
-    azure_search_key=vector_store_password,
-    index_name=vector_store_index,
-    embedding_function=embedding_function,
-    fields=fields,
-)
-
-# for each json file in the directory we append the content to the documents list
-documents = []
-for file in os.listdir(directory):
-    # if the file is not a json file we skip it
-    if not file.endswith(".json"):
-        continue
-
-    # Load and parse the json file
-    with open(directory + "/" + file, "r", encoding="utf-8") as file:
-        data = json.load(file)
-        documents.append(Document(page_content=data["content"], metadata={"title": data["title"], "label": data["label"]}))
-
-print(f"Read {len(documents)} documents from the file.")
-
-# Sort the documents by length in ascending order
-sorted_documents = sorted(documents, key=lambda doc: len(doc.page_content))
-
-# # Print few shortest documents
-# for i in range(8):
-#     print(sorted_documents[i])
-#     #print(f"Document {i+1} (length {len(sorted_documents[i].page_content)}): {sorted_documents[i].page_content} - {sorted_documents[i].metadata}")
-
-# Generate a unique ID for the split
-def generate_id():
-    return str(uuid4())
-
 # Create text splitter
 text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=500, 
+    chunk_size=500,
     chunk_overlap=100,
     separators=["\n\n", ".", "!", "?", "\n"],
-    # add_start_index=True,  # Optionally - it adds the starting position for each chunk within the split (0 for the first chunk) 
+    add_start_index=True,  # adds the starting position of each chunk in the note, used to merge adjacent chunks in the prompt context
 )
 
-# Split the documents
-split_docs = text_splitter.split_documents(documents)
-print(f"Split the documents into {len(split_docs)} chunks.")
-
-# Let's add IDs for each chunk ina separate list
-ids = [generate_id() for split in split_docs]
-
-# Print the content of the first few chunks
-for i in range(10):
-    print(f"Content for [{i}]: {split_docs[i]}")
-    print(f"ID for [{i}]: {ids[i]}\n\n")
-
-# Ask a user if they want to build the index
-create_index = input("Do you want to build the index? (y/n): ")
-if create_index.lower() != "y":
-    print("Index build aborted.")
-    exit()
-
-# Add documents to the vector store
-results = vector_store.add_documents(documents=split_docs, ids=ids)
 
-print(results[:5])
+def create_embeddings():
+    """Returns the embeddings model wrapped with the on-disk cache, so re-chunking or rebuilding the index re-embeds only new texts."""
+    embeddings = OpenAIEmbeddings(
+        openai_api_key=openai_api_key,
+        openai_api_version=openai_api_version,
+        model=model
+    )
+    return CachedEmbeddings(embeddings, model, embedding_cache_path)
+
+
+def create_vector_store(embedding_function):
+    return AzureSearch(
+        azure_search_endpoint=vector_store_address,
+        azure_search_key=vector_store_password,
+        index_name=vector_store_index,
+        embedding_function=embedding_function,
+        fields=fields,
+    )
+
+
+def split_note(note_id, data):
+    """Splits a note into chunks. Returns (chunks, ids), the chunk ID is also stored in the chunk metadata."""
+    document = Document(page_content=data["content"], metadata={"title": data["title"], "label": data["label"], "note_id": note_id})
+    chunks = text_splitter.split_documents([document])
+    ids = chunk_ids(note_id, [chunk.page_content for chunk in chunks])
+    for chunk, cid in zip(chunks, ids):
+        chunk.metadata["chunk_id"] = cid
+    return chunks, ids
+
+
+def update_manifest(manifest, new_entries, removed):
+    for note_id in removed:
+        del manifest["notes"][note_id]
+    manifest["notes"].update(new_entries)
+    save_manifest(manifest_path, manifest)
+    print(f"Manifest saved to {manifest_path}.")
+
+
+def update_azure_index(notes, embeddings, args):
+    """Uploads new/changed chunks to the Azure Search index, deletes stale ones and updates the manifest."""
+    # Compare the notes with the manifest. In the full mode every note is uploaded again,
+    # but the manifest is still used to delete chunks that no longer exist.
+    hashes = {note_id: note_hash(data) for note_id, data in notes.items()}
+    manifest = load_manifest(manifest_path, vector_store_index)
+    changed, removed = diff_notes(manifest, hashes)
+    if not args.incremental:
+        changed = list(notes)
+    print(f"{len(changed)} notes to upload, {len(removed)} notes removed since the last build.")
+
+    # Split the changed notes. Every chunk of a changed note is uploaded again, as a chunk with an unchanged text (and ID)
+    # may still have a new title, label or start position; the embedding cache spares re-embedding it.
+    # The IDs only tell which chunks of the previous version are stale.
+    split_docs = []
+    ids = []
+    stale_ids = []
+    new_entries = {}
+    for note_id in changed:
+        chunks, note_chunk_ids = split_note(note_id, notes[note_id])
+        indexed_ids = set(manifest["notes"].get(note_id, {}).get("chunks", []))
+        split_docs.extend(chunks)
+        ids.extend(note_chunk_ids)
+        stale_ids.extend(indexed_ids - set(note_chunk_ids))
+        new_entries[note_id] = {"hash": hashes[note_id], "chunks": note_chunk_ids}
+    for note_id in removed:
+        stale_ids.extend(manifest["notes"][note_id]["chunks"])
+
+    print(f"Split the documents into {len(split_docs)} chunks to upload, {len(stale_ids)} chunks to delete.")
+
+    # Print the content of the first few chunks
+    for i in range(min(10, len(split_docs))):
+        print(f"Content for [{i}]: {split_docs[i]}")
+        print(f"ID for [{i}]: {ids[i]}\n\n")
+
+    if not split_docs and not stale_ids:
+        # Notes without chunks (e.g. emptied) are still recorded, so they are not reported as changed again
+        if new_entries or removed:
+            update_manifest(manifest, new_entries, removed)
+        print("Index is up to date.")
+        return
+
+    # Ask a user if they want to build the index
+    create_index = input("Do you want to build the index? (y/n): ")
+    if create_index.lower() != "y":
+        print("Index build aborted.")
+        return
+
+    vector_store = create_vector_store(embeddings.embed_query)
+
+    # Embed and add chunks to the vector store under their deterministic IDs (uploading an existing ID overwrites it).
+    # Uploaded IDs are checkpointed, so if the build is interrupted, running it again resumes where it stopped.
+    pipeline = EmbeddingPipeline(
+        embeddings,
+        vector_store,
+        batch_size=args.batch_size,
+        upload_batch_size=args.upload_batch_size,
+        max_concurrency=args.concurrency,
+        checkpoint_path=checkpoint_path,
+    )
+    if split_docs:
+        stats = pipeline.run(split_docs, ids)
+        print(f"Uploaded {stats['chunks']} chunks in {stats['seconds']}s ({stats['chunks_per_second']} chunks/s). "
+              f"API calls: {embeddings.calls} embedding ({stats['embedding_calls']} batches, the rest served from the cache), "
+              f"{stats['upload_calls']} upload, {stats['retries']} retries.")
+
+    # Delete chunks of removed or edited notes
+    if stale_ids:
+        vector_store.delete(ids=[index_key(cid) for cid in stale_ids])
+        print(f"Deleted {len(stale_ids)} stale chunks.")
+
+    # Record the uploaded notes
+    update_manifest(manifest, new_entries, removed)
+    pipeline.clear_checkpoint()
+    write_index_version(index_version_path)
+
+
+def build_local_index(notes, embeddings, args):
+    """
+    Writes the local index with all chunks of all notes. Vectors of chunks embedded before
+    (e.g. uploaded to Azure or written to a previous local index) come from the embedding cache.
+    """
+    split_docs = []
+    ids = []
+    for note_id in sorted(notes):
+        chunks, note_chunk_ids = split_note(note_id, notes[note_id])
+        split_docs.extend(chunks)
+        ids.extend(note_chunk_ids)
+
+    pipeline = EmbeddingPipeline(embeddings, None, batch_size=args.batch_size, max_concurrency=args.concurrency)
+    vectors = pipeline.embed([doc.page_content for doc in split_docs])
+    LocalVectorStore.save(args.local_index, ids, [doc.page_content for doc in split_docs], [doc.metadata for doc in split_docs], vectors, ann_lists=args.ann_lists)
+    write_index_version(index_version_path)
+    print(f"Local index with {len(ids)} chunks saved to {args.local_index}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split the notes into chunks and add them to the Azure Search index")
+    parser.add_argument('--incremental', action='store_true', help="Upload only new or edited notes (according to the manifest)")
+    parser.add_argument('--batch-size', type=int, default=100, help="Number of chunks embedded in one request")
+    parser.add_argument('--upload-batch-size', type=int, default=500, help="Number of chunks uploaded to the index in one request")
+    parser.add_argument('--concurrency', type=int, default=4, help="Number of batches processed at the same time")
+    parser.add_argument('--target', type=str, default='azure', choices=['azure', 'local', 'both'], help="Index to build: Azure AI Search, local index or both")
+    parser.add_argument('--local-index', type=str, default=local_index_path, help="Directory of the local index")
+    parser.add_argument('--notes', type=str, help=f"Packed corpus file or directory of json notes (defaults to {corpus_path} if it exists, otherwise {directory})")
+    parser.add_argument('--ann-lists', type=int, default=0, help="Number of IVF lists of the local ANN index (about sqrt(chunks) is a good start, 0 = no ANN index)")
+    args = parser.parse_args()
+
+    # Read the notes from the packed corpus or the directory of json files
+    notes_path = args.notes or (corpus_path if os.path.exists(corpus_path) else directory)
+    notes = load_notes(notes_path)
+    print(f"Read {len(notes)} documents from {notes_path}.")
+
+    embeddings = create_embeddings()
+
+    if args.target in ('azure', 'both'):
+        update_azure_index(notes, embeddings, args)
+    if args.target in ('local', 'both'):
+        build_local_index(notes, embeddings, args)
+
+    print(f"Embedding cache: {embeddings.stats()}")
@@ -0,0 +1,171 @@
+"""
+Filename: embedding_pipeline.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines a class that embeds chunks in batches and uploads them to the Azure Search index.
+Several batches run concurrently, rate-limited calls are retried with backoff, and uploaded chunk IDs are checkpointed
+so an interrupted build resumes where it stopped.
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# HTTP statuses worth retrying: rate limiting and temporary unavailability
+retry_statuses = (429, 503)
+
+
+def is_rate_limited(error):
+    """Checks if an exception raised by the OpenAI or Azure SDK means we were throttled."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status in retry_statuses or type(error).__name__ == "RateLimitError"
+
+
+def retry_after(error):
+    """Returns the delay (in seconds) requested by the server in the Retry-After header, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def load_checkpoint(path):
+    """Returns the set of chunk IDs already uploaded by a previous (interrupted) run."""
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path, "r", encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+class EmbeddingPipeline:
+    """
+    A class that embeds chunks with embed_documents and uploads them to the vector store in bulk.
+
+    Args:
+        embeddings (Embeddings): The embeddings model (may be wrapped with CachedEmbeddings).
+        vector_store (AzureSearch): The vector store the chunks are uploaded to. Can be None if only embed() is used.
+        batch_size (int, optional): The number of chunks embedded in one request. Defaults to 100.
+        upload_batch_size (int, optional): The number of chunks uploaded in one request. Defaults to 500.
+        max_concurrency (int, optional): The number of upload batches processed at the same time. Defaults to 4.
+        max_retries (int, optional): How many times a throttled request is retried. Defaults to 8.
+        checkpoint_path (str, optional): The file in which uploaded chunk IDs are recorded. Defaults to None (no checkpoint).
+
+    Methods:
+        run(chunks, ids) -> dict: Embeds and uploads the chunks which are not in the checkpoint yet. Returns run statistics.
+        embed(texts) -> List[List[float]]: Embeds the texts in concurrent batches, without uploading them.
+        embed_batch(texts) -> List[List[float]]: Embeds the texts in sequential batches of batch_size in the calling thread.
+        upload(chunks, ids, vectors): Uploads embedded chunks to the vector store in the calling thread.
+    """
+
+    def __init__(self, embeddings, vector_store, batch_size=100, upload_batch_size=500, max_concurrency=4, max_retries=8, checkpoint_path=None):
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self.batch_size = batch_size
+        self.upload_batch_size = upload_batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.checkpoint_path = checkpoint_path
+        self.embedding_calls = 0
+        self.upload_calls = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _call(self, counter, func, *args, **kwargs):
+        """Calls func, retrying with exponential backoff (or the server's Retry-After) when throttled."""
+        for attempt in range(self.max_retries + 1):
+            self._count(counter)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == self.max_retries:
+                    raise
+                delay = retry_after(e) or min(60, 2 ** attempt) * (0.5 + random.random())
+                self._count("retries")
+                print(f"Throttled ({type(e).__name__}), retrying in {delay:.1f}s.")
+                time.sleep(delay)
+
+    def embed_batch(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._call("embedding_calls", self.embeddings.embed_documents, texts[start:start + self.batch_size]))
+        return vectors
+
+    def upload(self, chunks, ids, vectors):
+        self._call(
+            "upload_calls",
+            self.vector_store.add_embeddings,
+            list(zip([chunk.page_content for chunk in chunks], vectors)),
+            [chunk.metadata for chunk in chunks],
+            keys=ids,
+        )
+
+    def _process(self, chunks, ids):
+        """Embeds one upload batch (in embedding batches) and uploads it."""
+        self.upload(chunks, ids, self.embed_batch([chunk.page_content for chunk in chunks]))
+        return ids
+
+    def run(self, chunks, ids):
+        done = load_checkpoint(self.checkpoint_path)
+        pending = [(chunk, cid) for chunk, cid in zip(chunks, ids) if cid not in done]
+        if done:
+            print(f"Resuming from checkpoint: {len(chunks) - len(pending)} chunks already uploaded.")
+
+        batches = [pending[start:start + self.upload_batch_size] for start in range(0, len(pending), self.upload_batch_size)]
+        uploaded = 0
+        start_time = time.perf_counter()
+        checkpoint = open(self.checkpoint_path, "a", encoding="utf-8") if self.checkpoint_path else None
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            futures = [
+                executor.submit(self._process, [chunk for chunk, _ in batch], [cid for _, cid in batch])
+                for batch in batches
+            ]
+            for future in as_completed(futures):
+                batch_ids = future.result()
+                # Only the main thread writes the checkpoint, after the batch is safely in the index
+                if checkpoint:
+                    checkpoint.write("".join(f"{cid}\n" for cid in batch_ids))
+                    checkpoint.flush()
+                uploaded += len(batch_ids)
+                print(f"Uploaded {uploaded}/{len(pending)} chunks.")
+        finally:
+            # On failure do not start the remaining batches - the checkpoint keeps what was done
+            executor.shutdown(cancel_futures=True)
+            if checkpoint:
+                checkpoint.close()
+
+        elapsed = time.perf_counter() - start_time
+        return {
+            "chunks": uploaded,
+            "seconds": round(elapsed, 2),
+            "chunks_per_second": round(uploaded / elapsed, 1) if elapsed > 0 else 0.0,
+            "embedding_calls": self.embedding_calls,
+            "upload_calls": self.upload_calls,
+            "retries": self.retries,
+        }
+
+    def embed(self, texts):
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            return [vector for vectors in executor.map(self.embed_batch, batches) for vector in vectors]
+
+    def clear_checkpoint(self):
+        """Removes the checkpoint once the whole build has completed."""
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
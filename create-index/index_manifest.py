@@ -0,0 +1,98 @@
+"""
+Filename: index_manifest.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Manifest of the notes already uploaded to the search index. For every note it keeps a hash of the note content
+and the IDs of its chunks, so that build_index.py can upload only new/changed chunks and delete chunks of removed or edited notes.
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import uuid
+
+manifest_version = 1
+
+
+def note_hash(data):
+    """Returns a hash of the note fields that end up in the index."""
+    payload = json.dumps([data["title"], data["content"], data["label"]], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def chunk_ids(note_id, texts):
+    """
+    Returns deterministic IDs for the chunks of a note. An ID depends on the note and the chunk text only (not on its position),
+    so editing one paragraph keeps the IDs of the untouched chunks and only the chunks of the previous version with no
+    counterpart are deleted as stale. Repeated texts within a note get an occurrence number.
+    """
+    seen = {}
+    ids = []
+    for text in texts:
+        occurrence = seen.get(text, 0)
+        seen[text] = occurrence + 1
+        key = f"{note_id}\0{text}\0{occurrence}"
+        ids.append(hashlib.sha256(key.encode("utf-8")).hexdigest()[:40])
+    return ids
+
+
+def index_key(chunk_id):
+    """Returns the key under which AzureSearch stores a chunk (it base64-encodes the keys passed to add_texts)."""
+    return base64.urlsafe_b64encode(chunk_id.encode("utf-8")).decode("ascii")
+
+
+def empty_manifest(index_name):
+    return {"version": manifest_version, "index_name": index_name, "notes": {}}
+
+
+def load_manifest(path, index_name):
+    """Loads the manifest. Returns an empty one if the file does not exist or was written for a different index."""
+    if not os.path.exists(path):
+        return empty_manifest(index_name)
+
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    if manifest.get("version") != manifest_version or manifest.get("index_name") != index_name:
+        print(f"Manifest {path} was created for a different index or version - ignoring it.")
+        return empty_manifest(index_name)
+    return manifest
+
+
+def save_manifest(path, manifest):
+    """Saves the manifest atomically, so an interrupted write never corrupts the previous one."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def write_index_version(path):
+    """
+    Writes a new version stamp of the index. The search API watches it and clears its answer cache when it changes,
+    as the cached answers were generated from the previous index.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(uuid.uuid4().hex)
+    os.replace(tmp_path, path)
+
+
+def diff_notes(manifest, hashes):
+    """
+    Compares the manifest with the current note hashes ({note_id: hash}).
+    Returns (changed, removed): IDs of new or edited notes and IDs of notes that no longer exist.
+    """
+    indexed = manifest["notes"]
+    changed = [note_id for note_id, h in hashes.items() if note_id not in indexed or indexed[note_id]["hash"] != h]
+    removed = [note_id for note_id in indexed if note_id not in hashes]
+    return changed, removed
@@ -0,0 +1,431 @@
+"""
+Filename: ingest_pipeline.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Streaming ingestion of a Google Keep export, from the HTML files straight to the index, in one pass:
+parse -> filter -> chunk -> embed -> upload. Every stage runs in its own thread (the embedding stage in --concurrency
+threads, the parsing in --workers processes) and the stages are connected by bounded queues, so they overlap in time
+and only a few batches of notes are in memory at once, whatever the size of the export. No JSON files are written.
+
+It builds the same index as notes_to_json.py followed by build_index.py: the same chunks, chunk IDs, manifest,
+checkpoint and embedding cache, so the two ways can be mixed (e.g. a later build_index.py --incremental).
+The local index (--target local) is collected in memory, as LocalVectorStore writes and loads it whole.
+
+Example: python create-index/ingest_pipeline.py --incremental --workers 4
+Example: python create-index/ingest_pipeline.py --target local --local-index data/local_index
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import argparse
+import os
+import queue
+import resource
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from notes_to_json import parse_note, input_directory
+from build_index import (split_note, create_embeddings, create_vector_store, manifest_path, checkpoint_path,
+                         local_index_path, index_version_path, vector_store_index)
+from index_manifest import note_hash, index_key, load_manifest, save_manifest, write_index_version
+from embedding_pipeline import EmbeddingPipeline, load_checkpoint
+from local_vector_store import LocalVectorStore
+
+# Marks the end of the stream in a queue
+end_of_stream = object()
+
+
+class _Stopped(Exception):
+    """Raised in a stage when another stage has failed, to stop it without waiting for its queues."""
+
+
+def iter_html_files(directory):
+    """Yields the paths of the HTML files in the directory, without listing them all first."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.html') and entry.is_file():
+                yield entry.path
+
+
+def parse_notes(files, workers):
+    """
+    Yields parse_note results (file, data, error) in the order of the files. With several workers at most
+    4 files per worker are parsed ahead, so neither the file list nor the parsed notes pile up.
+    """
+    if workers <= 1:
+        yield from map(parse_note, files)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for file in files:
+            pending.append(executor.submit(parse_note, file))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class LocalIndexWriter:
+    """
+    A class collecting embedded chunks for the local index. It has the add_embeddings method of AzureSearch,
+    so the upload stage treats both targets the same.
+
+    Args:
+        path (str): The directory of the local index.
+        ann_lists (int, optional): The number of IVF lists of the ANN index. Defaults to 0 (no ANN index).
+
+    Methods:
+        add_embeddings(text_embeddings, metadatas, keys): Adds the (text, vector) pairs.
+        save(): Writes the local index (see LocalVectorStore.save).
+    """
+
+    def __init__(self, path, ann_lists=0):
+        self.path = path
+        self.ann_lists = ann_lists
+        self.ids = []
+        self.texts = []
+        self.metadatas = []
+        self.vectors = []
+
+    def add_embeddings(self, text_embeddings, metadatas, keys):
+        self.texts.extend(text for text, _ in text_embeddings)
+        self.vectors.append(np.asarray([vector for _, vector in text_embeddings], dtype=np.float32))
+        self.metadatas.extend(metadatas)
+        self.ids.extend(keys)
+
+    def save(self):
+        vectors = np.concatenate(self.vectors) if self.vectors else np.empty((0, 0), dtype=np.float32)
+        LocalVectorStore.save(self.path, self.ids, self.texts, self.metadatas, vectors, ann_lists=self.ann_lists)
+
+
+class IngestPipeline:
+    """
+    A class streaming the notes of an HTML export through the parse, filter, chunk, embed and upload stages.
+
+    Args:
+        embeddings (Embeddings): The embeddings model (may be wrapped with CachedEmbeddings).
+        vector_store (AzureSearch or LocalIndexWriter): The store the chunks are uploaded to.
+        manifest (dict, optional): The manifest of the index (see index_manifest.py), updated as notes are uploaded.
+            Defaults to None (no manifest, every chunk is uploaded and nothing is deleted).
+        incremental (bool, optional): Skip the notes and chunks the manifest says are indexed already. Defaults to False.
+        workers (int, optional): The number of processes parsing the HTML files. Defaults to 1 (parse in a thread).
+        batch_size (int, optional): The number of chunks embedded in one request. Defaults to 100.
+        upload_batch_size (int, optional): The number of chunks uploaded in one request. Defaults to 500.
+        concurrency (int, optional): The number of embedding threads. Defaults to 4.
+        queue_size (int, optional): The capacity of the queues between the stages (in notes or batches). Defaults to 8.
+        checkpoint_path (str, optional): The file in which uploaded chunk IDs are recorded. Defaults to None (no checkpoint).
+
+    Attributes:
+        removed (list): The IDs of the manifest notes which are not in the export any more (known after run).
+        stale_ids (list): The chunk IDs of edited and removed notes, to be deleted (known after run).
+
+    Methods:
+        run(files) -> dict: Ingests the HTML files. Returns the statistics of the run and of every stage.
+        delete_stale(): Deletes the chunks of edited and removed notes from the vector store and from the manifest.
+    """
+
+    def __init__(self, embeddings, vector_store, manifest=None, incremental=False, workers=1, batch_size=100,
+                 upload_batch_size=500, concurrency=4, queue_size=8, checkpoint_path=None):
+        self.vector_store = vector_store
+        self.manifest = manifest
+        self.incremental = incremental
+        self.workers = workers
+        self.batch_size = batch_size
+        self.upload_batch_size = upload_batch_size
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.checkpoint_path = checkpoint_path
+        # Embedding and upload calls with retries on throttling
+        self.calls = EmbeddingPipeline(embeddings, vector_store, batch_size=batch_size, checkpoint_path=checkpoint_path)
+
+        self.indexed = dict(manifest["notes"]) if manifest is not None else {}
+        self.pending = {}  # note_id -> [manifest entry, chunks not uploaded yet]
+        self.seen = set()
+        self.removed = []
+        self.stale_ids = []
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+        self.errors = []
+        self.counts = {"files": 0, "notes": 0, "too_short": 0, "parse_errors": 0, "unchanged": 0,
+                       "chunks": 0, "resumed": 0, "embedded": 0, "uploaded": 0}
+        self.stages = {}
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    def _wait(self, stage, seconds):
+        with self.lock:
+            self.stages[stage]["waiting"] += seconds
+
+    def _put(self, stage, q, item):
+        start = time.perf_counter()
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                self._wait(stage, time.perf_counter() - start)
+                return
+            except queue.Full:
+                pass
+        raise _Stopped()
+
+    def _get(self, stage, q):
+        start = time.perf_counter()
+        while not self.failed.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                self._wait(stage, time.perf_counter() - start)
+                return item
+            except queue.Empty:
+                pass
+        raise _Stopped()
+
+    def _thread(self, stage, func, *args):
+        """Returns a thread running a stage function. A failure stops the other stages through the failed event."""
+        self.stages.setdefault(stage, {"threads": 0, "seconds": 0.0, "waiting": 0.0})
+
+        def run():
+            start = time.perf_counter()
+            try:
+                func(*args)
+            except _Stopped:
+                pass
+            except BaseException as e:
+                with self.lock:
+                    self.errors.append(e)
+                self.failed.set()
+            finally:
+                with self.lock:
+                    self.stages[stage]["threads"] += 1
+                    self.stages[stage]["seconds"] += time.perf_counter() - start
+
+        return threading.Thread(target=run, name=f"ingest-{stage}", daemon=True)
+
+    def _parse(self, files, parsed):
+        for result in parse_notes(files, self.workers):
+            self._count("files")
+            self._put("parse", parsed, result)
+        self._put("parse", parsed, end_of_stream)
+
+    def _note_error(self, file, error):
+        self._count("parse_errors")
+        print(f"Error processing {file}: {error}. File skipped.")
+
+    def _filter(self, parsed, notes):
+        while (result := self._get("filter", parsed)) is not end_of_stream:
+            file, data, error = result
+            note_id = os.path.splitext(os.path.basename(file))[0]
+            if error is not None:
+                # A note that failed to parse is kept in the index as it was, not deleted as removed
+                self.seen.add(note_id)
+                self._note_error(file, error)
+                continue
+            if data is None:
+                self._count("too_short")
+                continue
+
+            self.seen.add(note_id)
+            try:
+                digest = note_hash(data)
+            except Exception as e:
+                # One bad note (e.g. text the hash cannot encode) is skipped, not the run; its index entries are kept
+                self._note_error(file, e)
+                continue
+            self._count("notes")
+            if self.incremental and self.indexed.get(note_id, {}).get("hash") == digest:
+                self._count("unchanged")
+                continue
+            self._put("filter", notes, (file, note_id, data, digest))
+        self._put("filter", notes, end_of_stream)
+
+    def _chunk(self, notes, batches):
+        done = load_checkpoint(self.checkpoint_path)
+        batch = []
+        while (item := self._get("chunk", notes)) is not end_of_stream:
+            file, note_id, data, digest = item
+            try:
+                chunks, ids = split_note(note_id, data)
+            except Exception as e:
+                self._note_error(file, e)
+                continue
+            indexed_ids = set(self.indexed.get(note_id, {}).get("chunks", []))
+            # Every chunk of a changed note is uploaded again (as in build_index.py): a chunk with an unchanged text
+            # and ID may have a new title, label or start position. Only the chunks uploaded before an interruption are skipped.
+            new = [(chunk, cid) for chunk, cid in zip(chunks, ids) if cid not in done]
+            self._count("chunks", len(chunks))
+            self._count("resumed", len(chunks) - len(new))
+
+            entry = {"hash": digest, "chunks": ids}
+            with self.lock:
+                self.stale_ids.extend(indexed_ids - set(ids))
+                if new:
+                    self.pending[note_id] = [entry, len(new)]
+                elif self.manifest is not None:
+                    self.manifest["notes"][note_id] = entry
+
+            for chunk, cid in new:
+                batch.append((note_id, chunk, cid))
+                if len(batch) == self.batch_size:
+                    self._put("chunk", batches, batch)
+                    batch = []
+        if batch:
+            self._put("chunk", batches, batch)
+        for _ in range(self.concurrency):
+            self._put("chunk", batches, end_of_stream)
+
+    def _embed(self, batches, embedded, live):
+        while (batch := self._get("embed", batches)) is not end_of_stream:
+            vectors = self.calls.embed_batch([chunk.page_content for _, chunk, _ in batch])
+            self._count("embedded", len(batch))
+            self._put("embed", embedded, (batch, vectors))
+        # The last embedding thread to finish ends the stream of the upload stage
+        with self.lock:
+            live[0] -= 1
+            last = live[0] == 0
+        if last:
+            self._put("embed", embedded, end_of_stream)
+
+    def _flush(self, buffer, checkpoint):
+        if not buffer:
+            return
+        batch = [item for items, _ in buffer for item in items]
+        vectors = [vector for _, batch_vectors in buffer for vector in batch_vectors]
+        ids = [cid for _, _, cid in batch]
+        self.calls.upload([chunk for _, chunk, _ in batch], ids, vectors)
+        if checkpoint:
+            checkpoint.write("".join(f"{cid}\n" for cid in ids))
+            checkpoint.flush()
+
+        # A note is recorded in the manifest once all its chunks are in the index
+        with self.lock:
+            for note_id, _, _ in batch:
+                entry = self.pending[note_id]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.pending[note_id]
+                    if self.manifest is not None:
+                        self.manifest["notes"][note_id] = entry[0]
+            self.counts["uploaded"] += len(batch)
+            uploaded = self.counts["uploaded"]
+        print(f"Uploaded {uploaded} chunks.")
+
+    def _upload(self, embedded):
+        checkpoint = open(self.checkpoint_path, "a", encoding="utf-8") if self.checkpoint_path else None
+        try:
+            buffer = []
+            size = 0
+            while (item := self._get("upload", embedded)) is not end_of_stream:
+                buffer.append(item)
+                size += len(item[0])
+                if size >= self.upload_batch_size:
+                    self._flush(buffer, checkpoint)
+                    buffer = []
+                    size = 0
+            self._flush(buffer, checkpoint)
+        finally:
+            if checkpoint:
+                checkpoint.close()
+
+    def run(self, files):
+        parsed, notes, batches, embedded = (queue.Queue(maxsize=self.queue_size) for _ in range(4))
+        live = [self.concurrency]
+        threads = [
+            self._thread("parse", self._parse, files, parsed),
+            self._thread("filter", self._filter, parsed, notes),
+            self._thread("chunk", self._chunk, notes, batches),
+            *[self._thread("embed", self._embed, batches, embedded, live) for _ in range(self.concurrency)],
+            self._thread("upload", self._upload, embedded),
+        ]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        if self.errors:
+            raise self.errors[0]
+
+        if self.manifest is not None:
+            self.removed = [note_id for note_id in self.indexed if note_id not in self.seen]
+            for note_id in self.removed:
+                self.stale_ids.extend(self.indexed[note_id]["chunks"])
+
+        # Busy time is the time a stage spent working and not waiting for its neighbours; stages whose busy
+        # times add up to more than the elapsed time have overlapped
+        stages = {
+            name: {"threads": stage["threads"], "busy_seconds": round(stage["seconds"] - stage["waiting"], 2)}
+            for name, stage in self.stages.items()
+        }
+        return {
+            **self.counts,
+            "seconds": round(elapsed, 2),
+            "chunks_per_second": round(self.counts["uploaded"] / elapsed, 1) if elapsed > 0 else 0.0,
+            "embedding_calls": self.calls.embedding_calls,
+            "upload_calls": self.calls.upload_calls,
+            "retries": self.calls.retries,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "stages": stages,
+        }
+
+    def delete_stale(self):
+        if self.stale_ids:
+            for start in range(0, len(self.stale_ids), self.upload_batch_size):
+                self.vector_store.delete(ids=[index_key(cid) for cid in self.stale_ids[start:start + self.upload_batch_size]])
+            print(f"Deleted {len(self.stale_ids)} stale chunks.")
+        for note_id in self.removed:
+            del self.manifest["notes"][note_id]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream the HTML notes through parsing, chunking, embedding and upload to the index")
+    parser.add_argument('--input', type=str, default=input_directory, help="Directory of the exported HTML notes")
+    parser.add_argument('--incremental', action='store_true', help="Upload only new or edited notes (according to the manifest)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes parsing the HTML files (1 = parse in a thread)")
+    parser.add_argument('--batch-size', type=int, default=100, help="Number of chunks embedded in one request")
+    parser.add_argument('--upload-batch-size', type=int, default=500, help="Number of chunks uploaded to the index in one request")
+    parser.add_argument('--concurrency', type=int, default=4, help="Number of embedding threads")
+    parser.add_argument('--queue-size', type=int, default=8, help="Capacity of the queues between the stages")
+    parser.add_argument('--target', type=str, default='azure', choices=['azure', 'local'], help="Index to build: Azure AI Search or local index")
+    parser.add_argument('--local-index', type=str, default=local_index_path, help="Directory of the local index")
+    parser.add_argument('--ann-lists', type=int, default=0, help="Number of IVF lists of the local ANN index (0 = no ANN index)")
+    args = parser.parse_args()
+
+    embeddings = create_embeddings()
+    if args.target == 'azure':
+        vector_store = create_vector_store(embeddings.embed_query)
+        manifest = load_manifest(manifest_path, vector_store_index)
+        pipeline = IngestPipeline(embeddings, vector_store, manifest=manifest, incremental=args.incremental, workers=max(1, args.workers),
+                                  batch_size=args.batch_size, upload_batch_size=args.upload_batch_size, concurrency=args.concurrency,
+                                  queue_size=args.queue_size, checkpoint_path=checkpoint_path)
+    else:
+        # The local index is always written whole, so there is no manifest or checkpoint
+        vector_store = LocalIndexWriter(args.local_index, ann_lists=args.ann_lists)
+        pipeline = IngestPipeline(embeddings, vector_store, workers=max(1, args.workers), batch_size=args.batch_size,
+                                  upload_batch_size=args.upload_batch_size, concurrency=args.concurrency, queue_size=args.queue_size)
+
+    stats = pipeline.run(iter_html_files(args.input))
+    print(f"Read {stats['files']} files: {stats['notes']} notes, {stats['too_short']} too short, {stats['parse_errors']} errors, "
+          f"{stats['unchanged']} unchanged. Uploaded {stats['uploaded']} of {stats['chunks']} chunks "
+          f"({stats['resumed']} uploaded before an interruption) in {stats['seconds']}s ({stats['chunks_per_second']} chunks/s), "
+          f"peak memory {stats['peak_rss_mb']} MB.")
+    print(f"API calls: {embeddings.calls} embedding ({stats['embedding_calls']} batches, the rest served from the cache), "
+          f"{stats['upload_calls']} upload, {stats['retries']} retries.")
+    print("Busy time per stage: " + ", ".join(f"{name} {stage['busy_seconds']}s" for name, stage in stats['stages'].items()))
+
+    if args.target == 'azure':
+        pipeline.delete_stale()
+        save_manifest(manifest_path, manifest)
+        pipeline.calls.clear_checkpoint()
+        print(f"Manifest saved to {manifest_path}.")
+    else:
+        vector_store.save()
+        print(f"Local index with {len(vector_store.ids)} chunks saved to {args.local_index}.")
+    write_index_version(index_version_path)
+    print(f"Embedding cache: {embeddings.stats()}")
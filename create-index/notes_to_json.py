@@ -5,64 +5,173 @@ Author: Szymon Manduk
 
 Company: Szymon Manduk AI, manduk.ai
 
-Description: 
-This script reads Google Notes exported as HTMLs and extracts the title, content, and label of each note. 
-The extracted information is then saved to a correspoding json file.
+Description:
+This script reads Google Notes exported as HTMLs and extracts the title, content, and label of each note.
+The extracted information is then saved to a packed corpus file, data/Notes/notes.jsonl (see search-index/corpus_store.py),
+or with --format json to a correspoding json file per note, as before.
+HTML files are parsed in parallel by a pool of worker processes (see --workers), the parent process writes the results.
+
+Example: python create-index/notes_to_json.py --workers 8
+Example: python create-index/notes_to_json.py --format json
 
 Copyright (c) 2024 Szymon Manduk AI.
 """
+import argparse
 import glob
 import json
-from bs4 import BeautifulSoup
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer
+
+# The corpus store is shared with the search API, so it lives in the search-index directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search-index'))
+from corpus_store import CorpusWriter
 
 # Directory containing the HTML files
 input_directory = 'data/Notes'
 output_directory = 'data/Notes/json'
+corpus_path = 'data/Notes/notes.jsonl'
 encoding = 'utf-8'
 length_threshold = 100  # Minimum number of characters in the content of a note
 
-# Ensure output directory exists
-os.makedirs(output_directory, exist_ok=True)
+# Only the body of the note is of interest - skipping the head saves parsing the large inline stylesheet
+body_only = SoupStrainer('body')
+
+
+def extract_fields(body):
+    """
+    Extracts title, content and label of a note in a single traversal of the body.
+    The first element with a given class wins, as it did with body.find(...).
+    """
+    title = content = label = None
+    for tag in body.find_all(['div', 'span']):
+        classes = tag.get('class') or []
+        if tag.name == 'div':
+            if title is None and 'title' in classes:
+                title = tag.text.strip()
+            elif content is None and 'content' in classes:
+                content = tag.text.strip()
+        elif label is None and 'label-name' in classes:
+            label = tag.text.strip()
 
-# Get a list of all HTML files in the input directory
-html_files = glob.glob(os.path.join(input_directory, '*.html'))
+        if title is not None and content is not None and label is not None:
+            break
 
-# Process each HTML file
-correct = 0
-incorrect = 0
-for file in html_files:
+    return title or '', content or '', label or ''
+
+
+def parse_note(file):
+    """
+    Parses a single HTML note. Runs in a worker process, so it never touches the output directory.
+    Returns a tuple (file, data, error) - data is None if the note was skipped, error is None on success.
+    """
     try:
         with open(file, 'r', encoding=encoding) as f:
-            soup = BeautifulSoup(f, 'html.parser')
-            body = soup.find('body')
-            if body:
-                v_title = body.find('div', class_='title').text.strip() if body.find('div', class_='title') else ''
-
-                v_content = body.find('div', class_='content').text.strip() if body.find('div', class_='content') else ''
-                # Skip if content is less than the threshold
-                if len(v_content) < length_threshold:
-                    continue
-
-                v_label = body.find('span', class_='label-name').text.strip() if body.find('span', class_='label-name') else ''
-
-                # Prepare data for JSON
-                data = {
-                    "title": v_title,
-                    "content": f"{v_title}\n{v_content}",
-                    "label": v_label
-                }
-
-                # Write the information to a JSON file
-                output_filename = os.path.splitext(os.path.basename(file))[0] + ".json"
-                output_path = os.path.join(output_directory, output_filename)
-                with open(output_path, 'w', encoding=encoding) as output_file:
-                    json.dump(data, output_file, ensure_ascii=False, indent=2)
-                correct += 1
+            soup = BeautifulSoup(f, 'html.parser', parse_only=body_only)
+        body = soup.find('body')
+        if not body:
+            return file, None, None
+
+        v_title, v_content, v_label = extract_fields(body)
+        # Skip if content is less than the threshold
+        if len(v_content) < length_threshold:
+            return file, None, None
+
+        # Prepare data for JSON
+        data = {
+            "title": v_title,
+            "content": f"{v_title}\n{v_content}",
+            "label": v_label
+        }
+        return file, data, None
     except Exception as e:
-        incorrect += 1
-        print(f"Error processing {file}: {str(e)}. File skipped.")
-        # delete the file
-        os.remove(output_path)
+        return file, None, str(e)
+
+
+def note_id(file):
+    """Returns the ID of a note: the file name without extension."""
+    return os.path.splitext(os.path.basename(file))[0]
+
+
+def write_note(file, data):
+    """
+    Writes the note to a JSON file. The file is written under a temporary name and renamed when complete,
+    so a failure never leaves a partial file behind (and never removes a good one from a previous run).
+    """
+    output_filename = note_id(file) + ".json"
+    output_path = os.path.join(output_directory, output_filename)
+    tmp_path = output_path + ".tmp"
+    try:
+        with open(tmp_path, 'w', encoding=encoding) as output_file:
+            json.dump(data, output_file, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, output_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def convert_notes(html_files, workers, write=write_note):
+    """
+    Parses the HTML files with a pool of workers and writes the results with write(file, data). Returns (correct, skipped, incorrect).
+    Workers get the files in chunks, so the inter-process overhead is paid per chunk and not per note.
+    """
+    correct = 0
+    skipped = 0
+    incorrect = 0
+
+    if workers > 1:
+        chunksize = max(1, min(64, len(html_files) // (workers * 4)))
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(parse_note, html_files, chunksize=chunksize)
+    else:
+        executor = None
+        results = map(parse_note, html_files)
+
+    try:
+        for file, data, error in results:
+            if error is None and data is not None:
+                try:
+                    write(file, data)
+                except Exception as e:
+                    error = str(e)
+
+            if error is not None:
+                incorrect += 1
+                print(f"Error processing {file}: {error}. File skipped.")
+            elif data is None:
+                skipped += 1
+            else:
+                correct += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return correct, skipped, incorrect
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert Google Keep HTML notes to json files")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Number of worker processes (1 = parse in the main process)")
+    parser.add_argument('--format', type=str, default='packed', choices=['packed', 'json'], help="Packed corpus file or one json file per note")
+    args = parser.parse_args()
+
+    # Get a list of all HTML files in the input directory
+    html_files = glob.glob(os.path.join(input_directory, '*.html'))
+
+    start = time.perf_counter()
+    if args.format == 'packed':
+        os.makedirs(os.path.dirname(corpus_path), exist_ok=True)
+        with CorpusWriter(corpus_path) as writer:
+            correct, skipped, incorrect = convert_notes(html_files, max(1, args.workers), lambda file, data: writer.add(note_id(file), data))
+        print(f'Notes saved to {corpus_path}.')
+    else:
+        # Ensure output directory exists
+        os.makedirs(output_directory, exist_ok=True)
+        correct, skipped, incorrect = convert_notes(html_files, max(1, args.workers))
+    elapsed = time.perf_counter() - start
 
-print(f'Processed {correct} notes. {incorrect} notes were skipped due to errors.')
+    print(f'Processed {correct} notes. {skipped} notes were too short. {incorrect} notes were skipped due to errors.')
+    print(f'Converted {len(html_files)} files in {elapsed:.2f}s ({len(html_files) / elapsed if elapsed > 0 else 0:.1f} files/s) using {args.workers} worker(s).')
@@ -0,0 +1,165 @@
+"""
+Filename: answer_cache.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines a semantic cache of answers of the search graph. A question is embedded and compared (cosine similarity)
+with the questions answered before; above the similarity threshold the stored answer and steps are returned and the graph
+(with its LLM calls) does not run. Entries expire after a TTL, the least recently used ones are evicted when the cache is full,
+and the whole cache is cleared when build_index.py writes a new index version stamp.
+
+The cache lives in the memory of a worker process (every gunicorn worker has its own).
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def read_index_version(path):
+    """Returns the version stamp written by build_index.py, or None if there is none."""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+class AnswerCache:
+    """
+    A class representing a semantic cache of answers.
+
+    Args:
+        embeddings (Embeddings): The embedding model used for the questions (the one of the retriever, so a cached
+            embedding of the question is shared by the answer cache and the search).
+        threshold (float, optional): The minimum cosine similarity of a cached question to be a hit. Defaults to 0.95.
+        ttl_seconds (float, optional): The lifetime of an entry. Defaults to 86400 (one day).
+        max_entries (int, optional): The maximum number of cached answers. Defaults to 1000.
+        index_version_path (str, optional): The index version stamp written by build_index.py. Defaults to None (no invalidation).
+        version_check_seconds (float, optional): How often the version stamp is checked. Defaults to 10.
+
+    Attributes:
+        vectors (np.ndarray): The (max_entries x dimensions) matrix of normalized question vectors, one row per slot.
+        entries (OrderedDict): Slot -> entry dict (question, answer, steps, created, seconds), in LRU order.
+
+    Methods:
+        lookup(question, vector) / alookup(question, vector) -> dict or None: Returns the best entry above the threshold
+            (with its "similarity") or None. The question is embedded unless its vector is given.
+        add(question, vector, answer, steps, seconds): Caches an answer that took the graph the given number of seconds.
+        record_hit(entry, lookup_seconds) -> float: Records the latency saved by a hit and returns it in seconds.
+        clear(): Removes all entries.
+        stats() -> dict: Returns lookups, hits, hit rate, latency saved and number of entries.
+    """
+
+    def __init__(self, embeddings, threshold=0.95, ttl_seconds=86400, max_entries=1000, index_version_path=None, version_check_seconds=10):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.index_version_path = index_version_path
+        self.version_check_seconds = version_check_seconds
+
+        self.vectors = None  # allocated when the first question is added (the dimensions are not known before)
+        self.used = np.zeros(max_entries, dtype=bool)
+        self.entries = OrderedDict()
+        self.free_slots = list(range(max_entries - 1, -1, -1))
+        self.lock = threading.Lock()
+
+        self.index_version = read_index_version(index_version_path)
+        self.version_checked = time.monotonic()
+
+        self.lookups = 0
+        self.hits = 0
+        self.latency_saved = 0.0
+
+    def _check_index_version(self):
+        now = time.monotonic()
+        if now - self.version_checked < self.version_check_seconds:
+            return
+        self.version_checked = now
+        version = read_index_version(self.index_version_path)
+        if version != self.index_version:
+            # The answers were generated from the previous index
+            self.index_version = version
+            self._clear()
+
+    def _clear(self):
+        self.entries.clear()
+        self.used[:] = False
+        self.free_slots = list(range(self.max_entries - 1, -1, -1))
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def _evict(self, slot):
+        del self.entries[slot]
+        self.used[slot] = False
+        self.free_slots.append(slot)
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _lookup(self, vector):
+        vector = self._normalize(vector)
+        with self.lock:
+            self.lookups += 1
+            self._check_index_version()
+            if not self.entries:
+                return None
+
+            scores = self.vectors @ vector
+            scores[~self.used] = -np.inf
+            slot = int(np.argmax(scores))
+            if scores[slot] < self.threshold:
+                return None
+
+            entry = self.entries[slot]
+            if time.time() - entry["created"] > self.ttl_seconds:
+                self._evict(slot)
+                return None
+
+            self.entries.move_to_end(slot)
+            self.hits += 1
+            return dict(entry, similarity=round(float(scores[slot]), 4))
+
+    def lookup(self, question, vector=None):
+        return self._lookup(self.embeddings.embed_query(question) if vector is None else vector)
+
+    async def alookup(self, question, vector=None):
+        return self._lookup(await self.embeddings.aembed_query(question) if vector is None else vector)
+
+    def add(self, question, vector, answer, steps, seconds):
+        with self.lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            if not self.free_slots:
+                self._evict(next(iter(self.entries)))
+            slot = self.free_slots.pop()
+            self.vectors[slot] = self._normalize(vector)
+            self.used[slot] = True
+            self.entries[slot] = {"question": question, "answer": answer, "steps": steps, "created": time.time(), "seconds": seconds}
+
+    def record_hit(self, entry, lookup_seconds):
+        """Records (and returns) the latency saved by a hit: the time the graph took for the cached question minus the lookup."""
+        saved = max(0.0, entry["seconds"] - lookup_seconds)
+        with self.lock:
+            self.latency_saved += saved
+        return saved
+
+    def stats(self):
+        with self.lock:
+            return {
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "latency_saved_seconds": round(self.latency_saved, 3),
+                "entries": len(self.entries),
+            }
@@ -0,0 +1,167 @@
+"""
+Filename: bm25_index.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines a compact BM25 inverted index, used as the keyword half of hybrid search in the local backend,
+and the reciprocal rank fusion (RRF) of keyword and vector rankings - the same fusion Azure AI Search uses for hybrid queries.
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import json
+import os
+import re
+from collections import Counter
+import numpy as np
+
+index_file = "bm25.npz"
+vocabulary_file = "bm25_vocabulary.json"
+
+token_pattern = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return token_pattern.findall(text.lower())
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuses several rankings (lists of rows, best first) into one. Every ranking adds 1 / (k + rank) to the score of a row.
+    Returns a list of (row, score), best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class BM25Index:
+    """
+    A class representing a BM25 inverted index over the chunks of the local index.
+
+    Postings of all terms are stored in two flat arrays (document rows and term frequencies), sliced by per-term offsets.
+    Document lengths and IDF values are precomputed at build time.
+
+    Args:
+        vocabulary (List[str]): The sorted list of indexed terms.
+        offsets (np.ndarray): The start of the postings of each term (one more entry than terms).
+        postings (np.ndarray): The document rows of all postings (int32).
+        frequencies (np.ndarray): The term frequencies of all postings (uint16).
+        lengths (np.ndarray): The number of tokens of each document (int32).
+        idf (np.ndarray): The inverse document frequency of each term (float32).
+        k1 (float, optional): The term frequency saturation parameter. Defaults to 1.2.
+        b (float, optional): The document length normalization parameter. Defaults to 0.75.
+
+    Methods:
+        build(texts) -> BM25Index: Builds the index for a list of texts (class method).
+        save(path) / load(path): Writes / reads the index files in the given directory.
+        search(query, k, ranges) -> List[Tuple[int, float]]: Returns the k best (row, score) pairs for the query
+            (among the rows of the given (start, end) slices, if any).
+    """
+
+    def __init__(self, vocabulary, offsets, postings, frequencies, lengths, idf, k1=1.2, b=0.75):
+        self.vocabulary = vocabulary
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.offsets = offsets
+        self.postings = postings
+        self.frequencies = frequencies
+        self.lengths = lengths
+        self.idf = idf
+        self.k1 = k1
+        self.b = b
+        # The length normalization part of the BM25 denominator depends only on the document
+        average_length = float(lengths.mean()) if len(lengths) else 0.0
+        self.norms = (k1 * (1 - b + b * lengths / max(average_length, 1.0))).astype(np.float32)
+
+    @classmethod
+    def build(cls, texts, k1=1.2, b=0.75):
+        term_postings = {}
+        lengths = np.zeros(len(texts), dtype=np.int32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[row] = len(tokens)
+            for term, frequency in Counter(tokens).items():
+                term_postings.setdefault(term, []).append((row, frequency))
+
+        vocabulary = sorted(term_postings)
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        postings = []
+        frequencies = []
+        for i, term in enumerate(vocabulary):
+            rows, counts = zip(*term_postings[term])
+            postings.extend(rows)
+            frequencies.extend(counts)
+            offsets[i + 1] = len(postings)
+
+        document_frequency = np.diff(offsets).astype(np.float32)
+        idf = np.log(1 + (len(texts) - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+        return cls(
+            vocabulary,
+            offsets,
+            np.asarray(postings, dtype=np.int32),
+            np.minimum(np.asarray(frequencies, dtype=np.int64), np.iinfo(np.uint16).max).astype(np.uint16),
+            lengths,
+            idf,
+            k1,
+            b,
+        )
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.savez(
+            os.path.join(path, index_file),
+            offsets=self.offsets,
+            postings=self.postings,
+            frequencies=self.frequencies,
+            lengths=self.lengths,
+            idf=self.idf,
+            parameters=np.array([self.k1, self.b], dtype=np.float32),
+        )
+        with open(os.path.join(path, vocabulary_file), "w", encoding="utf-8") as f:
+            json.dump(self.vocabulary, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(os.path.join(path, index_file)) as data:
+            arrays = {name: data[name] for name in data.files}
+        with open(os.path.join(path, vocabulary_file), "r", encoding="utf-8") as f:
+            vocabulary = json.load(f)
+        k1, b = arrays.pop("parameters").tolist()
+        return cls(vocabulary, **arrays, k1=k1, b=b)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, index_file))
+
+    def scores(self, query):
+        """Returns the BM25 score of every document for the query (zero for documents without query terms)."""
+        scores = np.zeros(len(self.lengths), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            rows = self.postings[start:end]
+            frequencies = self.frequencies[start:end].astype(np.float32)
+            # A term occurs at most once in the postings of a document, so plain fancy-index addition is safe
+            scores[rows] += self.idf[term_id] * frequencies * (self.k1 + 1) / (frequencies + self.norms[rows])
+        return scores
+
+    def search(self, query, k, ranges=None):
+        scores = self.scores(query)
+        if ranges is not None:
+            # Only the rows of the slices (e.g. of the labels the search is filtered by) are ranked
+            rows = np.concatenate([np.arange(start, end) for start, end in ranges]) if ranges else np.empty(0, dtype=np.int64)
+            matched = rows[scores[rows] != 0]
+        else:
+            matched = np.flatnonzero(scores)
+        if len(matched) == 0:
+            return []
+        k = min(k, len(matched))
+        best = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        best = best[np.argsort(-scores[best])]
+        return [(int(row), float(scores[row])) for row in best]
@@ -0,0 +1,104 @@
+"""
+Filename: calibrate_thresholds.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Fits the thresholds of the score-based evaluator (see score_evaluator.py) on a labeled question set and reports
+how many LLM evaluation calls they save and how accurate the decisions made without the LLM are.
+
+The question set is a JSONL file with {"question": ..., "sufficient": true/false} lines, where "sufficient" says whether
+the notes can answer the question. With --llm-labels, questions without the label are labeled by the LLM evaluation chain,
+so the thresholds reproduce its decisions. The retriever is configured with the same environment variables as the search API.
+
+Example: python search-index/calibrate_thresholds.py --questions-file labeled_questions.jsonl --precision 0.95
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import argparse
+import json
+import os
+from dotenv import load_dotenv, find_dotenv
+from retriever import Retriever
+from eval_chain import EvalChain
+from score_evaluator import ScoreEvaluator, top_score, calibrate
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the thresholds of the score-based evaluator")
+    parser.add_argument('--questions-file', type=str, required=True, help="JSONL file with {\"question\": ..., \"sufficient\": true/false} lines")
+    parser.add_argument('--precision', type=float, default=0.95, help="Required precision of the decisions made without the LLM")
+    parser.add_argument('--score-key', type=str, default='similarity', help="Document metadata key of the score")
+    parser.add_argument('--llm-labels', action='store_true', help="Label questions without \"sufficient\" with the LLM evaluation chain")
+    parser.add_argument('--output', type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    _ = load_dotenv(find_dotenv(filename='.env'))
+    retriever = Retriever(
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        open_ai_api_version="2023-05-15",
+        embedding_model_name="text-embedding-ada-002",
+        embedding_provider="openai",
+        vector_store_address=os.getenv("AZURESEARCH_ENDPOINT"),
+        vector_store_password=os.getenv("AZURESEARCH_ADMIN_KEY"),
+        vector_store_index=os.getenv("AZURESEARCH_INDEX_NAME"),
+        retrieved_documents=3,
+        search_type="hybrid",
+        embedding_cache_path=os.getenv("EMBEDDING_CACHE_PATH"),
+        backend=os.getenv("SEARCH_BACKEND", "azure"),
+        local_index_path=os.getenv("LOCAL_INDEX_PATH", "data/local_index"),
+        local_precision=os.getenv("LOCAL_INDEX_PRECISION", "float32"),
+        local_rescore=int(os.getenv("LOCAL_INDEX_RESCORE", "0")),
+        local_n_probe=int(os.getenv("LOCAL_INDEX_NPROBE", "0")),
+    )
+    eval_chain = EvalChain(provider="openai") if args.llm_labels else None
+
+    with open(args.questions_file, "r", encoding="utf-8") as f:
+        examples = [json.loads(line) for line in f if line.strip()]
+
+    scores = []
+    labels = []
+    for example in examples:
+        documents = retriever.retrieve(example["question"])
+        score = top_score(documents, args.score_key)
+        if score is None:
+            print(f"No {args.score_key} score for: {example['question']}")
+            continue
+        label = example.get("sufficient")
+        if label is None:
+            if eval_chain is None:
+                print(f"No label for: {example['question']} (use --llm-labels)")
+                continue
+            label = eval_chain.evaluate(example["question"], documents)["Evaluation"] == "yes"
+        scores.append(score)
+        labels.append(bool(label))
+
+    low, high = calibrate(scores, labels, args.precision)
+
+    # Replay the examples through the evaluator with the fitted thresholds
+    evaluator = ScoreEvaluator(None, low, high, args.score_key)
+    decided = 0
+    correct = 0
+    for score, label in zip(scores, labels):
+        decision = evaluator.decide_score(score)
+        if decision is not None:
+            decided += 1
+            correct += (decision == "yes") == label
+
+    results = {
+        "examples": len(scores),
+        "sufficient": sum(labels),
+        "precision": args.precision,
+        "score_key": args.score_key,
+        "low": low,
+        "high": high,
+        "decided_without_llm": decided,
+        "llm_calls_saved_rate": round(decided / len(scores), 4) if scores else 0.0,
+        "accuracy_without_llm": round(correct / decided, 4) if decided else None,
+    }
+    print(json.dumps(results, indent=2))
+    print(f"Set EVALUATOR=score, SCORE_EVAL_LOW={low if low is not None else ''} and SCORE_EVAL_HIGH={high if high is not None else ''} for the search API.")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,182 @@
+"""
+Filename: context_packer.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines the context packer, which turns the retrieved documents into the compact text put into the prompts
+of the evaluation and main chains. It merges adjacent (overlapping) chunks of the same note, drops near-duplicate documents,
+renders every document as a short header and its text, and trims the context to a token budget.
+
+build_index.py splits the notes with a 100 characters overlap and stores the start of every chunk in the note ("start_index").
+Chunks of an index built before that are merged by finding the overlap of their texts.
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import re
+
+# The merge fallback looks for an overlap of at least min_overlap characters (the splitter overlap is up to 100)
+min_overlap = 20
+max_overlap = 200
+
+
+def text_overlap(a, b):
+    """Returns the length of the longest suffix of a which is a prefix of b (0 if shorter than min_overlap)."""
+    for length in range(min(len(a), len(b), max_overlap), min_overlap - 1, -1):
+        if a.endswith(b[:length]):
+            return length
+    return 0
+
+
+def shingles(text, size=3):
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class ContextPacker:
+    """
+    A class that packs retrieved documents into a compact prompt context.
+
+    Args:
+        token_budget (int, optional): The maximum number of tokens of the context. Defaults to 1500.
+        duplicate_threshold (float, optional): The Jaccard similarity (of word 3-grams) above which a document is dropped
+            as a near-duplicate of a better ranked one. Defaults to 0.8.
+        model_name (str, optional): The model whose tokenizer counts the tokens (tiktoken). Defaults to "gpt-4o-mini";
+            if the tokenizer is not available the tokens are estimated as characters / 4.
+
+    Methods:
+        merge(documents) -> List[dict]: Merges adjacent chunks of the same note. Returns {"title", "label", "url", "text"} parts in rank order.
+        deduplicate(parts) -> List[dict]: Drops near-duplicate parts.
+        pack(documents) -> str: Returns the rendered context within the token budget.
+    """
+
+    def __init__(self, token_budget=1500, duplicate_threshold=0.8, model_name="gpt-4o-mini"):
+        self.token_budget = token_budget
+        self.duplicate_threshold = duplicate_threshold
+        self.model_name = model_name
+        self.encoding = None
+        self.encoding_loaded = False
+
+    def _encoding(self):
+        # tiktoken downloads the tokenizer on first use, so it is loaded lazily and may be unavailable (offline)
+        if not self.encoding_loaded:
+            self.encoding_loaded = True
+            try:
+                import tiktoken
+                self.encoding = tiktoken.encoding_for_model(self.model_name)
+            except Exception:
+                self.encoding = None
+        return self.encoding
+
+    def count_tokens(self, text):
+        encoding = self._encoding()
+        return len(encoding.encode(text)) if encoding is not None else (len(text) + 3) // 4
+
+    def truncate(self, text, tokens):
+        encoding = self._encoding()
+        if encoding is not None:
+            return encoding.decode(encoding.encode(text)[:tokens])
+        return text[:tokens * 4]
+
+    def merge(self, documents):
+        # Group the chunks by note; a merged part keeps the best rank of the chunks merged into it
+        groups = {}
+        for rank, doc in enumerate(documents):
+            key = doc.metadata.get("note_id") or doc.metadata.get("url") or f"document-{rank}"
+            groups.setdefault(key, []).append((rank, doc))
+
+        parts = []
+        for chunks in groups.values():
+            # Chunks with a start position are merged by position, the others keep their rank order
+            chunks.sort(key=lambda chunk: (chunk[1].metadata.get("start_index") is None, chunk[1].metadata.get("start_index") or 0, chunk[0]))
+            first_rank, first = chunks[0]
+            part = {
+                "rank": first_rank,
+                "title": first.metadata.get("title"),
+                "label": first.metadata.get("label"),
+                "url": first.metadata.get("url"),
+                "text": first.page_content,
+                "end": self._end(first),
+            }
+            parts.append(part)
+            for rank, doc in chunks[1:]:
+                start = doc.metadata.get("start_index")
+                if start is not None and part["end"] is not None and start <= part["end"] and self._continues(part, doc, start):
+                    # Overlapping (or touching) chunks: append only the part after the end of the previous one
+                    part["text"] += doc.page_content[part["end"] - start:]
+                    part["end"] = max(part["end"], self._end(doc))
+                    part["rank"] = min(part["rank"], rank)
+                else:
+                    # Without (consistent) positions the chunk may continue the part or precede it
+                    overlap = text_overlap(part["text"], doc.page_content)
+                    preceding = text_overlap(doc.page_content, part["text"]) if not overlap else 0
+                    if overlap:
+                        part["text"] += doc.page_content[overlap:]
+                        part["end"] = self._end(doc)
+                        part["rank"] = min(part["rank"], rank)
+                    elif preceding:
+                        part["text"] = doc.page_content + part["text"][preceding:]
+                        part["rank"] = min(part["rank"], rank)
+                    else:
+                        part = {**part, "rank": rank, "text": doc.page_content, "end": self._end(doc)}
+                        parts.append(part)
+        parts.sort(key=lambda part: part["rank"])
+        return parts
+
+    @staticmethod
+    def _continues(part, doc, start):
+        # The positions may be stale (a chunk kept from an index built before an edit shifted it), so the overlap they
+        # claim is checked against the texts; otherwise the chunk is merged by its text like a chunk without a position
+        overlap = part["end"] - start
+        if overlap >= len(doc.page_content):
+            return doc.page_content in part["text"]
+        return overlap <= len(part["text"]) and part["text"].endswith(doc.page_content[:overlap])
+
+    @staticmethod
+    def _end(doc):
+        start = doc.metadata.get("start_index")
+        return start + len(doc.page_content) if start is not None else None
+
+    def deduplicate(self, parts):
+        kept = []
+        kept_shingles = []
+        for part in parts:
+            part_shingles = shingles(part["text"])
+            if any(jaccard(part_shingles, other) >= self.duplicate_threshold for other in kept_shingles):
+                continue
+            kept.append(part)
+            kept_shingles.append(part_shingles)
+        return kept
+
+    @staticmethod
+    def render(index, part):
+        header = f"[{index}]"
+        if part["title"]:
+            header += f" {part['title']}"
+        if part["label"]:
+            header += f" ({part['label']})"
+        if part["url"]:
+            header += f" {part['url']}"
+        return f"{header}\n{part['text'].strip()}"
+
+    def pack(self, documents):
+        """Returns the context: rendered parts in rank order, while they fit the token budget (the last one truncated)."""
+        blocks = []
+        used = 0
+        for index, part in enumerate(self.deduplicate(self.merge(documents)), start=1):
+            block = self.render(index, part)
+            tokens = self.count_tokens(block) + 1
+            if used + tokens > self.token_budget:
+                remaining = self.token_budget - used - 1
+                if remaining > 0:
+                    blocks.append(self.truncate(block, remaining))
+                break
+            blocks.append(block)
+            used += tokens
+        return "\n\n".join(blocks)
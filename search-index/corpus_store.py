@@ -0,0 +1,176 @@
+"""
+Filename: corpus_store.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Packed storage of the converted notes, replacing the directory with one pretty-printed JSON file per note.
+The notes are written one after another as compact JSON lines to a single file (notes.jsonl), and an offset index
+(notes.jsonl.idx) maps every note ID to the position of its line. Readers memory-map the file, so loading the corpus
+is one sequential read and a single note (e.g. the note cited by an answer) is read by ID without scanning the file.
+If the offset index is missing or does not match the file, it is rebuilt by a scan.
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import json
+import mmap
+import os
+
+index_version = 1
+
+
+def corpus_index_path(path):
+    return path + ".idx"
+
+
+def load_notes(path):
+    """
+    Reads the notes from a packed corpus file or a directory of json files (the previous format).
+    Returns a dict {note_id: data}, the note ID is the file name without extension.
+    """
+    if os.path.isfile(path):
+        with CorpusStore(path) as corpus:
+            return dict(corpus.items())
+
+    notes = {}
+    for file in os.listdir(path):
+        # if the file is not a json file we skip it
+        if not file.endswith(".json"):
+            continue
+
+        # Load and parse the json file
+        with open(os.path.join(path, file), "r", encoding="utf-8") as f:
+            notes[os.path.splitext(file)[0]] = json.load(f)
+    return notes
+
+
+class CorpusWriter:
+    """
+    A class writing a packed corpus. The notes are appended to a temporary file as they come and the file and its
+    offset index are renamed into place when the writer is closed, so a failed conversion leaves the previous corpus intact.
+
+    Args:
+        path (str): The path of the corpus file (e.g. data/Notes/notes.jsonl).
+
+    Methods:
+        add(note_id, data): Appends a note ({"title", "content", "label"}).
+        close(): Writes the offset index and replaces the previous corpus. Also called on leaving a with block without an error.
+        abort(): Removes the temporary files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.offsets = {}
+        self.file = open(self.tmp_path, "wb")
+        self.position = 0
+
+    def add(self, note_id, data):
+        line = json.dumps({"id": note_id, **data}, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        self.file.write(line)
+        self.offsets[note_id] = (self.position, len(line) - 1)
+        self.position += len(line)
+
+    def close(self):
+        self.file.close()
+        index = {"version": index_version, "size": self.position, "notes": self.offsets}
+        with open(corpus_index_path(self.tmp_path), "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+        # The index goes last: until it is replaced, the size check makes readers rebuild it from the new file
+        os.replace(self.tmp_path, self.path)
+        os.replace(corpus_index_path(self.tmp_path), corpus_index_path(self.path))
+
+    def abort(self):
+        self.file.close()
+        for path in (self.tmp_path, corpus_index_path(self.tmp_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CorpusStore:
+    """
+    A class reading a packed corpus through a memory map.
+
+    Args:
+        path (str): The path of the corpus file.
+
+    Attributes:
+        offsets (dict): Note ID -> (offset, length) of its line, in the order of the file.
+
+    Methods:
+        get(note_id) -> dict: Returns the note ({"title", "content", "label"}) or None if there is no such note.
+        items(): Yields (note_id, data) of all notes in the order of the file.
+        close(): Releases the memory map.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        # An empty file cannot be memory-mapped
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.offsets = self._load_index(size)
+
+    def _load_index(self, size):
+        try:
+            with open(corpus_index_path(self.path), "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("version") == index_version and index.get("size") == size:
+                return {note_id: tuple(position) for note_id, position in index["notes"].items()}
+        except (OSError, ValueError):
+            pass
+        return self._scan()
+
+    def _scan(self):
+        offsets = {}
+        position = 0
+        while position < len(self.data):
+            end = self.data.find(b"\n", position)
+            if end == -1:
+                end = len(self.data)
+            if end > position:
+                offsets[json.loads(self.data[position:end])["id"]] = (position, end - position)
+            position = end + 1
+        return offsets
+
+    def _read(self, position):
+        offset, length = position
+        data = json.loads(self.data[offset:offset + length])
+        del data["id"]
+        return data
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, note_id):
+        return note_id in self.offsets
+
+    def get(self, note_id):
+        position = self.offsets.get(note_id)
+        return self._read(position) if position is not None else None
+
+    def items(self):
+        for note_id, position in self.offsets.items():
+            yield note_id, self._read(position)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
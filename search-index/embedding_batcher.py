@@ -0,0 +1,180 @@
+"""
+Filename: embedding_batcher.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines a wrapper of an embeddings model which micro-batches concurrent query embeddings. The questions
+arriving within a short window (a few milliseconds) are sent as one embed_documents request and every caller gets
+its own vector, so 50 concurrent questions cost one or a few embedding requests instead of 50 small ones (and as many
+rate-limited calls). A batch is sent early when it reaches the maximum size.
+
+The batcher goes under the embedding cache (CachedEmbeddings(BatchingEmbeddings(model))), so only the questions
+missing from the cache wait for a batch. The sizes of the batches and the wait of the questions for their batch
+are recorded in the metrics (metrics.py) and in stats().
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+from langchain_core.embeddings import Embeddings
+import metrics
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    A class collecting the concurrent embed_query / aembed_query calls into batched embed_documents requests.
+
+    Args:
+        embeddings (Embeddings): The embeddings model to wrap.
+        window_ms (float, optional): How long the first query of a batch waits for others, in milliseconds. Defaults to 5.
+        max_batch_size (int, optional): The number of queries which sends a batch at once. Defaults to 64. (A sync batch
+            also takes the few queries that arrive while it is being taken.)
+
+    Attributes:
+        pending (list): The queries of the async batch being collected: [text, future, enqueued, sent].
+        sync_pending (list): The queries of the sync batch being collected.
+
+    Methods:
+        embed_query(text) / aembed_query(text): Embeds a single text in a batch with the concurrent queries.
+        embed_documents(texts) / aembed_documents(texts): Embeds a list of texts directly (it is a batch already).
+        stats() -> dict: Returns the numbers of queries and batches, the batch size distribution and the wait for the batches.
+    """
+
+    def __init__(self, embeddings, window_ms=5.0, max_batch_size=64):
+        self.embeddings = embeddings
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.lock = threading.Lock()
+
+        # Async batches are collected per event loop (a worker runs one, but every asyncio.run starts a new one)
+        self.pending = []
+        self.loop = None
+        self.flush_handle = None
+        self.tasks = set()
+
+        self.sync_pending = []
+        self.sync_full = threading.Event()
+
+        self.queries = 0
+        self.batches = 0
+        self.duplicates = 0
+        self.batch_sizes = {}
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _texts(self, batch):
+        """Returns the distinct texts of a batch (a question asked twice at once is embedded once) and records the batch."""
+        sent = time.perf_counter()
+        texts = list(dict.fromkeys(item[0] for item in batch))
+        waits = [sent - item[2] for item in batch]
+        for item in batch:
+            item[3] = sent
+        with self.lock:
+            self.batches += 1
+            self.queries += len(batch)
+            self.duplicates += len(batch) - len(texts)
+            self.batch_sizes[len(texts)] = self.batch_sizes.get(len(texts), 0) + 1
+            self.wait_seconds += sum(waits)
+            self.max_wait_seconds = max(self.max_wait_seconds, *waits)
+        metrics.embedding_batch_size.observe(len(texts))
+        return texts
+
+    def _resolve(self, batch, texts, vectors=None, error=None):
+        vectors = dict(zip(texts, vectors)) if error is None else None
+        for text, future, _, _ in batch:
+            # The caller may have been cancelled meanwhile (e.g. a client that disconnected)
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(vectors[text])
+            else:
+                future.set_exception(error)
+
+    def _record_wait(self, item):
+        if item[3] is not None:
+            metrics.record_embedding_wait(item[3] - item[2])
+
+    def embed_query(self, text):
+        item = [text, Future(), time.perf_counter(), None]
+        with self.lock:
+            self.sync_pending.append(item)
+            leader = len(self.sync_pending) == 1
+            if len(self.sync_pending) >= self.max_batch_size:
+                self.sync_full.set()
+
+        if leader:
+            # The first query of a batch waits for the others and sends the batch
+            self.sync_full.wait(self.window)
+            with self.lock:
+                batch, self.sync_pending = self.sync_pending, []
+                self.sync_full.clear()
+            texts = self._texts(batch)
+            try:
+                self._resolve(batch, texts, self.embeddings.embed_documents(texts))
+            except Exception as e:
+                self._resolve(batch, texts, error=e)
+
+        vector = item[1].result()
+        self._record_wait(item)
+        return vector
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = self.loop.create_task(self._send(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch):
+        texts = self._texts(batch)
+        try:
+            vectors = await self.embeddings.aembed_documents(texts)
+        except Exception as e:
+            self._resolve(batch, texts, error=e)
+            return
+        self._resolve(batch, texts, vectors)
+
+    async def aembed_query(self, text):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.pending = []
+            self.flush_handle = None
+
+        item = [text, loop.create_future(), time.perf_counter(), None]
+        self.pending.append(item)
+        if len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif len(self.pending) == 1:
+            self.flush_handle = loop.call_later(self.window, self._flush)
+
+        vector = await item[1]
+        self._record_wait(item)
+        return vector
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        return await self.embeddings.aembed_documents(texts)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "window_ms": round(self.window * 1000, 3),
+                "queries": self.queries,
+                "batches": self.batches,
+                "duplicates": self.duplicates,
+                "mean_batch_size": round((self.queries - self.duplicates) / self.batches, 2) if self.batches else 0.0,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "mean_wait_ms": round(self.wait_seconds / self.queries * 1000, 3) if self.queries else 0.0,
+                "max_wait_ms": round(self.max_wait_seconds * 1000, 3),
+            }
@@ -0,0 +1,191 @@
+"""
+Filename: embedding_cache.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines a class that wraps an embeddings model with a persistent on-disk cache (SQLite).
+It is used both by the index builder (create-index/build_index.py) and by the Retriever, so texts embedded once are never sent to the embedding API again.
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+class CachedEmbeddings(Embeddings):
+    """
+    A class that caches the vectors returned by an embeddings model in a SQLite database.
+
+    Vectors are stored as float32 blobs keyed by a hash of the model name and the text. The cache is bounded:
+    when it grows above max_entries, the least recently used vectors are evicted. The last use of a vector is recorded
+    at most once per touch_interval, so cache hits rarely write to the database (a write locks it for all processes).
+
+    Args:
+        embeddings (Embeddings): The embeddings model to wrap.
+        model_name (str): The name of the embedding model - part of the cache key, so switching models never returns stale vectors.
+        path (str): The path of the SQLite database file. It is created if it does not exist.
+        max_entries (int, optional): The maximum number of cached vectors. Defaults to 200000 (~1.2 GB for 1536 dimensions).
+        touch_interval (float, optional): The minimum time in seconds between two updates of the last use of a vector. Defaults to 3600.
+
+    Attributes:
+        hits (int): The number of texts served from the cache.
+        misses (int): The number of texts sent to the embeddings model.
+        calls (int): The number of (successful) calls made to the embeddings model.
+
+    Methods:
+        embed_documents(texts) / aembed_documents(texts): Embeds a list of texts, calling the model only for the missing ones.
+        embed_query(text) / aembed_query(text): Embeds a single text.
+        stats() -> dict: Returns the hit/miss/call counters and the number of cached vectors.
+    """
+
+    def __init__(self, embeddings, model_name, path, max_entries=200000, touch_interval=3600):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # The connection is opened by the process that uses it (see _db), so a cache created before gunicorn forks its workers is safe
+        self._connection = None
+        self._connection_pid = None
+        self._db()
+
+    def _db(self):
+        """Returns the connection of this process, opening it on first use (callers hold the lock, except __init__)."""
+        if self._connection is None or self._connection_pid != os.getpid():
+            # One connection shared by all threads (guarded by the lock). WAL lets several processes (e.g. gunicorn workers) share the file.
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._connection_pid = os.getpid()
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._connection.commit()
+        return self._connection
+
+    def _size(self, connection):
+        # Counted in the database, as the other processes sharing the file insert and evict too (callers hold the lock)
+        return connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).digest()
+
+    def _lookup(self, texts):
+        """Returns a list with the cached vector for each text, or None if the text is not cached."""
+        keys = [self._key(text) for text in texts]
+        found = {}
+        used = {}
+        with self._lock:
+            connection = self._db()
+            # SQLite limits the number of query parameters, so we look the keys up in slices
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = connection.execute(
+                    f"SELECT key, vector, last_used FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, vector, last_used in rows:
+                    found[key] = vector
+                    used[key] = last_used
+            # Only the vectors not used for touch_interval get a new last use, so most hits are read-only
+            now = time.time()
+            touched = [(now, key) for key, last_used in used.items() if now - last_used > self.touch_interval]
+            if touched:
+                connection.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", touched)
+                connection.commit()
+            hits = sum(key in found for key in keys)
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        return [
+            np.frombuffer(found[key], dtype=np.float32).tolist() if key in found else None
+            for key in keys
+        ]
+
+    def _store(self, texts, vectors):
+        now = time.time()
+        rows = [(self._key(text), np.asarray(vector, dtype=np.float32).tobytes(), now) for text, vector in zip(texts, vectors)]
+        with self._lock:
+            connection = self._db()
+            self.calls += 1
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            size = self._size(connection) if connection.total_changes > before else 0
+            if size > self.max_entries:
+                # Evict the least recently used vectors, leaving some headroom so we do not evict on every insert
+                excess = size - int(self.max_entries * 0.9)
+                connection.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,)
+                )
+            connection.commit()
+
+    def _missing(self, texts, vectors):
+        """Returns the distinct texts without a cached vector."""
+        return list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+
+    def _merge(self, texts, vectors, missing, computed):
+        computed = dict(zip(missing, computed))
+        return [vector if vector is not None else computed[text] for text, vector in zip(texts, vectors)]
+
+    def embed_documents(self, texts):
+        vectors = self._lookup(texts)
+        missing = self._missing(texts, vectors)
+        if not missing:
+            return vectors
+        computed = self.embeddings.embed_documents(missing)
+        self._store(missing, computed)
+        return self._merge(texts, vectors, missing, computed)
+
+    def embed_query(self, text):
+        vector = self._lookup([text])[0]
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._store([text], [vector])
+        return vector
+
+    # The async methods read and write SQLite in a thread, so the disk I/O and the eviction do not block the event loop
+    async def aembed_documents(self, texts):
+        vectors = await asyncio.to_thread(self._lookup, texts)
+        missing = self._missing(texts, vectors)
+        if not missing:
+            return vectors
+        computed = await self.embeddings.aembed_documents(missing)
+        await asyncio.to_thread(self._store, missing, computed)
+        return self._merge(texts, vectors, missing, computed)
+
+    async def aembed_query(self, text):
+        vector = (await asyncio.to_thread(self._lookup, [text]))[0]
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            await asyncio.to_thread(self._store, [text], [vector])
+        return vector
+
+    def stats(self):
+        with self._lock:
+            entries = self._size(self._db())
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "calls": self.calls,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+        }
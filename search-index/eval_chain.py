@@ -10,10 +10,11 @@ Description: Defines a class that represents a chain for evaluating if retrieved
 Copyright (c) 2024 Szymon Manduk AI.
 """
 
-from langchain_ollama import ChatOllama
-from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
+from contextlib import nullcontext
+from llm_scheduler import EVALUATE
+from metrics import TokenCounter, timer
 
 class EvalChain:
     """
@@ -22,18 +23,23 @@ class EvalChain:
     Attributes:
         provider (str): The provider for the evaluator model. Default is "ollama", other option is "openai".
         temperature (int): The temperature parameter for generating responses. Default is 0.
+        context_packer (ContextPacker): Packs the documents into a compact prompt context. Default is None (documents formatted as they are).
+        scheduler (LLMScheduler): Schedules the async LLM calls (local inference server). Default is None (calls sent directly).
         prompt (PromptTemplate): The template for generating prompts.
         llm (ChatOllama or ChatOpenAI): The language model for generating responses.
         eval_chain (Chain): The chain for generating responses
 
     Methods:
         evaluate(self, question, documents): Evaluates if the documents are sufficient to answer the question.
+        aevaluate(self, question, documents): Async version of evaluate.
 
     """
 
-    def __init__(self, provider = "ollama", temperature = 0):
+    def __init__(self, provider = "ollama", temperature = 0, context_packer = None, scheduler = None):
         self.provider = provider
         self.temperature = temperature
+        self.context_packer = context_packer
+        self.scheduler = scheduler
         self.prompt = PromptTemplate(
             template="""Your task is to carefully evaluate if information in Documents provided below is sufficient for answering User Question.  
             User Question: {question} 
@@ -45,16 +51,34 @@ class EvalChain:
             input_variables=["question", "documents"],
         )
         
+        # Only the selected provider's package is imported (they are slow to import)
+        # The token counter records the token usage in the metrics (stream_usage reports it when the graph is streamed too)
         if self.provider == "openai":
+            from langchain_openai import ChatOpenAI
             self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, model_kwargs={"response_format": {"type": "json_object"}},
+                                  stream_usage=True, callbacks=[TokenCounter("evaluate")],
             )
         elif self.provider == "ollama":
-            self.llm = ChatOllama(model="llama3.1", temperature=0, format="json")
+            from langchain_ollama import ChatOllama
+            self.llm = ChatOllama(model="llama3.1", temperature=0, format="json", callbacks=[TokenCounter("evaluate")])
         else:
             raise ValueError("Invalid provider. Please choose 'openai' or 'ollama'.")
         
         self.eval_chain = self.prompt | self.llm | JsonOutputParser()
     
+    def _context(self, documents):
+        return self.context_packer.pack(documents) if self.context_packer is not None else documents
+
+    def _slot(self):
+        return self.scheduler.slot(EVALUATE, "evaluate") if self.scheduler is not None else nullcontext()
+
     def evaluate(self, question, documents):
-        return self.eval_chain.invoke({"documents": documents, "question": question})
-    
\ No newline at end of file
+        context = self._context(documents)
+        with timer("call", "llm_evaluate"):
+            return self.eval_chain.invoke({"documents": context, "question": question})
+
+    async def aevaluate(self, question, documents):
+        context = self._context(documents)
+        async with self._slot():
+            with timer("call", "llm_evaluate"):
+                return await self.eval_chain.ainvoke({"documents": context, "question": question})
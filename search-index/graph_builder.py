@@ -6,31 +6,57 @@ Author: Szymon Manduk
 Company: Szymon Manduk AI, manduk.ai
 
 Description: This module defines the build_graph function, which builds a graph structure for the search-index module.
+The graph has two modes: "two_call" (evaluate, then generate) and "fused" (judge evaluates and answers in one LLM call).
+Every node is registered with its sync and async operation, so the compiled graph runs with both invoke and ainvoke,
+and its wall time is recorded in the metrics.
 
 Copyright (c) 2024 Szymon Manduk AI.
 """
 
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import START, END, StateGraph
 from graph_state import GraphState
+from metrics import timed_node, atimed_node
 
-def build_graph(graph_ops):
-    graph_structure = StateGraph(GraphState)
+def node(name, func, afunc):
+    return RunnableLambda(timed_node(name, func), afunc=atimed_node(name, afunc))
 
-    graph_structure.add_node("retrieve", graph_ops.retrieve)
-    graph_structure.add_node("generate", graph_ops.generate)
-    graph_structure.add_node("evaluate", graph_ops.evaluate)
-    graph_structure.add_node("web_search", graph_ops.web_search)
+def build_graph(graph_ops, mode="two_call"):
+    graph_structure = StateGraph(GraphState)
 
+    graph_structure.add_node("retrieve", node("retrieve", graph_ops.retrieve, graph_ops.aretrieve))
+    graph_structure.add_node("generate", node("generate", graph_ops.generate, graph_ops.agenerate))
+    graph_structure.add_node("web_search", node("web_search", graph_ops.web_search, graph_ops.aweb_search))
     graph_structure.add_edge(START, "retrieve")
-    graph_structure.add_edge("retrieve", "evaluate")
-    graph_structure.add_conditional_edges(
-        "evaluate", 
-        graph_ops.determine_next_node,
-        {
-            "web_search": "web_search",
-            "generate": "generate",
-        },
-    )
+
+    if mode == "two_call":
+        # The evaluation chain decides, then the main chain answers from the documents or the web search results
+        graph_structure.add_node("evaluate", node("evaluate", graph_ops.evaluate, graph_ops.aevaluate))
+        graph_structure.add_edge("retrieve", "evaluate")
+        graph_structure.add_conditional_edges(
+            "evaluate", 
+            graph_ops.determine_next_node,
+            {
+                "web_search": "web_search",
+                "generate": "generate",
+            },
+        )
+    elif mode == "fused":
+        # The judge chain decides and answers in one call; only the web search path needs the main chain
+        graph_structure.add_node("judge", node("judge", graph_ops.judge, graph_ops.ajudge))
+        graph_structure.add_edge("retrieve", "judge")
+        graph_structure.add_conditional_edges(
+            "judge",
+            graph_ops.determine_after_judge,
+            {
+                "web_search": "web_search",
+                "generate": "generate",
+                "end": END,
+            },
+        )
+    else:
+        raise ValueError("Invalid graph mode. Please choose 'two_call' or 'fused'.")
+
     graph_structure.add_edge("web_search", "generate")
     graph_structure.add_edge("generate", END)
 
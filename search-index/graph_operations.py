@@ -5,34 +5,67 @@ Author: Szymon Manduk
 
 Company: Szymon Manduk AI, manduk.ai
 
-Description: This module defines the GraphOperations class, which contains nodes operations of the graph: retrieve, evaluate, generate and search-web.
+Description: This module defines the GraphOperations class, which contains nodes operations of the graph: retrieve, evaluate, generate and search-web,
+and judge, which evaluates and answers in one LLM call in the fused graph mode.
+Every node has a sync version (used by graph.invoke) and an async version with an "a" prefix (used by graph.ainvoke),
+which share the state handling and differ only in the call to the retriever, chain or tool.
+In the optional speculative mode the evaluate node starts the web search concurrently with the evaluation LLM call,
+so the fallback path does not wait for the two round trips in sequence (the judge node does the same with its call).
+The search results are used if the evaluation says "no" and discarded otherwise; the speculation counters record how often each happens.
 
 Copyright (c) 2024 Szymon Manduk AI.
 """
 
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from langchain.schema import Document
 
 class GraphOperations:
-    def __init__(self, retriever, main_chain, eval_chain, web_search_tool):
+    def __init__(self, retriever, main_chain, eval_chain, web_search_tool, speculative_search=False, judge_chain=None):
         self.retriever = retriever
         self.main_chain = main_chain
         self.eval_chain = eval_chain
         self.web_search_tool = web_search_tool
+        self.speculative_search = speculative_search
+        # Used by the judge node of the fused graph mode
+        self.judge_chain = judge_chain
 
+        # Speculative searches launched, used (evaluation "no"), wasted (evaluation "yes") and failed (the search raised)
+        self.speculation = {"launched": 0, "used": 0, "wasted": 0, "failed": 0}
+        self.speculation_lock = threading.Lock()
+        # The sync graph path runs the speculative searches in threads
+        self.executor = ThreadPoolExecutor(max_workers=8) if speculative_search else None
 
-    # Retrieves documents using previously defined retriever. Consumes a state with a question.
+    def _count(self, counter):
+        with self.speculation_lock:
+            self.speculation[counter] += 1
+
+    def speculation_stats(self):
+        with self.speculation_lock:
+            stats = dict(self.speculation)
+        finished = stats["used"] + stats["wasted"]
+        stats["wasted_rate"] = round(stats["wasted"] / finished, 4) if finished else 0.0
+        return stats
+
+
+    # Retrieves documents using previously defined retriever. Consumes a state with a question (and optionally its vector and labels).
     # Returns a new state with documents added and appended step
     def retrieve(self, state):
-        question = state["question"]
+        documents = self.retriever.retrieve(state["question"], state["question_vector"], state["labels"])
+        return self._retrieved(state, documents)
 
-        documents = self.retriever.retrieve(question)
-        
+    async def aretrieve(self, state):
+        documents = await self.retriever.aretrieve(state["question"], state["question_vector"], state["labels"])
+        return self._retrieved(state, documents)
+
+    def _retrieved(self, state, documents):
         steps = state["steps"] if state["steps"] is not None else []
         steps.append("retrieve_documents")
         
         return {
             "documents": documents, 
-            "question": question, 
+            "question": state["question"], 
             "steps": steps
         }
 
@@ -40,26 +73,29 @@ class GraphOperations:
     # Generates an answer using previously defined main_chain. Consumes a state with a question and documents. 
     # Returns a new state with answer added and appended step
     def generate(self, state):
-        question = state["question"]
-        documents = state["documents"]
-        search_required = state["search_required"]
-        search_results = state["search_results"]
-        
-        # if search was required and results are available, we use them instead of retrieved documents
-        if search_required and search_results:
-            documents = search_results
+        answer = self.main_chain.generate(state["question"], self._generation_documents(state))
+        return self._generated(state, answer)
 
-        answer = self.main_chain.generate(question, documents)
+    async def agenerate(self, state):
+        answer = await self.main_chain.agenerate(state["question"], self._generation_documents(state))
+        return self._generated(state, answer)
 
+    def _generation_documents(self, state):
+        # if search was required and results are available, we use them instead of retrieved documents
+        if state["search_required"] and state["search_results"]:
+            return state["search_results"]
+        return state["documents"]
+
+    def _generated(self, state, answer):
         steps = state["steps"]
         steps.append("generate_answer")
         
         return {
-            "documents": documents,
-            "question": question,
+            "documents": self._generation_documents(state),
+            "question": state["question"],
             "answer": answer,
-            "search_required": search_required,
-            "search_results": search_results,
+            "search_required": state["search_required"],
+            "search_results": state["search_results"],
             "steps": steps,
         }
 
@@ -67,51 +103,139 @@ class GraphOperations:
     # Evaluates if the documents are relevant to the question. Consumes a state with a question and documents.
     # Returns a new state with search_required added and appended step
     def evaluate(self, state):
-        question = state["question"]
-        documents = state["documents"]
+        evaluation, search_results = self._speculate(state, self.eval_chain.evaluate)
+        return self._evaluated(state, evaluation, search_results)
+
+    async def aevaluate(self, state):
+        evaluation, search_results = await self._aspeculate(state, self.eval_chain.aevaluate)
+        return self._evaluated(state, evaluation, search_results)
+
+    def _speculate(self, state, evaluate):
+        """Calls evaluate(question, documents), with a web search alongside in the speculative mode. Returns (evaluation, search results or None)."""
+        if not self.speculative_search:
+            return evaluate(state["question"], state["documents"]), None
+
+        self._count("launched")
+        search = self.executor.submit(self.web_search_tool.search, state["question"])
+        evaluation = evaluate(state["question"], state["documents"])
+        if evaluation["Evaluation"] != "no":
+            # A running search cannot be interrupted, its results are dropped
+            search.cancel()
+            self._count("wasted")
+            return evaluation, None
+        try:
+            results = search.result()
+        except Exception:
+            # The web_search node searches again
+            self._count("failed")
+            return evaluation, None
+        self._count("used")
+        return evaluation, results
+
+    async def _aspeculate(self, state, aevaluate):
+        if not self.speculative_search:
+            return await aevaluate(state["question"], state["documents"]), None
+
+        self._count("launched")
+        search = asyncio.create_task(self.web_search_tool.asearch(state["question"]))
+        try:
+            evaluation = await aevaluate(state["question"], state["documents"])
+        except BaseException:
+            search.cancel()
+            raise
+        if evaluation["Evaluation"] != "no":
+            search.cancel()
+            # Retrieve the exception of a search that had already failed, so asyncio does not log it as unhandled
+            search.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self._count("wasted")
+            return evaluation, None
+        try:
+            results = await search
+        except Exception:
+            # The web_search node searches again
+            self._count("failed")
+            return evaluation, None
+        self._count("used")
+        return evaluation, results
+
+    def _evaluated(self, state, evaluation, search_results=None, step="evaluate_retrieval"):
         steps = state["steps"]
-        steps.append("evaluate_retrieval")
-
-        # Evaluate if the documents are relevant to the question
-        evaluation = self.eval_chain.evaluate(question, documents)
+        steps.append(step)
 
         # if the evaluation is negative we set search_required to True
         search_required = False
         search_required = evaluation["Evaluation"] == "no"
 
-        return {
-            "documents": documents,
-            "question": question,
+        new_state = {
+            "documents": state["documents"],
+            "question": state["question"],
             "search_required": search_required,
             "steps": steps,
         }
+        # Results of a speculative web search, the web_search node passes them on
+        if search_results is not None:
+            new_state["search_results"] = self._search_documents(search_results)
+        return new_state
 
 
     # Searches the web for documents that may help to answer the question. Consumes the question.
-    # Returns the search results.
+    # Returns the search results. If the evaluate node has already searched speculatively, its results are used.
     def web_search(self, state):
-        question = state["question"]
-        documents = state["documents"]
-        search_required = state["search_required"]
-        steps = state["steps"]
-        steps.append("web_search")
-        
+        if state["search_results"] is not None:
+            return self._searched(state, state["search_results"])
         # results = web_search_tool.invoke({"query": question})
-        results = self.web_search_tool.search(question)
+        results = self.web_search_tool.search(state["question"])
+        return self._searched(state, self._search_documents(results))
 
-        search_results = [
+    async def aweb_search(self, state):
+        if state["search_results"] is not None:
+            return self._searched(state, state["search_results"])
+        results = await self.web_search_tool.asearch(state["question"])
+        return self._searched(state, self._search_documents(results))
+
+    def _search_documents(self, results):
+        return [
             Document(page_content=doc["content"], metadata={"url": doc["url"]})
             for doc in results
         ]
 
+    def _searched(self, state, search_results):
+        steps = state["steps"]
+        steps.append("web_search")
+
         return {
-            "documents": documents, 
-            "question": question,
-            "search_required": search_required,
+            "documents": state["documents"], 
+            "question": state["question"],
+            "search_required": state["search_required"],
             "search_results": search_results,
             "steps": steps
         }
     
 
+    # Evaluates the documents and, if they are sufficient, answers the question in one call of judge_chain (fused graph mode).
+    # Consumes a state with a question and documents. Returns a new state with search_required, the answer and appended steps
+    def judge(self, state):
+        verdict, search_results = self._speculate(state, self.judge_chain.judge)
+        return self._judged(state, verdict, search_results)
+
+    async def ajudge(self, state):
+        verdict, search_results = await self._aspeculate(state, self.judge_chain.ajudge)
+        return self._judged(state, verdict, search_results)
+
+    def _judged(self, state, verdict, search_results=None):
+        new_state = self._evaluated(state, verdict, search_results, step="judge_retrieval")
+        answer = verdict.get("Answer")
+        if not new_state["search_required"] and answer:
+            new_state["steps"].append("generate_answer")
+            new_state["answer"] = answer
+        return new_state
+
+
     def determine_next_node(self, state):
         return "web_search" if state["search_required"] else "generate"
+
+    def determine_after_judge(self, state):
+        # A "yes" verdict without an answer is answered by the generate node
+        if state["search_required"]:
+            return "web_search"
+        return "end" if state["answer"] else "generate"
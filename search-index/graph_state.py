@@ -18,6 +18,8 @@ class GraphState(TypedDict):
 
     Attributes:
         question: question
+        question_vector: embedding of the question, if the caller has already computed it (optional)
+        labels: labels of the notes the retrieval is restricted to (optional)
         documents: list of retrieved documents
         answer: LLM generated answer
         search_required: whether to search web
@@ -27,6 +29,8 @@ class GraphState(TypedDict):
     """
 
     question: str
+    question_vector: List[float]
+    labels: List[str]
     documents: List[str]
     answer: str
     search_required: bool
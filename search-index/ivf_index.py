@@ -0,0 +1,108 @@
+"""
+Filename: ivf_index.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines an inverted file (IVF) approximate nearest neighbour index for the local vector store.
+Vectors are clustered with spherical k-means; a query scans only the rows of the n_probe clusters closest to it,
+so the search cost grows with n_probe and not with the size of the corpus.
+The local vector store saves its rows grouped by cluster, so every list is a contiguous slice of the vector matrix.
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import os
+import numpy as np
+
+ivf_file = "ivf.npz"
+
+# Number of rows assigned to clusters at a time (bounds the temporary rows x clusters score matrix)
+assign_rows = 16384
+
+
+def assign(vectors, centroids):
+    """Returns the index of the closest centroid (highest dot product) of every row, computed block by block."""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), assign_rows):
+        block = np.asarray(vectors[start:start + assign_rows], dtype=np.float32)
+        labels[start:start + assign_rows] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+class IVFIndex:
+    """
+    A class representing an inverted file index over L2-normalized vectors stored grouped by list.
+
+    Args:
+        centroids (np.ndarray): The (lists x dimensions) float32 matrix of normalized cluster centroids.
+        offsets (np.ndarray): The first row of each list (one more entry than lists, the last one is the number of rows).
+
+    Methods:
+        build(vectors, n_lists) -> (IVFIndex, np.ndarray): Clusters the vectors (class method). Returns the index and the order
+            in which the vectors must be stored.
+        save(path) / load(path): Writes / reads the index file in the given directory.
+        candidates(query, n_probe) -> List[Tuple[int, int]]: Returns the row ranges of the n_probe lists closest to the query.
+    """
+
+    def __init__(self, centroids, offsets):
+        self.centroids = centroids
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, vectors, n_lists=None, iterations=10, sample_size=None, seed=0):
+        """
+        Builds the index. By default uses sqrt(n) lists and trains the centroids on a sample of 64 vectors per list,
+        which keeps the build time reasonable for millions of vectors.
+        """
+        n = len(vectors)
+        n_lists = min(n, n_lists or max(1, int(np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+
+        sample_size = min(n, sample_size or 64 * n_lists)
+        sample = np.asarray(vectors[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            labels = assign(sample, centroids)
+            counts = np.bincount(labels, minlength=n_lists)
+            # Sum the members of every cluster with one pass over the sample sorted by cluster
+            starts = np.cumsum(counts) - counts
+            sums = np.zeros_like(centroids)
+            empty = counts == 0
+            sums[~empty] = np.add.reduceat(sample[np.argsort(labels, kind="stable")], starts[~empty], axis=0)
+            # Empty clusters are restarted from random sample vectors
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        labels = assign(vectors, centroids)
+        order = np.argsort(labels, kind="stable")
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(labels, minlength=n_lists))
+        return cls(centroids, offsets), order
+
+    def save(self, path):
+        np.savez(os.path.join(path, ivf_file), centroids=self.centroids, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(os.path.join(path, ivf_file)) as data:
+            return cls(data["centroids"], data["offsets"])
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, ivf_file))
+
+    @staticmethod
+    def remove(path):
+        if IVFIndex.exists(path):
+            os.remove(os.path.join(path, ivf_file))
+
+    def candidates(self, query, n_probe):
+        n_probe = min(n_probe, len(self.centroids))
+        scores = self.centroids @ query
+        lists = np.sort(np.argpartition(-scores, n_probe - 1)[:n_probe])
+        return [(int(self.offsets[i]), int(self.offsets[i + 1])) for i in lists if self.offsets[i + 1] > self.offsets[i]]
@@ -0,0 +1,91 @@
+"""
+Filename: judge_chain.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines a class that represents a chain which, in a single LLM call, evaluates if retrieved documents are
+sufficient to answer a given query and, if they are, answers it. It replaces the evaluation chain and the main chain
+on the common path of the fused graph mode (one round trip and one copy of the documents instead of two).
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+from langchain.prompts import PromptTemplate
+from langchain_core.output_parsers import JsonOutputParser
+from contextlib import nullcontext
+from llm_scheduler import GENERATE
+from metrics import TokenCounter, timer
+
+class JudgeChain:
+    """
+    A class representing a chain for evaluating if retrieved documents are sufficient to answer a given query and answering it.
+
+    Attributes:
+        provider (str): The provider for the model. Default is "ollama", other option is "openai".
+        temperature (int): The temperature parameter for generating responses. Default is 0.
+        context_packer (ContextPacker): Packs the documents into a compact prompt context. Default is None (documents formatted as they are).
+        scheduler (LLMScheduler): Schedules the async LLM calls (local inference server). Default is None (calls sent directly).
+        prompt (PromptTemplate): The template for generating prompts.
+        llm (ChatOllama or ChatOpenAI): The language model for generating responses.
+        judge_chain (Chain): The chain for generating responses
+
+    Methods:
+        judge(self, question, documents): Returns {"Evaluation": "yes" or "no", "Answer": answer or ""}.
+        ajudge(self, question, documents): Async version of judge.
+
+    """
+
+    def __init__(self, provider = "ollama", temperature = 0, context_packer = None, scheduler = None):
+        self.provider = provider
+        self.temperature = temperature
+        self.context_packer = context_packer
+        self.scheduler = scheduler
+        self.prompt = PromptTemplate(
+            template="""You are an assistant for question-answering tasks.
+            First, carefully evaluate if information in Documents provided below is sufficient for answering User Question.
+            If it is, analyze carefully and use the Documents to answer the User Question. Do not make up an answer.
+            Keep your answer short and to the point.
+            User Question: {question}
+            Documents: {documents}
+            Return JSON with two keys: 'Evaluation' with binary score 'yes' or 'no', and 'Answer' with your answer if the
+            Evaluation is 'yes' or an empty string if it is 'no'. No other keys, values or preambles are allowed.
+
+            JSON:
+            """,
+            input_variables=["question", "documents"],
+        )
+
+        # Only the selected provider's package is imported (they are slow to import)
+        # The token counter records the token usage in the metrics (stream_usage reports it when the graph is streamed too)
+        if self.provider == "openai":
+            from langchain_openai import ChatOpenAI
+            self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=self.temperature, model_kwargs={"response_format": {"type": "json_object"}},
+                                  stream_usage=True, callbacks=[TokenCounter("judge")],
+            )
+        elif self.provider == "ollama":
+            from langchain_ollama import ChatOllama
+            self.llm = ChatOllama(model="llama3.1", temperature=self.temperature, format="json", callbacks=[TokenCounter("judge")])
+        else:
+            raise ValueError("Invalid provider. Please choose 'openai' or 'ollama'.")
+
+        self.judge_chain = self.prompt | self.llm | JsonOutputParser()
+
+    def _context(self, documents):
+        return self.context_packer.pack(documents) if self.context_packer is not None else documents
+
+    def _slot(self):
+        # The call generates an answer, so it is scheduled like the main chain (after the short evaluations)
+        return self.scheduler.slot(GENERATE, "judge") if self.scheduler is not None else nullcontext()
+
+    def judge(self, question, documents):
+        context = self._context(documents)
+        with timer("call", "llm_judge"):
+            return self.judge_chain.invoke({"documents": context, "question": question})
+
+    async def ajudge(self, question, documents):
+        context = self._context(documents)
+        async with self._slot():
+            with timer("call", "llm_judge"):
+                return await self.judge_chain.ainvoke({"documents": context, "question": question})
@@ -0,0 +1,138 @@
+"""
+Filename: llm_scheduler.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines a scheduler of the LLM calls of the chains, in front of a local inference server (Ollama) with a fixed
+number of parallel slots. At most max_parallel calls run at a time and the others wait in a bounded priority queue:
+the short JSON evaluation calls go before the long answer generations, so they do not queue behind them. When the queue
+is full, or a call waits longer than the queue timeout, the call fails at once with SchedulerOverloaded (503 in the API)
+instead of timing out later. The queue wait is recorded separately from the inference time (metrics.py).
+
+Only the async path (the API and the batch mode) is scheduled; the sync path (test-mode) calls the LLM directly.
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import asyncio
+import heapq
+import itertools
+import threading
+from contextlib import asynccontextmanager
+from metrics import llm_rejected, timer
+
+# Priorities of the chains (lower goes first)
+EVALUATE = 0
+GENERATE = 1
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when an LLM call is not admitted: the queue is full or the call waited longer than the queue timeout."""
+
+
+class LLMScheduler:
+    """
+    A class scheduling the LLM calls of the chains by priority, with bounded parallelism and admission control.
+
+    Args:
+        max_parallel (int, optional): The number of calls running at a time - the parallel slots of the server
+            (OLLAMA_NUM_PARALLEL). Defaults to 1.
+        max_queue (int, optional): The maximum number of waiting calls; more are rejected. Defaults to 32.
+        queue_timeout (float, optional): The maximum wait in seconds before a call is rejected. Defaults to 30.
+
+    Attributes:
+        active (int): The number of running calls.
+        waiters (list): The heap of (priority, sequence, future) of the waiting calls.
+
+    Methods:
+        slot(priority, name): Async context manager running the block in a slot. Raises SchedulerOverloaded.
+        stats() -> dict: Returns the running and waiting calls and the numbers of admitted and rejected calls.
+    """
+
+    def __init__(self, max_parallel=1, max_queue=32, queue_timeout=30.0):
+        self.max_parallel = max_parallel
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()  # guards the counters read by stats() from other threads
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    def _release(self):
+        # The slot goes to the first waiting call (the waiters whose wait was cancelled are skipped), or is freed
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        with self.lock:
+            self.active -= 1
+
+    def _remove(self, entry):
+        if entry in self.waiters:
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+
+    async def _acquire(self, priority, name):
+        if self.active < self.max_parallel and not self.waiters:
+            with self.lock:
+                self.active += 1
+                self.admitted += 1
+            return
+
+        if len(self.waiters) >= self.max_queue:
+            with self.lock:
+                self.rejected_full += 1
+            llm_rejected.labels(name, "queue_full").inc()
+            raise SchedulerOverloaded(f"The LLM queue is full ({self.max_queue} calls waiting)")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.sequence), future)
+        heapq.heappush(self.waiters, entry)
+        with self.lock:
+            self.queued += 1
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the wait ended
+                self._release()
+            else:
+                self._remove(entry)
+            if isinstance(e, asyncio.TimeoutError):
+                with self.lock:
+                    self.rejected_timeout += 1
+                llm_rejected.labels(name, "queue_timeout").inc()
+                raise SchedulerOverloaded(f"The LLM call waited more than {self.queue_timeout}s in the queue") from None
+            raise
+        with self.lock:
+            self.admitted += 1
+
+    @asynccontextmanager
+    async def slot(self, priority, name):
+        """Runs the block when a slot is free; name labels the queue wait in the metrics (e.g. "generate")."""
+        with timer("queue", name):
+            await self._acquire(priority, name)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "max_parallel": self.max_parallel,
+                "active": self.active,
+                "waiting": len(self.waiters),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected_queue_full": self.rejected_full,
+                "rejected_queue_timeout": self.rejected_timeout,
+            }
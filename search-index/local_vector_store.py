@@ -0,0 +1,287 @@
+"""
+Filename: local_vector_store.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines an in-process vector store that can replace Azure AI Search in the Retriever.
+Chunk vectors are kept in a contiguous NumPy float32 matrix and queried with a single matrix-vector product.
+Hybrid search fuses the vector ranking with a local BM25 keyword ranking (see bm25_index.py).
+Vectors can be held in memory quantized (float16 or int8 with per-dimension scales), optionally rescoring the best
+candidates exactly with the float32 vectors, which stay memory-mapped on disk.
+For large corpora an IVF index (see ivf_index.py) restricts the scan to the clusters closest to the query.
+Rows are stored grouped by label (within every IVF list), so the chunks of a label are a few contiguous slices of the
+matrix and a search filtered by labels scans only those slices.
+The index files are produced by create-index/build_index.py (--target local).
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import json
+import os
+import numpy as np
+from langchain.schema import Document
+from bm25_index import BM25Index, reciprocal_rank_fusion
+from ivf_index import IVFIndex
+
+vectors_file = "vectors.npy"
+chunks_file = "chunks.jsonl"
+
+
+def normalize(vectors):
+    """L2-normalizes the rows of a matrix, so the dot product of two rows is their cosine similarity."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """Returns the indices of the k highest scores, best first, without sorting the whole array."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def label_order(rows, metadatas):
+    """Returns the rows sorted by the label of their chunk (stable, so the order within a label is kept)."""
+    return np.asarray(sorted(rows, key=lambda row: metadatas[row].get("label", "")), dtype=np.int64)
+
+
+def label_ranges(metadatas):
+    """Returns {label: [(start, end), ...]}: the slices of consecutive rows of every label, in row order."""
+    ranges = {}
+    start = 0
+    for row in range(1, len(metadatas) + 1):
+        label = metadatas[start].get("label", "")
+        if row == len(metadatas) or metadatas[row].get("label", "") != label:
+            ranges.setdefault(label, []).append((start, row))
+            start = row
+    return ranges
+
+
+def range_rows(ranges):
+    return sum(end - start for start, end in ranges)
+
+
+def intersect_ranges(a, b):
+    """Returns the intersection of two sorted lists of disjoint (start, end) slices."""
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start, end = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if start < end:
+            result.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+# Number of rows converted to float32 at a time when scoring quantized vectors (bounds the temporary memory per query)
+block_rows = 1024
+
+
+def quantize(vectors, precision):
+    """
+    Quantizes a float32 matrix (possibly memory-mapped) block by block. Returns (codes, scales):
+    - float16: codes are the float16 vectors, scales is None.
+    - int8: codes are int8 vectors and scales are per-dimension float32 factors, so that vectors ~= codes * scales.
+    """
+    if precision == "float16":
+        codes = np.empty(vectors.shape, dtype=np.float16)
+        for start in range(0, len(vectors), block_rows):
+            codes[start:start + block_rows] = vectors[start:start + block_rows]
+        return codes, None
+
+    if precision == "int8":
+        peaks = np.zeros(vectors.shape[1], dtype=np.float32)
+        for start in range(0, len(vectors), block_rows):
+            np.maximum(peaks, np.abs(vectors[start:start + block_rows]).max(axis=0), out=peaks)
+        scales = np.where(peaks > 0, peaks / 127, 1.0).astype(np.float32)
+        codes = np.empty(vectors.shape, dtype=np.int8)
+        for start in range(0, len(vectors), block_rows):
+            codes[start:start + block_rows] = np.clip(np.rint(vectors[start:start + block_rows] / scales), -127, 127)
+        return codes, scales
+
+    raise ValueError("Invalid precision. Please choose 'float32', 'float16' or 'int8'.")
+
+
+class LocalVectorStore:
+    """
+    A class representing an in-process vector store with cosine similarity search (exact for float32 vectors).
+
+    Args:
+        path (str): The directory with the index files (vectors.npy, chunks.jsonl and the BM25 index).
+        embedding_function (Callable): The function used to embed queries.
+        fetch_k (int, optional): The number of candidates taken from each ranking before fusion in hybrid search. Defaults to 50.
+        precision (str, optional): How vectors are held in memory: "float32", "float16" (2x smaller) or "int8" (4x smaller). Defaults to "float32".
+        rescore (int, optional): For quantized vectors, the number of best candidates rescored with the exact float32 vectors. Defaults to 0 (no rescoring).
+        n_probe (int, optional): The number of IVF lists scanned per query (search breadth), if the index has an IVF index. Defaults to 0 (exact scan).
+
+    Attributes:
+        vectors (np.ndarray): The (chunks x dimensions) matrix of L2-normalized chunk vectors, in the chosen precision.
+        scales (np.ndarray): The per-dimension scales of int8 vectors (None for other precisions).
+        ids (List[str]): The chunk IDs, in the order of the matrix rows.
+        texts (List[str]): The chunk contents.
+        metadatas (List[dict]): The chunk metadata (title, label, note_id, chunk_id).
+        keyword_index (BM25Index): The keyword index over the chunk titles and contents (None for indexes saved without it).
+        ann_index (IVFIndex): The approximate nearest neighbour index (None if not built or n_probe is 0).
+        partitions (dict): Label -> the (start, end) slices of its rows (more slices in indexes saved before rows were grouped by label).
+
+    Methods:
+        save(path, ids, texts, metadatas, vectors, ann_lists): Writes the index files, with an IVF index of ann_lists lists if ann_lists > 0 (static method).
+        similarity_search_with_score(query, k, vector, labels) -> List[Tuple[Document, float]]: Returns the k chunks most similar to the query
+            (only chunks with one of the labels, if given).
+        similarity_search(query, k, vector, labels) -> List[Document]: As above, without the scores.
+        hybrid_search_with_score(query, k, vector, labels) -> List[Tuple[Document, float]]: Returns the k best chunks by RRF of vector and keyword rankings.
+        hybrid_search(query, k, vector, labels) -> List[Document]: As above, without the scores.
+        labels() -> List[str]: Returns the labels of the chunks.
+        memory_bytes() -> int: Returns the memory held by the vectors.
+    """
+
+    def __init__(self, path, embedding_function, fetch_k=50, precision="float32", rescore=0, n_probe=0):
+        self.path = path
+        self.embedding_function = embedding_function
+        self.fetch_k = fetch_k
+        self.precision = precision
+        self.rescore = rescore
+        self.n_probe = n_probe
+
+        if precision == "float32":
+            self.vectors = np.ascontiguousarray(np.load(os.path.join(path, vectors_file)), dtype=np.float32)
+            self.scales = None
+            self.full_vectors = self.vectors
+        else:
+            # The float32 vectors stay on disk - only the rows of rescored candidates are ever read
+            self.full_vectors = np.load(os.path.join(path, vectors_file), mmap_mode="r")
+            self.vectors, self.scales = quantize(self.full_vectors, precision)
+        self.ids = []
+        self.texts = []
+        self.metadatas = []
+        with open(os.path.join(path, chunks_file), "r", encoding="utf-8") as f:
+            for line in f:
+                chunk = json.loads(line)
+                self.ids.append(chunk["id"])
+                self.texts.append(chunk["content"])
+                self.metadatas.append(chunk["metadata"])
+
+        if len(self.ids) != self.vectors.shape[0]:
+            raise ValueError(f"Local index {path} is corrupted: {len(self.ids)} chunks but {self.vectors.shape[0]} vectors.")
+
+        self.keyword_index = BM25Index.load(path) if BM25Index.exists(path) else None
+        self.ann_index = IVFIndex.load(path) if n_probe > 0 and IVFIndex.exists(path) else None
+        self.partitions = label_ranges(self.metadatas)
+
+    @staticmethod
+    def save(path, ids, texts, metadatas, vectors, ann_lists=0):
+        os.makedirs(path, exist_ok=True)
+        vectors = normalize(vectors)
+        # An IVF index of a previous build would not match the new rows, so it is always rebuilt or removed
+        if ann_lists > 0:
+            ann_index, order = IVFIndex.build(vectors, ann_lists)
+            ann_index.save(path)
+            # Rows are stored grouped by IVF list, so every list is a contiguous slice of the matrix, and by label within a list
+            offsets = ann_index.offsets
+            order = np.concatenate([label_order(order[offsets[i]:offsets[i + 1]], metadatas) for i in range(len(offsets) - 1)])
+        else:
+            IVFIndex.remove(path)
+            order = label_order(range(len(ids)), metadatas)
+        vectors = vectors[order]
+        ids = [ids[i] for i in order]
+        texts = [texts[i] for i in order]
+        metadatas = [metadatas[i] for i in order]
+        np.save(os.path.join(path, vectors_file), vectors)
+        with open(os.path.join(path, chunks_file), "w", encoding="utf-8") as f:
+            for cid, text, metadata in zip(ids, texts, metadatas):
+                f.write(json.dumps({"id": cid, "content": text, "metadata": metadata}, ensure_ascii=False) + "\n")
+
+        # Azure searches the title field next to the content, so the keyword index covers both
+        BM25Index.build([f"{metadata.get('title', '')}\n{text}" for text, metadata in zip(texts, metadatas)]).save(path)
+
+    def _document(self, row, similarity):
+        # The cosine similarity of the chunk to the query is kept in the metadata (used e.g. by ScoreEvaluator)
+        return Document(page_content=self.texts[row], metadata=dict(self.metadatas[row], similarity=similarity))
+
+    def labels(self):
+        return sorted(self.partitions)
+
+    def _label_ranges(self, labels):
+        """Returns the sorted slices of the rows with one of the labels."""
+        return sorted(r for label in set(labels) for r in self.partitions.get(label, []))
+
+    def memory_bytes(self):
+        return self.vectors.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def _scores(self, query, vectors):
+        """Returns the (approximate for quantized vectors) cosine similarity of the vectors to the normalized query."""
+        if self.precision == "float32":
+            return vectors @ query
+        # For int8 the scales are folded into the query: (codes * scales) @ query == codes @ (scales * query)
+        query = query * self.scales if self.scales is not None else query
+        scores = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), block_rows):
+            scores[start:start + block_rows] = vectors[start:start + block_rows].astype(np.float32) @ query
+        return scores
+
+    def search_by_vector(self, vector, k, labels=None):
+        """Returns a list of (row, score) for the k rows most similar to the vector (among the rows with one of the labels, if given)."""
+        query = normalize(vector)
+        ranges = self._label_ranges(labels) if labels else None
+        if self.ann_index is not None:
+            # With the IVF index only the rows of the closest lists (contiguous slices) are scored. With labels the lists
+            # narrow the slices of the labels only if these have more rows and at least k of them are left; otherwise
+            # the rows of the labels are scanned exactly.
+            candidates = self.ann_index.candidates(query, self.n_probe)
+            if ranges is None:
+                ranges = candidates
+            elif range_rows(ranges) > range_rows(candidates):
+                narrowed = intersect_ranges(candidates, ranges)
+                if range_rows(narrowed) >= k:
+                    ranges = narrowed
+        if ranges is not None:
+            # Only the slices of the labels and / or lists are scored
+            if not ranges:
+                return []
+            rows = np.concatenate([np.arange(start, end) for start, end in ranges])
+            scores = np.concatenate([self._scores(query, self.vectors[start:end]) for start, end in ranges])
+        else:
+            rows = None
+            scores = self._scores(query, self.vectors)
+        if self.precision == "float32" or not self.rescore:
+            best = top_k(scores, k)
+            return [(int(rows[i] if rows is not None else i), float(scores[i])) for i in best]
+
+        # Rescore the best candidates with the exact vectors (sorted rows read the memory-mapped file sequentially)
+        candidates = top_k(scores, max(self.rescore, k))
+        candidates = np.sort(rows[candidates] if rows is not None else candidates)
+        exact = np.asarray(self.full_vectors[candidates], dtype=np.float32) @ query
+        best = top_k(exact, k)
+        return [(int(candidates[i]), float(exact[i])) for i in best]
+
+    # The search methods take an optional query vector, if the caller has already embedded the query (e.g. asynchronously)
+    def similarity_search_with_score(self, query, k=4, vector=None, labels=None):
+        vector = self.embedding_function(query) if vector is None else vector
+        return [(self._document(row, score), score) for row, score in self.search_by_vector(vector, k, labels)]
+
+    def similarity_search(self, query, k=4, vector=None, labels=None):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, vector, labels)]
+
+    def hybrid_search_with_score(self, query, k=4, vector=None, labels=None):
+        if self.keyword_index is None:
+            raise ValueError(f"Local index {self.path} has no keyword index - rebuild it with build_index.py to use hybrid search.")
+        vector = self.embedding_function(query) if vector is None else vector
+        fetch_k = max(self.fetch_k, k)
+        vector_rows = [row for row, _ in self.search_by_vector(vector, fetch_k, labels)]
+        keyword_rows = [row for row, _ in self.keyword_index.search(query, fetch_k, self._label_ranges(labels) if labels else None)]
+        fused = reciprocal_rank_fusion([vector_rows, keyword_rows])[:k]
+        # Exact similarities of the fused rows (keyword-only rows have none from the vector search)
+        similarities = np.asarray(self.full_vectors[[row for row, _ in fused]], dtype=np.float32) @ normalize(vector)
+        return [(self._document(row, float(similarity)), score) for (row, score), similarity in zip(fused, similarities)]
+
+    def hybrid_search(self, query, k=4, vector=None, labels=None):
+        return [doc for doc, _ in self.hybrid_search_with_score(query, k, vector, labels)]
@@ -10,10 +10,11 @@ Description: Defines a class that represents a main chain for question-answering
 Copyright (c) 2024 Szymon Manduk AI.
 """
 
-from langchain_ollama import ChatOllama
-from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from contextlib import nullcontext
+from llm_scheduler import GENERATE
+from metrics import TokenCounter, timer
 
 class MainChain:
     """
@@ -22,17 +23,22 @@ class MainChain:
     Attributes:
         provider (str): The provider for the question-answering model. Default is "ollama", other option is "openai".
         temperature (int): The temperature parameter for generating responses. Default is 0.
+        context_packer (ContextPacker): Packs the documents into a compact prompt context. Default is None (documents formatted as they are).
+        scheduler (LLMScheduler): Schedules the async LLM calls (local inference server). Default is None (calls sent directly).
         prompt (PromptTemplate): The template for generating prompts.
         llm (ChatOllama or ChatOpenAI): The language model for generating responses.
         chain (Chain): The chain for generating responses
 
     Methods:
         generate(self, question, documents): Generates a response for the given question and documents.
+        agenerate(self, question, documents): Async version of generate.
 
     """
-    def __init__(self, provider = "ollama", temperature = 0):
+    def __init__(self, provider = "ollama", temperature = 0, context_packer = None, scheduler = None):
         self.provider = provider
         self.temperature = temperature
+        self.context_packer = context_packer
+        self.scheduler = scheduler
         self.prompt = PromptTemplate(
             template="""You are an assistant for question-answering tasks. 
             Analyze carefully and use the following documents to answer the user question. 
@@ -45,14 +51,32 @@ class MainChain:
             input_variables=["question", "documents"],
         )
         
+        # Only the selected provider's package is imported (they are slow to import)
+        # The token counter records the token usage in the metrics (stream_usage reports it when the answer is streamed too)
         if self.provider == "openai":
-            self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=self.temperature)
+            from langchain_openai import ChatOpenAI
+            self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=self.temperature, stream_usage=True, callbacks=[TokenCounter("generate")])
         elif self.provider == "ollama":
-            self.llm = ChatOllama(model="llama3.1", temperature=self.temperature)
+            from langchain_ollama import ChatOllama
+            self.llm = ChatOllama(model="llama3.1", temperature=self.temperature, callbacks=[TokenCounter("generate")])
         else:
             raise ValueError("Invalid provider. Please choose 'openai' or 'ollama'.")
         
         self.chain = self.prompt | self.llm | StrOutputParser()
     
+    def _context(self, documents):
+        return self.context_packer.pack(documents) if self.context_packer is not None else documents
+
+    def _slot(self):
+        return self.scheduler.slot(GENERATE, "generate") if self.scheduler is not None else nullcontext()
+
     def generate(self, question, documents):
-        return self.chain.invoke({"documents": documents, "question": question})
+        context = self._context(documents)
+        with timer("call", "llm_generate"):
+            return self.chain.invoke({"documents": context, "question": question})
+
+    async def agenerate(self, question, documents):
+        context = self._context(documents)
+        async with self._slot():
+            with timer("call", "llm_generate"):
+                return await self.chain.ainvoke({"documents": context, "question": question})
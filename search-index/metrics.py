@@ -0,0 +1,196 @@
+"""
+Filename: metrics.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines the in-process instrumentation of the search API, exposed on /metrics in the Prometheus format:
+- search_node_seconds: wall time of every graph node,
+- search_call_seconds: wall time of every outbound call (embedding, search, LLM, web search) and its outcome,
+- search_answer_seconds: wall time of a whole answer, from the graph or the answer cache,
+- search_llm_queue_seconds and search_llm_rejected_total: wait of the LLM calls in the scheduler queue (llm_scheduler.py)
+  and the calls it rejected,
+- search_llm_tokens_total: prompt and completion tokens of the LLM calls (counted by a LangChain callback),
+- search_embedding_batch_size and search_embedding_batch_wait_seconds: texts of the batched query embedding requests and
+  the wait of the questions for their batch (embedding_batcher.py),
+- search_answer_cache_lookups_total: hits and misses of the answer cache,
+- search_embedding_cache_lookups_total, search_web_search_cache_lookups_total: hits and misses of the embedding cache and
+  of the web search cache (their own counters, see StatsCollector).
+The timings of a single request can also be collected (start_timings) and returned with its answer.
+
+Every gunicorn worker has its own metrics. To serve the metrics of all workers from any of them, set PROMETHEUS_MULTIPROC_DIR
+to an empty directory before the start (the embedding cache counters are then those of the worker serving /metrics).
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+import time
+from contextlib import contextmanager
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+node_seconds = Histogram("search_node_seconds", "Wall time of the graph nodes", ["node"], buckets=buckets)
+call_seconds = Histogram("search_call_seconds", "Wall time of the outbound calls", ["call", "outcome"], buckets=buckets)
+llm_queue_seconds = Histogram("search_llm_queue_seconds", "Wait of the LLM calls in the scheduler queue", ["chain"], buckets=buckets)
+llm_rejected = Counter("search_llm_rejected", "LLM calls rejected by the scheduler", ["chain", "reason"])
+answer_seconds = Histogram("search_answer_seconds", "Wall time of the answers", ["source"], buckets=buckets)
+llm_tokens = Counter("search_llm_tokens", "Tokens of the LLM calls", ["chain", "kind"])
+answer_cache_lookups = Counter("search_answer_cache_lookups", "Lookups of the answer cache", ["result"])
+embedding_batch_size = Histogram("search_embedding_batch_size", "Texts of the batched query embedding requests", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+embedding_batch_wait_seconds = Histogram("search_embedding_batch_wait_seconds", "Wait of the query embeddings for their batch",
+                                         buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+
+# Collectors of this process added to the metrics (see StatsCollector)
+process_collectors = []
+
+# The timings of the current request (a list shared by the tasks and threads the request starts), None outside requests
+current_timings = contextvars.ContextVar("current_timings", default=None)
+
+
+def start_timings():
+    """Starts collecting the timings of the current request. Returns the list the timings are appended to."""
+    timings = []
+    current_timings.set(timings)
+    return timings
+
+
+@contextmanager
+def timer(kind, name):
+    """Times the block into the histogram of its kind ("node", "call" or "queue") and into the timings of the current request."""
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except asyncio.CancelledError:
+        # e.g. a speculative web search that was not needed
+        outcome = "cancelled"
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        if kind == "node":
+            node_seconds.labels(name).observe(seconds)
+        elif kind == "queue":
+            llm_queue_seconds.labels(name).observe(seconds)
+        else:
+            call_seconds.labels(name, outcome).observe(seconds)
+        timings = current_timings.get()
+        if timings is not None:
+            timings.append({"kind": kind, "name": name, "ms": round(seconds * 1000, 1), "outcome": outcome})
+
+
+def timed_node(name, func):
+    """Wraps a sync graph node so its wall time is recorded."""
+    @functools.wraps(func)
+    def node(state):
+        with timer("node", name):
+            return func(state)
+    return node
+
+
+def atimed_node(name, afunc):
+    """Wraps an async graph node so its wall time is recorded."""
+    @functools.wraps(afunc)
+    async def node(state):
+        with timer("node", name):
+            return await afunc(state)
+    return node
+
+
+def record_answer_cache(hit):
+    answer_cache_lookups.labels("hit" if hit else "miss").inc()
+
+
+def record_embedding_wait(seconds):
+    """Records the wait of a query embedding for its batch, also in the timings of the current request."""
+    embedding_batch_wait_seconds.observe(seconds)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.append({"kind": "queue", "name": "embedding_batch", "ms": round(seconds * 1000, 1), "outcome": "ok"})
+
+
+class TokenCounter(BaseCallbackHandler):
+    """
+    A LangChain callback handler counting the prompt and completion tokens of the LLM calls of a chain.
+
+    Args:
+        chain (str): The chain label of the counts (e.g. "generate" or "evaluate").
+    """
+
+    def __init__(self, chain):
+        self.chain = chain
+
+    def on_llm_end(self, response, **kwargs):
+        usage = {}
+        for generations in response.generations:
+            for generation in generations:
+                # Chat models report usage_metadata on the message (also when streaming, if enabled)
+                metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if metadata:
+                    usage["prompt"] = usage.get("prompt", 0) + metadata.get("input_tokens", 0)
+                    usage["completion"] = usage.get("completion", 0) + metadata.get("output_tokens", 0)
+        if not usage and response.llm_output:
+            token_usage = response.llm_output.get("token_usage") or {}
+            usage = {"prompt": token_usage.get("prompt_tokens", 0), "completion": token_usage.get("completion_tokens", 0)}
+        for kind, tokens in usage.items():
+            if tokens:
+                llm_tokens.labels(self.chain, kind).inc(tokens)
+
+
+class StatsCollector:
+    """
+    A Prometheus collector exposing the hit and miss counters of a cache with a stats() method (e.g. CachedEmbeddings),
+    so the cache itself needs no instrumentation.
+
+    Args:
+        name (str): The metric name (search_<name>_lookups_total).
+        stats (callable): Returns a dict with the counters.
+        results (dict, optional): Result label -> counter key of the stats. Defaults to {"hit": "hits", "miss": "misses"}.
+    """
+
+    def __init__(self, name, stats, results=None):
+        self.name = name
+        self.stats = stats
+        self.results = results or {"hit": "hits", "miss": "misses"}
+
+    def collect(self):
+        stats = self.stats()
+        family = CounterMetricFamily(f"search_{self.name}_lookups", f"Lookups of the {self.name.replace('_', ' ')}", labels=["result"])
+        for result, key in self.results.items():
+            family.add_metric([result], stats[key])
+        yield family
+
+
+def register_stats(name, stats, results=None):
+    collector = StatsCollector(name, stats, results)
+    process_collectors.append(collector)
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        REGISTRY.register(collector)
+
+
+def render():
+    """Returns the metrics in the Prometheus text format and its content type."""
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    # The metrics of all workers, aggregated from the files they write
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    for collector in process_collectors:
+        registry.register(collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Removes the live metrics of an exited worker (gunicorn child_exit hook)."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid)
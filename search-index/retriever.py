@@ -5,18 +5,40 @@ Author: Szymon Manduk
 
 Company: Szymon Manduk AI, manduk.ai
 
-Description: Defines a class that retrieves documents from Azure AI Seearch based on a given question.
+Description: Defines a class that retrieves documents from Azure AI Seearch (or a local vector index) based on a given question.
+The search can be restricted to notes with given labels: the filter is pushed down to Azure AI Search (the label field is
+filterable), and the local index scans only the slices of rows of those labels.
 
 Copyright (c) 2024 Szymon Manduk AI.
 """
 
-from langchain_openai import OpenAIEmbeddings
-from langchain_openai import AzureOpenAIEmbeddings
-from langchain_community.vectorstores.azuresearch import AzureSearch
+import asyncio
+import os
+import numpy as np
+from embedding_cache import CachedEmbeddings
+from embedding_batcher import BatchingEmbeddings
+from metrics import timer
+from local_vector_store import normalize
+from bm25_index import tokenize
+
+
+def label_filter(labels):
+    """Returns the OData filter of Azure AI Search matching the chunks with one of the labels."""
+    values = [label.replace("'", "''") for label in labels]
+    if any("|" in value for value in values):
+        return " or ".join(f"label eq '{value}'" for value in values)
+    return f"search.in(label, '{'|'.join(values)}', '|')"
+
+
+def detect_labels(question, labels):
+    """Returns the labels mentioned in the question: all the words of a label occur in it, in any case."""
+    words = set(tokenize(question))
+    return [label for label in labels if tokenize(label) and set(tokenize(label)) <= words]
+
 
 class Retriever:
     """
-    A class that retrieves documents from Azure AI Search based on a given question.
+    A class that retrieves documents from Azure AI Search (or a local vector index) based on a given question.
 
     Args:
         openai_api_key (str): The API key for OpenAI.
@@ -28,18 +50,34 @@ class Retriever:
         vector_store_index (str): The index name of the vector store.
         retrieved_documents (int, optional): The number of documents to retrieve. Defaults to 3.
         search_type (str, optional): The type of search to perform. Defaults to "hybrid". Other option is "similarity".
+        embedding_cache_path (str, optional): The path of the on-disk embedding cache (see CachedEmbeddings). Defaults to None (no cache).
+        backend (str, optional): The search backend: "azure" (Azure AI Search) or "local" (LocalVectorStore). Defaults to "azure".
+        local_index_path (str, optional): The directory of the local index built by build_index.py. Required for the local backend.
+        local_precision (str, optional): How the local backend holds vectors in memory: "float32", "float16" or "int8". Defaults to "float32".
+        local_rescore (int, optional): The number of candidates the local backend rescores exactly when vectors are quantized. Defaults to 0.
+        local_n_probe (int, optional): The number of IVF lists the local backend scans per query (needs an index built with --ann-lists). Defaults to 0 (exact scan).
+        embedding_dimensions (int, optional): The dimensions of the embedding model. Defaults to 1536 (text-embedding-ada-002).
+        embedding_batch_window_ms (float, optional): The window in which concurrent question embeddings are collected into one request
+            (see BatchingEmbeddings). Defaults to 0 (every question is embedded on its own).
+        embedding_batch_size (int, optional): The number of questions which sends a batch at once. Defaults to 64.
 
     Attributes:
         embeddings (Embeddings): The embedding function used for querying.
-        vector_store (AzureSearch): The vector store interface for document search.
-        retriever (Retriever): The retriever object for invoking searches.
+        embedding_batcher (BatchingEmbeddings): The batcher of the question embeddings (None if batching is off).
+        vector_store (AzureSearch or LocalVectorStore): The vector store interface for document search
+            (Azure backend: only for search types other than similarity and hybrid, None otherwise).
+        retriever (Retriever): The retriever object for invoking searches (Azure backend, search types other than similarity and hybrid).
 
     Methods:
-        retrieve(question: str) -> List[Document]:
-            Retrieves documents based on the given question.
+        retrieve(question: str, vector: List[float] = None, labels: List[str] = None) -> List[Document]:
+            Retrieves documents based on the given question (and its embedding, if already computed), only from notes with one of the labels if given.
+            For the similarity and hybrid search types the metadata of every document has the search "score" and the cosine "similarity" of the chunk to the question.
+        aretrieve(question: str, vector: List[float] = None, labels: List[str] = None) -> List[Document]:
+            Async version of retrieve - the embedding and the search do not block the event loop.
+        labels() -> List[str]: Returns the labels of the indexed notes (local backend), None if they are not known (Azure backend).
     """
 
-    def __init__(self, openai_api_key, open_ai_api_version, embedding_model_name, embedding_provider, vector_store_address, vector_store_password, vector_store_index, retrieved_documents=3, search_type="hybrid"):
+    def __init__(self, openai_api_key, open_ai_api_version, embedding_model_name, embedding_provider, vector_store_address, vector_store_password, vector_store_index, retrieved_documents=3, search_type="hybrid", embedding_cache_path=None, backend="azure", local_index_path=None, local_precision="float32", local_rescore=0, local_n_probe=0, embedding_dimensions=1536, embedding_batch_window_ms=0, embedding_batch_size=64):
         self.openai_api_key = openai_api_key
         self.openai_api_version = open_ai_api_version
         self.model = embedding_model_name
@@ -48,8 +86,11 @@ class Retriever:
         self.vector_store_index = vector_store_index
         self.retrieved_documents = retrieved_documents
         self.search_type = search_type
+        self.backend = backend
         
+        # Provider and vector store packages are imported only when used (they are slow to import)
         if embedding_provider == "openai":
+            from langchain_openai import OpenAIEmbeddings
             self.embeddings = OpenAIEmbeddings(
             openai_api_key=self.openai_api_key,
             openai_api_version=self.openai_api_version,
@@ -58,6 +99,7 @@ class Retriever:
         elif embedding_provider == "azure":
             #ToDo: Add token provider
             print("Add token provider!")
+            from langchain_openai import AzureOpenAIEmbeddings
             self.embeddings = AzureOpenAIEmbeddings(
             model=self.model,
             azure_endpoint=self.vector_store_address,
@@ -65,15 +107,152 @@ class Retriever:
             )
         else:
             raise ValueError("Invalid embedding provider. Please choose 'openai' or 'azure'.")
+
+        # Concurrent questions are embedded in batches. The batcher goes under the cache, so cached questions do not wait for a batch.
+        self.embedding_batcher = None
+        if embedding_batch_window_ms > 0:
+            self.embedding_batcher = self.embeddings = BatchingEmbeddings(self.embeddings, window_ms=embedding_batch_window_ms, max_batch_size=embedding_batch_size)
+
+        # Repeated questions are embedded only once
+        if embedding_cache_path:
+            self.embeddings = CachedEmbeddings(self.embeddings, self.model, embedding_cache_path)
         
-        self.vector_store = AzureSearch(
-            azure_search_endpoint=self.vector_store_address,
-            azure_search_key=self.vector_store_password,
-            index_name=self.vector_store_index,
-            embedding_function=self.embeddings.embed_query,
-        )
-        
-        self.retriever = self.vector_store.as_retriever(k=self.retrieved_documents, search_type=self.search_type)
+        if self.backend == "azure":
+            # Similarity and hybrid searches are sent by the retriever's own search clients, created on first use (so in
+            # every worker process), and constructing the retriever calls no service. AzureSearch checks the index and
+            # embeds a probe text when it is created, so it is only built for the other search types.
+            self.vector_store = None
+            self.retriever = None
+            if self.search_type not in ("similarity", "hybrid"):
+                from langchain_community.vectorstores.azuresearch import AzureSearch
+
+                # Passing the Embeddings object (not its embed_query) lets the vector store embed queries asynchronously too
+                self.vector_store = AzureSearch(
+                    azure_search_endpoint=self.vector_store_address,
+                    azure_search_key=self.vector_store_password,
+                    index_name=self.vector_store_index,
+                    embedding_function=self.embeddings,
+                    vector_search_dimensions=embedding_dimensions,
+                )
+                self.retriever = self.vector_store.as_retriever(k=self.retrieved_documents, search_type=self.search_type)
+        elif self.backend == "local":
+            if self.search_type not in ("similarity", "hybrid"):
+                raise ValueError("The local backend supports only the 'similarity' and 'hybrid' search types.")
+            from local_vector_store import LocalVectorStore
+            self.vector_store = LocalVectorStore(local_index_path, self.embeddings.embed_query, precision=local_precision, rescore=local_rescore, n_probe=local_n_probe)
+            self.retriever = None
+        else:
+            raise ValueError("Invalid backend. Please choose 'azure' or 'local'.")
+
+        # Azure search clients: the sync one is created in the process that uses it, the async one in the event loop that uses it
+        self.search_client = None
+        self.search_client_pid = None
+        self.async_client = None
+        self.async_client_loop = None
     
-    def retrieve(self, question):
-        return self.retriever.invoke(question)
+    def labels(self):
+        return self.vector_store.labels() if self.backend == "local" else None
+
+    def retrieve(self, question, vector=None, labels=None):
+        if self.backend == "azure" and self.search_type not in ("similarity", "hybrid"):
+            # Other Azure search types (e.g. semantic_hybrid) go through the LangChain retriever, without scores
+            with timer("call", "search"):
+                return self.retriever.invoke(question, **self._retriever_filters(labels))
+
+        if vector is None:
+            with timer("call", "embedding"):
+                vector = self.embeddings.embed_query(question)
+        with timer("call", "search"):
+            if self.backend == "local":
+                return self._local_search(question, vector, labels)
+            results = self._search_client().search(**self._azure_query(question, vector, labels))
+            return [self._azure_document(result, vector) for result in results]
+
+    def _retriever_filters(self, labels):
+        return {"filters": label_filter(labels)} if labels else {}
+
+    def _local_search(self, question, vector, labels=None):
+        search = self.vector_store.hybrid_search_with_score if self.search_type == "hybrid" else self.vector_store.similarity_search_with_score
+        documents = []
+        for doc, score in search(question, self.retrieved_documents, vector, labels):
+            doc.metadata["score"] = score
+            documents.append(doc)
+        return documents
+
+    def _azure_query(self, question, vector, labels=None):
+        # The same query as AzureSearch.hybrid_search / vector_search (a vector-only search has empty search text)
+        from azure.search.documents.models import VectorizedQuery
+        from langchain_community.vectorstores.azuresearch import FIELDS_CONTENT_VECTOR
+
+        query = {
+            "search_text": question if self.search_type == "hybrid" else "",
+            "vector_queries": [VectorizedQuery(vector=np.asarray(vector, dtype=np.float32).tolist(), k_nearest_neighbors=self.retrieved_documents, fields=FIELDS_CONTENT_VECTOR)],
+            "top": self.retrieved_documents,
+        }
+        if labels:
+            # The filter is applied before the nearest neighbour search, so the k neighbours all have one of the labels
+            query["filter"] = label_filter(labels)
+            query["vector_filter_mode"] = "preFilter"
+        return query
+
+    def _azure_document(self, result, vector):
+        """
+        Converts a search result to a Document, with the search score (RRF for hybrid search) and the cosine similarity
+        of the chunk to the question (the index returns the chunk vectors) in the metadata, like the local backend does.
+        """
+        from langchain_community.vectorstores.azuresearch import FIELDS_CONTENT_VECTOR, _result_to_document
+
+        chunk_vector = result.get(FIELDS_CONTENT_VECTOR)
+        doc = _result_to_document(result)
+        doc.metadata["score"] = result["@search.score"]
+        if chunk_vector:
+            doc.metadata["similarity"] = float(normalize(chunk_vector) @ normalize(vector))
+        return doc
+
+    def _search_client(self):
+        # Connections must not be shared by processes (e.g. gunicorn workers forked from the master), so every process creates its own client
+        from azure.core.credentials import AzureKeyCredential
+        from azure.search.documents import SearchClient
+
+        if self.search_client is None or self.search_client_pid != os.getpid():
+            self.search_client = SearchClient(
+                endpoint=self.vector_store_address,
+                index_name=self.vector_store_index,
+                credential=AzureKeyCredential(self.vector_store_password),
+                user_agent="langchain",
+            )
+            self.search_client_pid = os.getpid()
+        return self.search_client
+
+    def _async_search_client(self):
+        # AzureSearch opens and closes its async client around every call, so concurrent searches would close each other's
+        # connections. We keep one client (and its connection pool) per event loop instead.
+        from azure.core.credentials import AzureKeyCredential
+        from azure.search.documents.aio import SearchClient
+
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self.async_client_loop is not loop:
+            self.async_client = SearchClient(
+                endpoint=self.vector_store_address,
+                index_name=self.vector_store_index,
+                credential=AzureKeyCredential(self.vector_store_password),
+                user_agent="langchain",
+            )
+            self.async_client_loop = loop
+        return self.async_client
+
+    async def aretrieve(self, question, vector=None, labels=None):
+        if self.backend == "azure" and self.search_type not in ("similarity", "hybrid"):
+            # Other Azure search types (e.g. semantic_hybrid) go through the LangChain retriever in a thread
+            with timer("call", "search"):
+                return await asyncio.to_thread(self.retriever.invoke, question, **self._retriever_filters(labels))
+
+        if vector is None:
+            with timer("call", "embedding"):
+                vector = await self.embeddings.aembed_query(question)
+        with timer("call", "search"):
+            if self.backend == "local":
+                # The in-process search is CPU-bound, so it runs in a thread (NumPy releases the GIL)
+                return await asyncio.to_thread(self._local_search, question, vector, labels)
+            results = await self._async_search_client().search(**self._azure_query(question, vector, labels))
+            return [self._azure_document(result, vector) async for result in results]
@@ -0,0 +1,124 @@
+"""
+Filename: score_evaluator.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines an evaluator that decides if the retrieved documents are sufficient to answer a question from their
+retrieval scores, and calls the LLM evaluation chain only when the score is ambiguous. It has the interface of EvalChain,
+so it can replace it in GraphOperations. The thresholds are fitted on a labeled question set with calibrate_thresholds.py.
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import threading
+
+
+def top_score(documents, score_key="similarity"):
+    """Returns the best score of the documents (None if no document has one)."""
+    scores = [doc.metadata[score_key] for doc in documents if doc.metadata.get(score_key) is not None]
+    return max(scores) if scores else None
+
+
+def calibrate(scores, labels, precision=0.95):
+    """
+    Fits the thresholds on labeled examples (labels: True if the documents were sufficient).
+    high is the lowest score above which at least `precision` of the examples are sufficient,
+    low is the highest score below which at least `precision` of the examples are insufficient.
+    Returns (low, high); low is None / high is None if no threshold reaches the precision.
+    """
+    examples = sorted(zip(scores, labels))
+    n = len(examples)
+
+    high = None
+    sufficient = 0
+    # Walk down from the top score, the examples at and above examples[i] are decided as sufficient
+    for i in range(n - 1, -1, -1):
+        sufficient += examples[i][1]
+        if i > 0 and examples[i - 1][0] == examples[i][0]:
+            continue
+        if sufficient / (n - i) >= precision:
+            high = examples[i][0]
+
+    low = None
+    insufficient = 0
+    # Walk up from the lowest score, the examples below examples[i + 1] are decided as insufficient
+    for i in range(n):
+        insufficient += not examples[i][1]
+        if i < n - 1 and examples[i + 1][0] == examples[i][0]:
+            continue
+        if insufficient / (i + 1) >= precision:
+            low = examples[i + 1][0] if i < n - 1 else float("inf")
+
+    # The bands must not overlap
+    if low is not None and high is not None and low > high:
+        low = high
+    return low, high
+
+
+class ScoreEvaluator:
+    """
+    A class evaluating if retrieved documents are sufficient to answer a question from their retrieval scores.
+
+    Args:
+        eval_chain (EvalChain): The LLM evaluation chain used when the score is between the thresholds.
+        low (float, optional): Below this best score the documents are insufficient. Defaults to None (never decided by score).
+        high (float, optional): At or above this best score the documents are sufficient. Defaults to None (never decided by score).
+        score_key (str, optional): The metadata key of the score. Defaults to "similarity" (cosine similarity of the chunk
+            to the question, set by the Retriever for both backends).
+
+    Methods:
+        evaluate(question, documents) -> dict: Returns {"Evaluation": "yes" or "no"} like EvalChain.evaluate.
+        aevaluate(question, documents) -> dict: Async version of evaluate.
+        decide(documents) -> str or None: Returns "yes" / "no" if the best score decides, None if the LLM must decide.
+        decide_score(score) -> str or None: As above, for a given best score.
+        stats() -> dict: Returns the numbers of evaluations decided by the score and by the LLM.
+    """
+
+    def __init__(self, eval_chain, low=None, high=None, score_key="similarity"):
+        self.eval_chain = eval_chain
+        self.low = low
+        self.high = high
+        self.score_key = score_key
+        self.counts = {"score_yes": 0, "score_no": 0, "llm": 0}
+        self.lock = threading.Lock()
+
+    def _count(self, counter):
+        with self.lock:
+            self.counts[counter] += 1
+
+    def decide(self, documents):
+        return self.decide_score(top_score(documents, self.score_key))
+
+    def decide_score(self, score):
+        if score is None:
+            return None
+        if self.high is not None and score >= self.high:
+            return "yes"
+        if self.low is not None and score < self.low:
+            return "no"
+        return None
+
+    def evaluate(self, question, documents):
+        decision = self.decide(documents)
+        if decision is not None:
+            self._count(f"score_{decision}")
+            return {"Evaluation": decision}
+        self._count("llm")
+        return self.eval_chain.evaluate(question, documents)
+
+    async def aevaluate(self, question, documents):
+        decision = self.decide(documents)
+        if decision is not None:
+            self._count(f"score_{decision}")
+            return {"Evaluation": decision}
+        self._count("llm")
+        return await self.eval_chain.aevaluate(question, documents)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        total = sum(stats.values())
+        stats["llm_calls_saved_rate"] = round((total - stats["llm"]) / total, 4) if total else 0.0
+        return stats
@@ -6,35 +6,67 @@ Author: Szymon Manduk
 Company: Szymon Manduk AI, manduk.ai
 
 Description: Main script for the search engine. It defines:
-- The retriever class that retrieves documents from Azure AI Search based on a given question.
+- The retriever class that retrieves documents from Azure AI Search based on a given question (optionally only from notes
+  with given labels, or the labels mentioned in the question with auto_label).
 - The main chain class that generates an answer based on the retrieved documents.
-- The evaluation chain class that evaluates if the retrieved documents are sufficient to answer the question.
-- The web search tool class that performs a web search for additional information.
+- The judge chain class that evaluates the documents and answers in one call (fused graph mode, GRAPH_MODE=fused).
+- The evaluation chain class that evaluates if the retrieved documents are sufficient to answer the question
+  (optionally behind the score evaluator, which decides clear cases from the retrieval scores without the LLM).
+- The web search tool class that performs a web search for additional information (behind a cache which also coalesces
+  concurrent identical searches).
+- The LLM scheduler that queues the LLM calls of both chains for a local inference server (Ollama), evaluations first.
 - The graph builder that builds the graph of operations.
 - The graph operations that define the operations in the graph.
-- The FastAPI app that serves the API for answering questions.
+- The semantic answer cache that answers questions similar to the ones answered before without running the graph.
+- The packed corpus of the notes (corpus_store.py), from which /notes/{note_id} returns the whole note of a cited chunk.
+- The FastAPI app (create_app) that serves the API for answering questions (and /stats with counters of the worker,
+  /metrics with latency, token and cache metrics in the Prometheus format, /ready and /warmup for the startup of the workers), with a streaming variant (/answer/stream) that sends
+  server-sent events: a "step" event as each graph node completes, "token" events with the answer as the LLM produces it
+  and a final "done" event with the whole answer and steps, and a batch variant (/answer/batch) that streams the answers
+  of many questions as newline-delimited JSON.
 
-it can be run in two modes:
+it can be run in three modes:
 - test-mode: to test the graph - this will print the answer and steps for a few hardcoded questions: python search-index\search_notes.py --mode test-mode
+- batch: to answer the questions of a JSONL file ({"question": ...} lines) with bounded concurrency, writing the answers as they complete:
+    python search-index\search_notes.py --mode batch --input questions.jsonl --output answers.jsonl --concurrency 8
 - api-mode: to start the FastAPI server that serves the API for answering questions. The API can be accessed locally at on http://localhost:8000 
     The example command for local execution: 
     python search-index\search_notes.py --mode api-mode-local (uses Uvicorn)
     or
     python search-index\search_notes.py --mode api-mode-azure (uses Gunicorn)
 
+Startup: building the components calls no service (the clients connect on first use) and only the selected providers'
+packages are imported. Under gunicorn the app is built once in the master process and the workers are forked from it
+(preload_app); every worker then warms its own connections (an embedding request and a search) in the background
+and reports ready on /ready when done.
+
 Copyright (c) 2024 Szymon Manduk AI.
 """
 
+import time
+startup_start = time.perf_counter()
+
 import argparse
-from retriever import Retriever
+import asyncio
+import json
+from retriever import Retriever, detect_labels
 from main_chain import MainChain
 from eval_chain import EvalChain
+from judge_chain import JudgeChain
 from web_search_tool import WebSearchTool
+from web_search_cache import CachedWebSearchTool
 from graph_builder import build_graph
 from graph_operations import GraphOperations
+from answer_cache import AnswerCache
+from score_evaluator import ScoreEvaluator
+from context_packer import ContextPacker
+from llm_scheduler import LLMScheduler, SchedulerOverloaded
+from embedding_cache import CachedEmbeddings
+from corpus_store import CorpusStore
+import metrics
 from langchain_core.tracers.context import tracing_v2_enabled
-from fastapi import FastAPI
 from pydantic import BaseModel
+from typing import List
 import os
 from dotenv import load_dotenv, find_dotenv
 
@@ -45,11 +77,42 @@ model = "text-embedding-ada-002"
 vector_store_address = os.getenv("AZURESEARCH_ENDPOINT") 
 vector_store_password = os.getenv("AZURESEARCH_ADMIN_KEY")
 vector_store_index = os.getenv("AZURESEARCH_INDEX_NAME")
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH")  # optional, e.g. data/embedding_cache.sqlite
+embedding_batch_window_ms = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "0"))  # concurrent questions embedded in one request, 0 = off
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))  # questions which send a batch at once
+search_backend = os.getenv("SEARCH_BACKEND", "azure")  # "azure" or "local" (in-process index built by build_index.py)
+local_index_path = os.getenv("LOCAL_INDEX_PATH", "data/local_index")
+local_index_precision = os.getenv("LOCAL_INDEX_PRECISION", "float32")  # "float32", "float16" or "int8"
+local_index_rescore = int(os.getenv("LOCAL_INDEX_RESCORE", "0"))  # candidates rescored exactly when vectors are quantized
+local_index_n_probe = int(os.getenv("LOCAL_INDEX_NPROBE", "0"))  # IVF lists scanned per query, 0 = exact scan
+speculative_web_search = os.getenv("SPECULATIVE_WEB_SEARCH", "0") == "1"  # web search concurrently with the evaluation
+context_packing = os.getenv("CONTEXT_PACKING", "1") == "1"  # compact, deduplicated prompt context of the chains
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))  # maximum tokens of the documents in a prompt
+graph_mode = os.getenv("GRAPH_MODE", "two_call")  # "two_call" (evaluate, then generate) or "fused" (one call evaluates and answers)
+evaluator_mode = os.getenv("EVALUATOR", "llm")  # "llm" or "score" (retrieval scores, the LLM only for ambiguous scores)
+score_eval_low = os.getenv("SCORE_EVAL_LOW")  # thresholds fitted by calibrate_thresholds.py
+score_eval_high = os.getenv("SCORE_EVAL_HIGH")
+answer_cache_enabled = os.getenv("ANSWER_CACHE", "0") == "1"  # semantic cache of answers to similar questions
+answer_cache_threshold = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))  # minimum cosine similarity of the questions
+answer_cache_ttl = float(os.getenv("ANSWER_CACHE_TTL", "86400"))  # seconds
+answer_cache_size = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))  # answers per worker
+web_search_cache_enabled = os.getenv("WEB_SEARCH_CACHE", "1") == "1"  # cached and coalesced web searches
+web_search_cache_ttl = float(os.getenv("WEB_SEARCH_CACHE_TTL", "3600"))  # seconds
+web_search_cache_size = int(os.getenv("WEB_SEARCH_CACHE_SIZE", "1000"))  # queries per worker
+batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", "8"))  # questions of a batch in the graph at a time
+index_version_path = os.getenv("INDEX_VERSION_PATH", "data/index_version.txt")  # written by build_index.py, clears the answer cache
+corpus_path = os.getenv("CORPUS_PATH", "data/Notes/notes.jsonl")  # packed corpus written by notes_to_json.py, optional
 
 # We may choose the provider of intelligence: Ollama (llama3.1) or OpenAI (gpt-4o-mini)
 # PROVIDER = "ollama" 
 PROVIDER = "openai"
 
+# The LLM scheduler shares the parallel slots of a local inference server (Ollama) between the chains, evaluations first
+llm_scheduler_enabled = os.getenv("LLM_SCHEDULER", "1" if PROVIDER == "ollama" else "0") == "1"
+llm_max_parallel = int(os.getenv("LLM_MAX_PARALLEL", "1"))  # the server's parallel slots (OLLAMA_NUM_PARALLEL)
+llm_max_queue = int(os.getenv("LLM_MAX_QUEUE", "32"))  # waiting LLM calls per worker, more are rejected (503)
+llm_queue_timeout = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))  # seconds a call may wait before it is rejected (503)
+
 # Define the retriever - it will retrieve documents from the vector store
 retriever = Retriever(
     openai_api_key=openai_api_key,
@@ -60,29 +123,389 @@ retriever = Retriever(
     vector_store_password=vector_store_password,
     vector_store_index=vector_store_index,
     retrieved_documents=3,
-    search_type="hybrid"
+    search_type="hybrid",
+    embedding_cache_path=embedding_cache_path,
+    backend=search_backend,
+    local_index_path=local_index_path,
+    local_precision=local_index_precision,
+    local_rescore=local_index_rescore,
+    local_n_probe=local_index_n_probe,
+    embedding_batch_window_ms=embedding_batch_window_ms,
+    embedding_batch_size=embedding_batch_size,
 )
 
+# Define the context packer - it merges overlapping chunks, drops duplicates and trims the documents to the token budget
+context_packer = ContextPacker(token_budget=context_token_budget) if context_packing else None
+
+# Define the LLM scheduler - it queues the LLM calls of both chains for the slots of the inference server
+llm_scheduler = None
+if llm_scheduler_enabled:
+    llm_scheduler = LLMScheduler(max_parallel=llm_max_parallel, max_queue=llm_max_queue, queue_timeout=llm_queue_timeout)
+
 # Define the main chain - it will generate an answer based on the retrieved documents
-main_chain = MainChain(provider=PROVIDER)
+main_chain = MainChain(provider=PROVIDER, context_packer=context_packer, scheduler=llm_scheduler)
 
 # Define the evaluation chain - it will evaluate if the retrieved documents are sufficient to answer the question
-eval_chain = EvalChain(provider=PROVIDER)
+eval_chain = EvalChain(provider=PROVIDER, context_packer=context_packer, scheduler=llm_scheduler)
+
+# Define the judge chain - in the fused graph mode it evaluates the documents and answers in one call
+judge_chain = JudgeChain(provider=PROVIDER, context_packer=context_packer, scheduler=llm_scheduler) if graph_mode == "fused" else None
+
+# With the score evaluator clearly sufficient or insufficient retrievals are decided without the evaluation chain
+evaluator = eval_chain
+if evaluator_mode == "score":
+    evaluator = ScoreEvaluator(
+        eval_chain,
+        low=float(score_eval_low) if score_eval_low else None,
+        high=float(score_eval_high) if score_eval_high else None,
+    )
+elif evaluator_mode != "llm":
+    raise ValueError("Invalid EVALUATOR. Please choose 'llm' or 'score'.")
 
 # Define websearch tool - we use Tavily Search for this
 # ToDo: extend to Azure Bing Search
 web_search_tool = WebSearchTool()
 
+# Repeated and concurrent identical web searches share one Tavily call
+if web_search_cache_enabled:
+    web_search_tool = CachedWebSearchTool(web_search_tool, ttl_seconds=web_search_cache_ttl, max_entries=web_search_cache_size)
+
  # Create graph operations
-graph_ops = GraphOperations(retriever, main_chain, eval_chain, web_search_tool)
+graph_ops = GraphOperations(retriever, main_chain, evaluator, web_search_tool, speculative_search=speculative_web_search, judge_chain=judge_chain)
 
 # Build the graph
-search_graph = build_graph(graph_ops)
+search_graph = build_graph(graph_ops, mode=graph_mode)
+
+# Define the answer cache - similar questions get the stored answer without running the graph
+answer_cache = None
+if answer_cache_enabled:
+    answer_cache = AnswerCache(
+        retriever.embeddings,
+        threshold=answer_cache_threshold,
+        ttl_seconds=answer_cache_ttl,
+        max_entries=answer_cache_size,
+        index_version_path=index_version_path,
+    )
+
+# The notes are memory-mapped (and the pages shared by the gunicorn workers), a note is read only when requested
+corpus = CorpusStore(corpus_path) if os.path.isfile(corpus_path) else None
+
+# The embedding cache keeps its own hit and miss counters, exposed on /metrics
+if isinstance(retriever.embeddings, CachedEmbeddings):
+    metrics.register_stats("embedding_cache", retriever.embeddings.stats)
+if web_search_cache_enabled:
+    metrics.register_stats("web_search_cache", web_search_tool.stats, {"hit": "hits", "miss": "misses", "coalesced": "coalesced"})
+
+print(f"Search components built in {time.perf_counter() - startup_start:.2f}s")
+
+
+# Labels of the notes, found in the questions with auto_label (read on first use)
+note_labels = None
+
+
+def known_labels():
+    """Returns the labels of the notes: those of the local index, or those of the packed corpus (Azure backend)."""
+    global note_labels
+    if note_labels is None:
+        labels = retriever.labels()
+        if labels is None and corpus is not None:
+            labels = sorted({data["label"] for _, data in corpus.items() if data.get("label")})
+        note_labels = labels or []
+    return note_labels
+
+
+def resolve_labels(question, labels=None, auto_label=False):
+    """Returns the labels the retrieval is restricted to: the given ones or, with auto_label, the ones mentioned in the question. None means all notes."""
+    if labels:
+        return labels
+    if auto_label:
+        return detect_labels(question, known_labels()) or None
+    return None
+
+
+async def lookup_answer(question, vector=None, labels=None):
+    """
+    Looks the question up in the answer cache. Returns (response or None, question vector, start time);
+    the vector (also passed to the graph, so the question is embedded once) and the start time are passed to cache_answer after a miss.
+    Questions restricted to labels are not looked up, as the cached answers come from all notes.
+    """
+    start = time.perf_counter()
+    if answer_cache is None or labels:
+        return None, vector, start
+    if vector is None:
+        with metrics.timer("call", "embedding"):
+            vector = await retriever.embeddings.aembed_query(question)
+    entry = await answer_cache.alookup(question, vector)
+    metrics.record_answer_cache(entry is not None)
+    if entry is None:
+        return None, vector, start
+    seconds = time.perf_counter() - start
+    metrics.answer_seconds.labels("cache").observe(seconds)
+    saved = answer_cache.record_hit(entry, seconds)
+    return {
+        "answer": entry["answer"],
+        "steps": entry["steps"],
+        "cached": True,
+        "similarity": entry["similarity"],
+        "latency_saved_ms": round(saved * 1000, 1),
+    }, vector, start
+
+
+def cache_answer(question, vector, start, answer, steps, labels=None):
+    """Records the time of an answer from the graph and caches the answer (unless the question was restricted to labels)."""
+    seconds = time.perf_counter() - start
+    metrics.answer_seconds.labels("graph").observe(seconds)
+    if answer_cache is not None and answer is not None and not labels:
+        answer_cache.add(question, vector, answer, steps, seconds)
+
+
+async def answer_question(question, vector=None, timings=False, labels=None, auto_label=False):
+    """
+    Answers the question from the answer cache or by running the graph. The question vector is optional.
+    With labels (or auto_label) only the notes with those labels are searched, and the response has the "labels" used.
+    With timings the response also has the wall time of every node and outbound call ("timings") and the total ("total_ms").
+    """
+    request_timings = metrics.start_timings() if timings else None
+    labels = resolve_labels(question, labels, auto_label)
+    cached, vector, start = await lookup_answer(question, vector, labels)
+    if cached is not None:
+        response = cached
+    else:
+        result = await search_graph.ainvoke({"question": question, "question_vector": vector, "labels": labels})
+        cache_answer(question, vector, start, result['answer'], result['steps'], labels)
+        response = {"answer": result['answer'], "steps": result['steps'], "cached": False}
+    if labels:
+        response = {**response, "labels": labels}
+    if timings:
+        response = {**response, "timings": request_timings, "total_ms": round((time.perf_counter() - start) * 1000, 1)}
+    return response
+
+
+async def answer_batch(questions, concurrency=8, labels=None, auto_label=False):
+    """
+    Answers a batch of questions with at most `concurrency` of them in the graph at a time (restricted to the labels
+    or with auto_label to the labels each question mentions, as in answer_question), and yields
+    {"index", "question", "answer", "steps", "cached"} (or "error") for every question as soon as it is answered.
+    Repeated questions run once, and all questions are embedded with one embedding request.
+    """
+    unique = list(dict.fromkeys(question.strip() for question in questions))
+    positions = {}
+    for index, question in enumerate(questions):
+        positions.setdefault(question.strip(), []).append(index)
+
+    try:
+        vectors = await retriever.embeddings.aembed_documents(unique)
+    except Exception as e:
+        # Every question embeds its own question instead
+        print(f"Batch embedding failed: {e}")
+        vectors = [None] * len(unique)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer(question, vector):
+        async with semaphore:
+            try:
+                return question, await answer_question(question, vector, labels=labels, auto_label=auto_label)
+            except Exception as e:
+                return question, {"error": str(e)}
+
+    tasks = [asyncio.create_task(answer(question, vector)) for question, vector in zip(unique, vectors)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            question, result = await task
+            for index in positions[question]:
+                yield {"index": index, "question": questions[index], **result}
+    finally:
+        # The client may have disconnected before the end of the batch
+        for task in tasks:
+            task.cancel()
+
+
+async def run_batch(input_path, output_path, concurrency):
+    """Answers the questions of a JSONL file ({"question": ...} lines) and writes the results as JSONL lines as they complete."""
+    with open(input_path, "r", encoding="utf-8") as f:
+        questions = [json.loads(line)["question"] for line in f if line.strip()]
+
+    start = time.perf_counter()
+    errors = 0
+    with open(output_path, "w", encoding="utf-8") as f:
+        async for result in answer_batch(questions, concurrency):
+            errors += "error" in result
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+            f.flush()
+    print(f"Answered {len(questions)} questions in {time.perf_counter() - start:.1f}s ({errors} errors), results written to {output_path}.")
+
+
+def server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_answer(question, labels=None, auto_label=False):
+    """
+    Runs the graph for the question and yields server-sent events: "step" when a node completes, "token" for every
+    piece of the answer streamed by the LLM of the generate node, and "done" with the final answer and steps.
+    An answer found in the answer cache is sent as a single "token" event.
+    An exception is reported as an "error" event, as the response status has already been sent.
+    """
+    answer = None
+    steps = []
+    streamed = False
+    try:
+        labels = resolve_labels(question, labels, auto_label)
+        cached, vector, start = await lookup_answer(question, labels=labels)
+        if cached is not None:
+            yield server_sent_event("token", {"token": cached["answer"]})
+            yield server_sent_event("done", cached)
+            return
+
+        async for event in search_graph.astream_events({"question": question, "question_vector": vector, "labels": labels}, version="v2"):
+            node = event["metadata"].get("langgraph_node")
+            if event["event"] == "on_chat_model_stream" and node == "generate":
+                token = event["data"]["chunk"].content
+                if token:
+                    streamed = True
+                    yield server_sent_event("token", {"token": token})
+            elif event["event"] == "on_chain_stream" and not event["parent_ids"]:
+                # The graph itself streams {node: state update} when a node completes
+                for node, output in event["data"]["chunk"].items():
+                    steps = output.get("steps", steps)
+                    answer = output.get("answer", answer)
+                    if answer and not streamed:
+                        # The answer of the judge node (fused mode) is part of its JSON verdict, so it is sent at once
+                        streamed = True
+                        yield server_sent_event("token", {"token": answer})
+                    yield server_sent_event("step", {"node": node, "steps": steps})
+    except Exception as e:
+        # The status the non-streaming endpoint would return (503 when the LLM queue is full)
+        yield server_sent_event("error", {"error": str(e), "status": 503 if isinstance(e, SchedulerOverloaded) else 500})
+        return
+    cache_answer(question, vector, start, answer, steps, labels)
+    done = {"answer": answer, "steps": steps, "cached": False}
+    yield server_sent_event("done", {**done, "labels": labels} if labels else done)
+
+
+# Per-process warmup state: the connections of a worker are opened by its first requests, so warmup() sends one of each
+warmup_state = {"ready": False, "seconds": None, "error": None}
+
+
+async def warmup():
+    """Opens the connections of this process (embedding model and search service) with one retrieval. Returns the warmup state."""
+    start = time.perf_counter()
+    try:
+        await retriever.aretrieve("warmup")
+        warmup_state["error"] = None
+    except Exception as e:
+        # A worker that cannot warm up still serves requests (they connect on first use)
+        warmup_state["error"] = str(e)
+        print(f"Warmup failed: {e}")
+    warmup_state["seconds"] = round(time.perf_counter() - start, 3)
+    warmup_state["ready"] = True
+    print(f"Worker {os.getpid()} ready in {time.perf_counter() - startup_start:.2f}s since start (warmup {warmup_state['seconds']:.2f}s)")
+    return warmup_state
+
+
+class Question(BaseModel):
+    question: str
+    timings: bool = False  # return the wall time of every node and outbound call (/answer)
+    labels: List[str] = []  # search only the notes with one of these labels
+    auto_label: bool = False  # without labels, search only the notes with the labels mentioned in the question (if any)
+
+
+class Questions(BaseModel):
+    questions: List[str]
+    concurrency: int = batch_concurrency
+    labels: List[str] = []
+    auto_label: bool = False
+
+
+def create_app():
+    """Returns the FastAPI app (used in both local and Azure). FastAPI is imported here, so the other modes do not pay for it."""
+    from fastapi import FastAPI
+    from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+    app = FastAPI()
+    warmup_tasks = set()
+
+    @app.exception_handler(SchedulerOverloaded)
+    async def overloaded(request, exc):
+        # Rejected at once when the LLM queue is full, so clients and load balancers can retry elsewhere
+        return JSONResponse({"error": str(exc)}, status_code=503, headers={"Retry-After": "1"})
+
+    @app.on_event("startup")
+    async def start_warmup():
+        # Runs in every worker (after the fork) without delaying its startup
+        task = asyncio.create_task(warmup())
+        warmup_tasks.add(task)
+        task.add_done_callback(warmup_tasks.discard)
+
+    @app.get("/ready")
+    async def get_ready():
+        # 503 until the worker has warmed up, for health probes that should not route traffic to a cold worker
+        return JSONResponse(warmup_state, status_code=200 if warmup_state["ready"] else 503)
+
+    @app.post("/warmup")
+    async def post_warmup():
+        return await warmup()
+
+    @app.post("/answer")
+    async def get_answer(question: Question):
+        # The async graph path keeps the event loop free while the nodes wait for the LLMs and search services
+        return await answer_question(question.question, timings=question.timings, labels=question.labels, auto_label=question.auto_label)
+
+    @app.post("/answer/stream")
+    async def stream_answer_events(question: Question):
+        # X-Accel-Buffering stops reverse proxies from buffering the events until the answer is complete
+        return StreamingResponse(
+            stream_answer(question.question, question.labels, question.auto_label),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @app.post("/answer/batch")
+    async def get_batch_answers(batch: Questions):
+        # Newline-delimited JSON, one line per question in the order the answers complete
+        async def lines():
+            async for result in answer_batch(batch.questions, max(1, min(batch.concurrency, batch_concurrency)), batch.labels, batch.auto_label):
+                yield json.dumps(result) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    @app.get("/notes/{note_id}")
+    async def get_note(note_id: str):
+        # The whole note of a chunk cited in an answer (the note_id of its metadata)
+        note = corpus.get(note_id) if corpus is not None else None
+        if note is None:
+            return JSONResponse({"error": f"Note {note_id} not found"}, status_code=404)
+        return {"note_id": note_id, **note}
+
+    @app.get("/stats")
+    async def get_stats():
+        # Counters of this worker process
+        return {
+            "speculative_web_search": graph_ops.speculation_stats() if graph_ops.speculative_search else None,
+            "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+            "score_evaluator": evaluator.stats() if evaluator_mode == "score" else None,
+            "web_search_cache": web_search_tool.stats() if web_search_cache_enabled else None,
+            "llm_scheduler": llm_scheduler.stats() if llm_scheduler is not None else None,
+            "embedding_batcher": retriever.embedding_batcher.stats() if retriever.embedding_batcher is not None else None,
+        }
+
+    @app.get("/metrics")
+    async def get_metrics():
+        content, content_type = metrics.render()
+        return Response(content, media_type=content_type)
+
+    return app
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run the script in different modes")
-    parser.add_argument('--mode', type=str, required=True, choices=['test-mode', 'api-mode-local', 'api-mode-azure'], help="Mode of operation: 'test-mode', 'api-mode-local' or 'api-mode-azure'")
+    parser.add_argument('--mode', type=str, required=True, choices=['test-mode', 'api-mode-local', 'api-mode-azure', 'batch'], help="Mode of operation: 'test-mode', 'api-mode-local', 'api-mode-azure' or 'batch'")
+    parser.add_argument('--input', type=str, help="JSONL file with {\"question\": ...} lines (batch mode)")
+    parser.add_argument('--output', type=str, default='answers.jsonl', help="JSONL file for the answers (batch mode)")
+    parser.add_argument('--concurrency', type=int, default=batch_concurrency, help="Questions answered at the same time (batch mode)")
     args = parser.parse_args()
+    if args.mode == 'batch' and not args.input:
+        parser.error("--mode batch needs --input")
     print(f"Arguments parsed - mode: {args.mode}")
 
     if args.mode == 'test-mode':
@@ -103,18 +526,13 @@ if __name__ == "__main__":
             print(result['answer'])
             print(result['steps'])
 
+    elif args.mode == 'batch':
+        #### Answering the questions of a file ####
+        asyncio.run(run_batch(args.input, args.output, args.concurrency))
+
     else:
         #### Define fastAPI App (used in both local and Azure) ####
-        app = FastAPI()
-
-        class Question(BaseModel):
-            question: str
-
-        @app.post("/answer")
-        async def get_answer(question: Question):
-            result = search_graph.invoke({"question": question.question})
-            return {"answer": result['answer'], "steps": result['steps']}
-        
+        app = create_app()
         print("FastAPI app created")
 
         if args.mode == 'api-mode-local':
@@ -125,7 +543,6 @@ if __name__ == "__main__":
         elif args.mode == 'api-mode-azure':
             print("Starting FastAPI server via gunicorn")
             #### Azure API Mode: Start FastAPI server via gunicorn ####
-                        #### Azure API Mode: Start FastAPI server via gunicorn ####
             from gunicorn.app.base import BaseApplication
 
             class StandaloneApplication(BaseApplication):
@@ -146,7 +563,11 @@ if __name__ == "__main__":
             options = {
                 'bind': '0.0.0.0:8000',
                 'workers': 4,
-                'worker_class': 'uvicorn.workers.UvicornWorker'
+                'worker_class': 'uvicorn.workers.UvicornWorker',
+                # The app built above is shared by the forked workers (nothing is imported or built again per worker)
+                'preload_app': True,
+                # Removes the metrics of exited workers (with PROMETHEUS_MULTIPROC_DIR)
+                'child_exit': lambda server, worker: metrics.mark_process_dead(worker.pid),
             }
             StandaloneApplication(app, options).run()
         else:
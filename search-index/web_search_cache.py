@@ -0,0 +1,170 @@
+"""
+Filename: web_search_cache.py
+
+Author: Szymon Manduk
+
+Company: Szymon Manduk AI, manduk.ai
+
+Description: Defines a cache around the web search tool. Results are kept per normalized query (case, whitespace and
+trailing punctuation do not matter) for a TTL, and the least recently used ones are evicted when the cache is full.
+Concurrent identical queries are coalesced: the first one calls the web search, the others wait for its result,
+so a popular question asked by several users at once costs one (paid, slow) search.
+
+The cache lives in the memory of a worker process (every gunicorn worker has its own).
+
+Copyright (c) 2024 Szymon Manduk AI.
+"""
+
+import asyncio
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def normalize_query(query):
+    """Returns the cache key of a query: lowercase, single spaces, without trailing punctuation."""
+    return re.sub(r"\s+", " ", query).strip().lower().rstrip("?!.")
+
+
+class CachedWebSearchTool:
+    """
+    A class wrapping a web search tool (WebSearchTool) with a result cache and request coalescing. It has the interface
+    of WebSearchTool, so it can replace it in GraphOperations.
+
+    Args:
+        web_search_tool (WebSearchTool): The web search tool to wrap.
+        ttl_seconds (float, optional): The lifetime of cached results. Defaults to 3600 (one hour).
+        max_entries (int, optional): The maximum number of cached queries. Defaults to 1000.
+
+    Attributes:
+        entries (OrderedDict): Normalized query -> (created, results), in LRU order.
+        in_flight (dict): Normalized query -> Future of the sync searches in progress.
+        async_in_flight (dict): Normalized query -> Task of the async searches in progress.
+
+    Methods:
+        search(query) -> list: Returns the cached results, the results of an identical search in progress or new results.
+        asearch(query) -> list: Async version of search.
+        clear(): Removes all entries.
+        stats() -> dict: Returns the hits, misses, coalesced requests, web searches made and number of entries.
+    """
+
+    def __init__(self, web_search_tool, ttl_seconds=3600, max_entries=1000):
+        self.web_search_tool = web_search_tool
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.async_in_flight = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.searches = 0
+
+    def _cached(self, key):
+        # Callers hold the lock
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        created, results = entry
+        if time.monotonic() - created > self.ttl_seconds:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return results
+
+    def _checked(self, results):
+        # TavilySearchResults returns the repr of the error as a string when the API call fails (e.g. a 429),
+        # so it is raised here to be neither cached nor passed to the coalesced requests as results
+        if not isinstance(results, list):
+            raise RuntimeError(f"Web search failed: {results}")
+        return results
+
+    def _store(self, key, results):
+        with self.lock:
+            self.searches += 1
+            self.entries[key] = (time.monotonic(), results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def search(self, query):
+        key = normalize_query(query)
+        with self.lock:
+            results = self._cached(key)
+            if results is not None:
+                self.hits += 1
+                return results
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                self.misses += 1
+                future = self.in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            results = self._checked(self.web_search_tool.search(query))
+            self._store(key, results)
+            future.set_result(results)
+            return results
+        except BaseException as e:
+            # Errors are not cached, the waiting requests get the same error
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+    async def asearch(self, query):
+        key = normalize_query(query)
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            results = self._cached(key)
+            if results is not None:
+                self.hits += 1
+                return results
+            task = self.async_in_flight.get(key)
+            if task is not None and task.get_loop() is loop:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                # The search runs in its own task, so a cancelled request (e.g. an unneeded speculative search)
+                # does not cancel it for the other requests waiting for it
+                task = self.async_in_flight[key] = loop.create_task(self._asearch(key, query))
+                # Retrieves the error of a search nobody waits for any more
+                task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+        return await asyncio.shield(task)
+
+    async def _asearch(self, key, query):
+        try:
+            results = self._checked(await self.web_search_tool.asearch(query))
+            self._store(key, results)
+            return results
+        finally:
+            with self.lock:
+                if self.async_in_flight.get(key) is asyncio.current_task():
+                    del self.async_in_flight[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "web_searches": self.searches,
+                "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+                "entries": len(self.entries),
+            }
@@ -10,6 +10,7 @@ Description: Defines a class that represents a tool for searching the web for do
 Copyright (c) 2024 Szymon Manduk AI.
 """
 from langchain_community.tools.tavily_search import TavilySearchResults
+from metrics import timer
 
 class WebSearchTool:
     """
@@ -21,6 +22,7 @@ class WebSearchTool:
 
     Methods:
         search(self, query): Searches the web for documents that may help to answer a given question.
+        asearch(self, query): Async version of search.
     """
     
     def __init__(self, max_results = 3):
@@ -28,4 +30,9 @@ class WebSearchTool:
         self.web_search_tool = TavilySearchResults(max_results=self.max_results, include_images=False)
     
     def search(self, query):
-        return self.web_search_tool.invoke({"query": query})
+        with timer("call", "web_search"):
+            return self.web_search_tool.invoke({"query": query})
+
+    async def asearch(self, query):
+        with timer("call", "web_search"):
+            return await self.web_search_tool.ainvoke({"query": query})
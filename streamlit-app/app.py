@@ -10,6 +10,7 @@ Description: Simple Streamlit application for asking questions and getting answe
 Copyright (c) 2024 Szymon Manduk AI.
 """
 
+import json
 import streamlit as st
 import requests
 
@@ -22,13 +23,33 @@ question = st.text_input("Your question:")
 
 if st.button("Get Answer"):
     if question:
-        # Send request to your API
-        response = requests.post(f"{API_URL}/answer", json={"question": question})
+        # Send request to the streaming endpoint, so the answer is shown as the LLM produces it
+        response = requests.post(f"{API_URL}/answer/stream", json={"question": question}, stream=True)
         if response.status_code == 200:
-            answer = response.json()["answer"]
-            steps = response.json()["steps"]
-            st.write("Answer:", answer)
-            st.write("Steps:", steps)
+            steps = st.empty()
+            result = {}
+
+            def tokens():
+                # Server-sent events: "event: <name>" and "data: <json>" lines, separated by an empty line
+                event = None
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: "):
+                        data = json.loads(line[len("data: "):])
+                        if event == "token":
+                            yield data["token"]
+                        elif event == "step":
+                            steps.write(f"Steps: {data['steps']}")
+                        elif event in ("done", "error"):
+                            result[event] = data
+
+            st.write("Answer:")
+            st.write_stream(tokens())
+            if "done" in result:
+                steps.write(f"Steps: {result['done']['steps']}")
+            else:
+                st.error("Failed to get an answer. Please try again.")
         else:
             st.error("Failed to get an answer. Please try again.")
     else: